@@ -0,0 +1,113 @@
+"""
+Сравнение серверов (потоки и asyncio) при большом числе простаивающих клиентов:
+память и число потоков сервера, задержка подключения до получения меню.
+
+    python -m benchmarks.bench_connections --clients 1000
+"""
+import argparse
+import asyncio
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+MAIN = Path(__file__).resolve().parent.parent / "main.py"
+MENU_END = "6. Выход\n".encode()
+
+
+def raise_fd_limit(count: int) -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = min(hard, max(soft, count + 256))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+
+def process_stats(pid: int) -> dict:
+    stats = {}
+    for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+        key, _, value = line.partition(":")
+        if key in ("VmRSS", "Threads"):
+            stats[key] = int(value.split()[0])
+    return stats
+
+
+def wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Сервер не запустился на порту {port}")
+
+
+async def open_idle_client(port: int):
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    await reader.readuntil(MENU_END)
+    return time.perf_counter() - start, writer
+
+
+async def measure(pid: int, port: int, clients: int):
+    """Подключает клиентов одновременно и снимает показатели сервера, пока они простаивают"""
+    results = await asyncio.gather(*(open_idle_client(port) for _ in range(clients)))
+    await asyncio.sleep(0.5)
+    stats = process_stats(pid)
+    for _, writer in results:
+        writer.close()
+    return [latency for latency, _ in results], stats
+
+
+def run(mode: str, port: int, clients: int) -> None:
+    args = [sys.executable, str(MAIN), "--port", str(port)]
+    if mode == "asyncio":
+        args.append("--async")
+    with tempfile.TemporaryDirectory() as workdir:
+        server = subprocess.Popen(
+            args,
+            cwd=workdir,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            preexec_fn=lambda: raise_fd_limit(clients),
+        )
+        try:
+            wait_for_port(port)
+            time.sleep(0.5)
+            before = process_stats(server.pid)
+            latencies, after = asyncio.run(measure(server.pid, port, clients))
+        finally:
+            server.terminate()
+            server.wait()
+
+    latencies.sort()
+    rss_per_client = (after["VmRSS"] - before["VmRSS"]) / clients
+    print(
+        f"{mode:8} клиентов: {clients:5}  "
+        f"потоков: {before['Threads']} -> {after['Threads']:5}  "
+        f"RSS: {before['VmRSS'] / 1024:.1f} -> {after['VmRSS'] / 1024:.1f} МБ "
+        f"({rss_per_client:.1f} КБ на клиента)  "
+        f"подключение: медиана {statistics.median(latencies) * 1000:.1f} мс, "
+        f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f} мс, "
+        f"макс {latencies[-1] * 1000:.1f} мс"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=9970)
+    parser.add_argument("--mode", choices=["threads", "asyncio", "both"], default="both")
+    args = parser.parse_args()
+
+    raise_fd_limit(args.clients)
+    modes = ["threads", "asyncio"] if args.mode == "both" else [args.mode]
+    for offset, mode in enumerate(modes):
+        run(mode, args.port + offset, args.clients)
+
+
+if __name__ == "__main__":
+    main()
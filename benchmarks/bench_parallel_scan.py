@@ -0,0 +1,63 @@
+"""
+Пропускная способность просмотра файла (записей в секунду) в зависимости от числа
+процессов пула: поиск подстроки (scan_books) и сводка по жанрам (count_field_values).
+
+    python -m benchmarks.bench_parallel_scan --rows 1000000 --processes 1 2 4 8
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import generate_library  # noqa: E402
+import main as db  # noqa: E402
+
+
+def scan(path: Path, value: str) -> int:
+    with path.open("rb") as file:
+        return sum(1 for _ in db.scan_books(file, "name", value))
+
+
+def count(path: Path, value: str) -> int:
+    with path.open("rb") as file:
+        return len(db.count_field_values(file, ["genres", "rating"], {"rating": db.RATING_PREFIX}))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--value", default="ова")
+    parser.add_argument(
+        "--processes", type=int, nargs="+", default=sorted({1, 2, os.cpu_count() or 1})
+    )
+    parser.add_argument("--file", type=Path, help="готовый файл базы вместо сгенерированного")
+    args = parser.parse_args()
+    print(f"Ядер: {os.cpu_count()}")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = args.file
+        if path is None:
+            path = Path(workdir) / "library.txt"
+            generate_library.write_database(path, args.rows, seed=1, check=False)
+        rows = os.path.getsize(path) // db.RECORD_SIZE - 1
+        db.PARALLEL_SCAN_MIN_RECORDS = 1
+        for processes in args.processes:
+            db.SCAN_PROCESSES = processes
+            # Новый пул на каждое число процессов; первый просмотр запускает процессы и
+            # прогревает кэш страниц, поэтому не измеряется
+            db.scan_pool = None
+            scan(path, args.value)
+            for name, function in (("поиск", scan), ("сводка", count)):
+                start = time.perf_counter()
+                function(path, args.value)
+                elapsed = time.perf_counter() - start
+                print(f"процессов: {processes:2}  {name:6} {rows / elapsed:12,.0f} записей/с")
+            if db.scan_pool is not None:
+                db.scan_pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Сравнение полного просмотра файла при поиске подстроки: чтение со сборкой
+словаря на каждую запись (прежний и текущий record_to_dict) и поиск по отображенному
+в память файлу (scan_books), который собирает книгу только для подходящих записей.
+
+    python -m benchmarks.bench_scan --rows 1000000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import generate_library  # noqa: E402
+import main as db  # noqa: E402
+
+def build_file(path: Path, rows: int) -> None:
+    generate_library.write_database(path, rows, seed=1, check=False)
+
+
+def legacy_record_to_dict(record: bytes) -> dict:
+    """record_to_dict до появления scan_books: декодирование, затем обрезка пробелов"""
+    return {
+        header: record[field_slice].decode().rstrip(" ")
+        for header, field_slice in db.FIELD_SLICES.items()
+    }
+
+
+def scan_legacy(path: Path, field: str, value: str) -> int:
+    """Прежний путь: словарь из 12 полей на каждую запись, затем проверка"""
+    with path.open("rb") as file:
+        return sum(
+            1
+            for _, record in db.iter_records(file)
+            if not db.is_deleted(record) and value in legacy_record_to_dict(record)[field].lower()
+        )
+
+
+def scan_dicts(path: Path, field: str, value: str) -> int:
+    """Тот же путь с текущим record_to_dict"""
+    with path.open("rb") as file:
+        return sum(1 for book in db.iter_books(file) if value in book[field].lower())
+
+
+def scan_mmap(path: Path, field: str, value: str) -> int:
+    with path.open("rb") as file:
+        return sum(1 for _ in db.scan_books(file, field, value))
+
+
+def measure(function, path: Path, field: str, value: str) -> tuple:
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    found = function(path, field, value)
+    cpu = time.process_time() - start_cpu
+    wall = time.perf_counter() - start
+    return found, cpu, wall
+
+
+def measure_allocations(function, path: Path, field: str, value: str) -> int:
+    tracemalloc.start()
+    try:
+        function(path, field, value)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--field", default="name")
+    parser.add_argument("--value", default="ова")
+    parser.add_argument("--file", type=Path, help="готовый файл базы вместо сгенерированного")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = args.file
+        if path is None:
+            path = Path(workdir) / "library.txt"
+            start = time.perf_counter()
+            build_file(path, args.rows)
+            print(
+                f"Файл: {args.rows} записей, {os.path.getsize(path) / 2 ** 20:.0f} МБ "
+                f"({time.perf_counter() - start:.1f} с)"
+            )
+        value = args.value.lower()
+        # Первый проход прогревает кэш страниц, чтобы оба способа читали из памяти
+        scan_mmap(path, args.field, value)
+        results = {}
+        for name, function in (("прежний", scan_legacy), ("словари", scan_dicts), ("mmap", scan_mmap)):
+            found, cpu, wall = measure(function, path, args.field, value)
+            peak = measure_allocations(function, path, args.field, value)
+            results[name] = cpu
+            print(
+                f"{name:8} найдено: {found:8}  CPU: {cpu:6.2f} с  время: {wall:6.2f} с  "
+                f"пик памяти Python: {peak / 1024:8.1f} КБ"
+            )
+        print(f"Ускорение по CPU: {results['прежний'] / max(results['mmap'], 1e-9):.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Скорость проверки книг (книг в секунду): прежние проверки с некомпилированными
+регулярными выражениями и strptime, проверка одной книги validate_book
+и проверка пакета validate_books.
+
+    python -m benchmarks.bench_validation --books 20000
+"""
+import argparse
+import re
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main as db  # noqa: E402
+import validators  # noqa: E402
+
+POOL_SIZE = 1000
+
+
+# Проверки до появления модуля validators
+def legacy_validate_regex(field, value):
+    if not re.fullmatch(validators.regex_schema[field], str(value)):
+        raise ValueError(field)
+
+
+def legacy_validate_book(book):
+    for field in ["name", "authors", "genres", "book_type", "source", "rating"]:
+        legacy_validate_regex(field, book[field])
+    legacy_validate_regex("year", book["year"])
+    if int(book["year"]) > datetime.now().year or int(book["year"]) < 1500:
+        raise ValueError("year")
+    for field in ["width", "height"]:
+        legacy_validate_regex(field, book[field])
+        if not 0 < float(book[field]) <= 1000:
+            raise ValueError(field)
+    legacy_validate_regex("date_added", book["date_added"])
+    date_added = datetime.strptime(book["date_added"], "%d-%m-%Y")
+    if date_added >= datetime.now() or date_added.year < int(book["year"]):
+        raise ValueError("date_added")
+    legacy_validate_regex("date_read", book["date_read"])
+    if datetime.strptime(book["date_read"], "%d-%m-%Y") < date_added:
+        raise ValueError("date_read")
+
+
+def run_legacy(books):
+    for book in books:
+        legacy_validate_book(book)
+
+
+def run_single(books):
+    for book in books:
+        validators.validate_book(book)
+
+
+def run_batch(books):
+    if validators.validate_books(books):
+        raise ValueError("книги не прошли проверку")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--books", type=int, default=20000)
+    args = parser.parse_args()
+
+    pool = [{key: str(value) for key, value in book.items()} for book in db.generate_books(POOL_SIZE)]
+    books = [pool[i % POOL_SIZE] for i in range(args.books)]
+    results = {}
+    for name, function in (("прежняя", run_legacy), ("по одной", run_single), ("пакет", run_batch)):
+        start = time.perf_counter()
+        function(books)
+        rate = len(books) / (time.perf_counter() - start)
+        results[name] = rate
+        print(f"{name:9} {rate:12,.0f} книг/с")
+    print(f"Ускорение пакетной проверки: {results['пакет'] / results['прежняя']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
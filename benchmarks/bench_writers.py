@@ -0,0 +1,120 @@
+"""
+Пропускная способность записи при одновременных клиентах: каждый клиент по протоколу
+добавляет книги (ADD) и обновляет добавленные (UPD). Сравнивается сервер без задержек
+и сервер с прежней задержкой 0.3 с под блокировкой, внесенной флагом --inject.
+
+    python -m benchmarks.bench_writers --writers 1 4 16 --seconds 5
+"""
+import argparse
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import client  # noqa: E402
+import generate_library  # noqa: E402
+import main as db  # noqa: E402
+
+MAIN = Path(__file__).resolve().parent.parent / "main.py"
+# Задержка, которую add_book и modify_books_file делали под блокировкой до появления --inject
+LEGACY_DELAY = ["--inject", "add_book=0.3", "--inject", "modify_books_file=0.3"]
+BOOKS_PER_SECOND = 5000
+
+
+def wait_for_port(port: int, timeout: float = 60) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Сервер не запустился на порту {port}")
+
+
+def writer(port: int, books: list, deadline: float, latencies: list, errors: list) -> None:
+    """ADD новой книги, затем UPD ее года - пока не истечет время"""
+    sock, reader = client.connect("127.0.0.1", port)
+    try:
+        for book in books:
+            if time.perf_counter() >= deadline:
+                break
+            line = "|".join(str(book[field]) for field in db.HEADERS[1:])
+            start = time.perf_counter()
+            [(ok, lines)] = client.request(sock, reader, [f"ADD {line}"])
+            latencies.append(time.perf_counter() - start)
+            if not ok:
+                errors.append(lines)
+                continue
+            book_id = lines[0].split("|")[0]
+            start = time.perf_counter()
+            [(ok, lines)] = client.request(sock, reader, [f"UPD {book_id} year {book['year']}"])
+            latencies.append(time.perf_counter() - start)
+            if not ok:
+                errors.append(lines)
+        client.request(sock, reader, ["QUIT"])
+    finally:
+        sock.close()
+
+
+def run(name: str, extra_args: list, port: int, writers: int, seconds: float) -> None:
+    # С запасом: без задержки клиент успевает больше тысячи записей в секунду
+    count = max(BOOKS_PER_SECOND * seconds, 100 * writers)
+    books = [book for batch in generate_library.iter_batches(int(count), seed=1) for book in batch]
+    with tempfile.TemporaryDirectory() as workdir:
+        server = subprocess.Popen(
+            [sys.executable, str(MAIN), "--port", str(port), *extra_args],
+            cwd=workdir,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_for_port(port)
+            latencies = []
+            errors = []
+            deadline = time.perf_counter() + seconds
+            threads = [
+                threading.Thread(
+                    target=writer,
+                    args=(port, books[i::writers], deadline, latencies, errors),
+                )
+                for i in range(writers)
+            ]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            server.terminate()
+            server.wait()
+
+    latencies.sort()
+    print(
+        f"{name:9} клиентов: {writers:3}  записей: {len(latencies):6}  "
+        f"{len(latencies) / elapsed:9,.1f} записей/с  "
+        f"задержка: медиана {statistics.median(latencies) * 1000:7.1f} мс, "
+        f"макс {latencies[-1] * 1000:7.1f} мс  ошибок: {len(errors)}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--writers", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--port", type=int, default=9975)
+    args = parser.parse_args()
+
+    for writers in args.writers:
+        for offset, (name, extra_args) in enumerate((("с 0.3 с", LEGACY_DELAY), ("без", []))):
+            run(name, extra_args, args.port + offset, writers, args.seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,62 @@
 import socket
-import time
+
+
+def connect(host='127.0.0.1', port=9956):
+    """Подключение к серверу в режиме протокола (команда PROTO вместо пункта меню)"""
+    sock = socket.create_connection((host, port))
+    sock.settimeout(600)
+    reader = sock.makefile("rb")
+    sock.sendall(b"PROTO\n")
+    # Пропускаем приветствие и меню до подтверждения режима
+    for line in reader:
+        if line == b"OK PROTO\n":
+            break
+    return sock, reader
+
+
+def read_reply(reader):
+    """Ответ сервера: (True, строки данных) или (False, сообщение об ошибке)"""
+    status = reader.readline().decode().strip()
+    if status == "OK *":
+        # Ответ порциями (LIST, FIND): строки до "." или до ошибки
+        lines = []
+        for line in reader:
+            line = line.decode().rstrip("\n")
+            if line == ".":
+                return True, lines
+            if line.startswith("ERR "):
+                return False, line[4:]
+            lines.append(line)
+        return False, "Соединение закрыто"
+    if status.startswith("OK"):
+        count = int(status.split()[1])
+        return True, [reader.readline().decode().rstrip("\n") for _ in range(count)]
+    return False, status[4:]
+
+
+def request(sock, reader, commands):
+    """Отправка всех команд одним сообщением и чтение ответов в том же порядке"""
+    sock.sendall("".join(f"{command}\n" for command in commands).encode())
+    return [read_reply(reader) for _ in commands]
+
 
 def auto_add_books(host='127.0.0.1', port=9956, count=1000):
+    sock = None
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((host, port))
-        sock.settimeout(10)  # Увеличиваем таймаут
-        
-        # Получаем приветственное сообщение
-        print(sock.recv(4096).decode())
-        
-        for i in range(1, count + 1):
-            # Отправляем выбор меню
-            sock.sendall(b"1\n")  # Выбираем "Добавить книгу"
-            time.sleep(0.2)
-            
-            # Получаем подменю добавления
-            menu = sock.recv(4096).decode()
-            
-            # Выбираем генерацию книги
-            sock.sendall(b"1.1\n")
-            time.sleep(0.2)
-            
-            # Получаем сгенерированную книгу
-            book_info = sock.recv(4096).decode()
-            
-            # Подтверждаем добавление
-            sock.sendall(b"y\n")
-            time.sleep(0.2)
-            
-            # Получаем ответ о добавлении
-            response = sock.recv(4096).decode().strip()
-            print(f"Книга {i}/{count}: {response}")
-            
-            # Возвращаемся в главное меню
-            if i < count:
-                sock.sendall(b"\n")
-                time.sleep(0.2)
-                
+        sock, reader = connect(host, port)
+
+        # Все книги генерируются и добавляются сервером за одну операцию
+        [(ok, lines)] = request(sock, reader, [f"GEN {count}"])
+        print("\n".join(lines) if ok else f"Ошибка: {lines}")
+
+        request(sock, reader, ["QUIT"])
     except Exception as e:
         print(f"Ошибка: {e}")
     finally:
-        sock.close()
+        if sock is not None:
+            sock.close()
         print("Соединение закрыто")
 
+
 if __name__ == "__main__":
-    auto_add_books(count=1000)
\ No newline at end of file
+    auto_add_books(count=1000)
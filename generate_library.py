@@ -0,0 +1,230 @@
+"""
+Быстрая генерация тестовой библиотеки: книги, проходящие проверки validators,
+с фиксированным зерном случайности. Книги записываются прямо в файл базы
+или отправляются на сервер пакетами BATCH.
+
+    python3 generate_library.py --books 1000000 --output home_library.txt
+    python3 generate_library.py --books 100000 --server 127.0.0.1:9999
+"""
+import argparse
+import functools
+import os
+import random
+import sys
+import time
+from datetime import date
+from pathlib import Path
+from typing import List
+
+from faker import Faker
+
+import client
+import main as db
+import validators
+
+# Словари, из которых собираются книги: Faker вызывается только при их построении
+AUTHORS_COUNT = 2000
+# Длина слова ограничена, чтобы название (до 5 слов) и комментарий (до 10 слов)
+# всегда помещались в ограничения схемы
+MAX_WORD_LENGTH = 15
+# Ширина и высота - строки с одним знаком после запятой от 10.0 до 200.0
+SIZES = [f"{tenths / 10:.1f}" for tenths in range(100, 2001)]
+BATCH_SIZE = 10000
+
+
+def build_vocabulary(seed: int) -> tuple:
+    """Авторы и слова из Faker с тем же зерном, поэтому словари одинаковы при каждом запуске"""
+    fake = Faker("ru_RU")
+    fake.seed_instance(seed)
+    authors = set()
+    while len(authors) < AUTHORS_COUNT:
+        name = fake.name()
+        if validators.SCHEMA["authors"].fullmatch(name):
+            authors.add(name)
+    # Весь словарь слов Faker для ru_RU (около 500 слов)
+    words = {word for word in fake.get_words_list() if word.isalpha() and len(word) <= MAX_WORD_LENGTH}
+    return sorted(authors), sorted(words)
+
+
+@functools.lru_cache(maxsize=1)
+def date_texts(first_day: int, last_day: int) -> List[str]:
+    """Даты DD-MM-YYYY всех дней от first_day до last_day (порядковые номера), один раз за запуск"""
+    return [date.fromordinal(day).strftime("%d-%m-%Y") for day in range(first_day, last_day + 1)]
+
+
+def join_runs(items: list, lengths: list, separator: str) -> List[str]:
+    """Разбиение items на отрезки длины lengths, каждый склеивается через separator"""
+    result = []
+    position = 0
+    for length in lengths:
+        result.append(separator.join(items[position:position + length]))
+        position += length
+    return result
+
+
+def unique_runs(pool: list, lengths: list, rng: random.Random) -> List[str]:
+    """Списки без повторов из pool через запятую (авторы, жанры)"""
+    items = rng.choices(pool, k=sum(lengths))
+    result = []
+    position = 0
+    for length in lengths:
+        result.append(",".join(dict.fromkeys(items[position:position + length])))
+        position += length
+    return result
+
+
+def generate_batch(rng: random.Random, authors: list, words: list, count: int) -> List[dict]:
+    """
+    count книг. Случайные значения выбираются для всего пакета сразу (choices с k=count),
+    а книги собираются из готовых строк; даты выбираются в допустимых границах
+    """
+    today = date.today()
+    years = rng.choices(range(validators.MIN_YEAR, today.year + 1), k=count)
+    name_lengths = rng.choices(range(1, 6), k=count)
+    names = join_runs(rng.choices(words, k=sum(name_lengths)), name_lengths, " ")
+    comment_lengths = rng.choices(range(3, 11), k=count)
+    comments = join_runs(rng.choices(words, k=sum(comment_lengths)), comment_lengths, " ")
+    book_authors = unique_runs(authors, rng.choices(range(1, 4), k=count), rng)
+    book_genres = unique_runs(db.genres_list, rng.choices(range(1, 5), k=count), rng)
+    widths = rng.choices(SIZES, k=count)
+    heights = rng.choices(SIZES, k=count)
+    book_types = rng.choices(["мягкий", "твердый"], k=count)
+    sources = rng.choices(["покупка", "подарок", "наследство"], k=count)
+    scores = rng.choices(range(1, 11), k=count)
+    fractions = [rng.random() for _ in range(2 * count)]
+    first_year_day = date(validators.MIN_YEAR, 1, 1).toordinal()
+    last_day = today.toordinal()
+    dates = date_texts(first_year_day, last_day)
+    books = []
+    for i in range(count):
+        first_day = date(years[i], 1, 1).toordinal()
+        added = first_day + int(fractions[2 * i] * (last_day - first_day + 1))
+        read = added + int(fractions[2 * i + 1] * (last_day - added + 1))
+        books.append({
+            "name": names[i].capitalize(),
+            "authors": book_authors[i],
+            "genres": book_genres[i],
+            "year": str(years[i]),
+            "width": widths[i],
+            "height": heights[i],
+            "book_type": book_types[i],
+            "source": sources[i],
+            "date_added": dates[added - first_year_day],
+            "date_read": dates[read - first_year_day],
+            "rating": f"{scores[i]}/10 - {comments[i].capitalize()}.",
+        })
+    return books
+
+
+def iter_batches(count: int, seed: int, batch_size: int = BATCH_SIZE):
+    """
+    Пакеты книг без дубликатов по ключу уникальности базы, всего count книг.
+    Пакеты генерируются целиком, поэтому при том же зерне меньшая библиотека -
+    начало большей
+    """
+    rng = random.Random(seed)
+    authors, words = build_vocabulary(seed)
+    keys = set()
+    left = count
+    while left > 0:
+        batch = []
+        for book in generate_batch(rng, authors, words, batch_size):
+            key = db.unique_key(book)
+            if key not in keys:
+                keys.add(key)
+                batch.append(book)
+        batch = batch[:left]
+        left -= len(batch)
+        yield batch
+
+
+def check_batch(books: List[dict]) -> None:
+    errors = validators.validate_books(books)
+    if errors:
+        number, error = next(iter(errors.items()))
+        raise ValueError(f"Книга {books[number]} не прошла проверку: {error}")
+
+
+def write_database(path: Path, count: int, seed: int, check: bool) -> None:
+    """Файл базы целиком: заголовок и записи с id от 1 подряд"""
+    with path.open("wb") as file:
+        file.write(db.make_header(count + 1))
+        book_id = 1
+        for batch in iter_batches(count, seed):
+            if check:
+                check_batch(batch)
+            records = []
+            for book in batch:
+                book["id"] = book_id
+                records.append(db.dict_to_record(book))
+                book_id += 1
+            file.write(b"".join(records))
+    # Снимок индексов, журнал и состояние реплики относятся к прежнему содержимому файла
+    for suffix in (".idx", ".wal", ".replica"):
+        Path(f"{path}{suffix}").unlink(missing_ok=True)
+    # LSN нового журнала начинается с нуля: старые снимки с большим LSN вытеснили бы
+    # новые и вернули бы при восстановлении прежнюю библиотеку. Каталог резервных
+    # копий сервер ведет рядом с файлом базы под именем по умолчанию
+    if path.name == db.FILENAME:
+        backup_dir = path.parent / db.BACKUP_DIR
+        for pattern in ("snapshot_*.txt", "wal_*.seg"):
+            for backup in backup_dir.glob(pattern):
+                backup.unlink()
+
+
+def send_to_server(host: str, port: int, count: int, seed: int, check: bool) -> None:
+    """Пакеты отправляются командой BATCH; следующий пакет уходит, пока сервер пишет текущий"""
+    sock, reader = client.connect(host, port)
+    pending = 0
+    try:
+        for batch in iter_batches(count, seed):
+            if check:
+                check_batch(batch)
+            lines = [f"BATCH {len(batch)}"]
+            lines.extend("|".join(str(book[field]) for field in db.HEADERS[1:]) for book in batch)
+            sock.sendall("".join(f"{line}\n" for line in lines).encode())
+            pending += 1
+            if pending > 1:
+                report_reply(client.read_reply(reader))
+                pending -= 1
+        for _ in range(pending):
+            report_reply(client.read_reply(reader))
+        client.request(sock, reader, ["QUIT"])
+    finally:
+        sock.close()
+
+
+def report_reply(reply: tuple) -> None:
+    ok, lines = reply
+    if not ok:
+        raise RuntimeError(f"Ошибка сервера: {lines}")
+    print(lines[0])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--books", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=1)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--output", type=Path, help="файл базы, который будет создан")
+    target.add_argument("--server", help="адрес сервера host:port")
+    parser.add_argument("--force", action="store_true", help="перезаписать существующий файл")
+    parser.add_argument("--check", action="store_true", help="проверять каждую книгу validators")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.output is not None:
+        if args.output.exists() and not args.force:
+            sys.exit(f"Файл {args.output} уже существует, используйте --force")
+        write_database(args.output, args.books, args.seed, args.check)
+        size = f", {os.path.getsize(args.output) / 2 ** 20:.0f} МБ"
+    else:
+        host, _, port = args.server.rpartition(":")
+        send_to_server(host or "127.0.0.1", int(port), args.books, args.seed, args.check)
+        size = ""
+    elapsed = time.perf_counter() - start
+    print(f"Книг: {args.books}{size}, {elapsed:.1f} с ({args.books / elapsed:,.0f} книг/с)")
+
+
+if __name__ == "__main__":
+    main()
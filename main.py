@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import List
+from typing import Dict, Generator, List
 from faker import Faker
 import random
 import logging
@@ -9,10 +9,148 @@ import socket
 import os
 from contextlib import contextmanager
 import shutil
-from datetime import datetime
+from datetime import date, datetime
 import threading
+import asyncio
+import argparse
+from collections import Counter, OrderedDict, deque, namedtuple
+import pickle
+import bisect
+import math
+import itertools
+import functools
+import http.server
+import inspect
+import heapq
+import operator
+import mmap
+import struct
+import zlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+from validators import (
+    SCHEMA,
+    validate_book,
+    validate_books,
+    validate_date_added,
+    validate_date_read,
+    validate_height,
+    validate_regex,
+    validate_width,
+    validate_year,
+)
+
+try:
+    import fcntl
+except ImportError:
+    # Без fcntl (Windows) файл защищен только от потоков своего процесса
+    fcntl = None
 
 FILENAME = "home_library.txt"
+INDEX_FILENAME = f"{FILENAME}.idx"
+WAL_FILENAME = f"{FILENAME}.wal"
+REPLICA_STATE_FILENAME = f"{FILENAME}.replica"
+
+# Формат записи: байт состояния, версия записи, затем поля фиксированной ширины (в байтах UTF-8,
+# кириллица занимает 2 байта на символ), разделенные "|", и перевод строки
+FIELD_WIDTHS = {
+    "id": 10,
+    "name": 200,
+    "year": 4,
+    "authors": 260,
+    "genres": 200,
+    "width": 16,
+    "height": 16,
+    "book_type": 14,
+    "source": 20,
+    "date_added": 10,
+    "date_read": 10,
+    "rating": 408,
+}
+RECORD_ALIVE = b" "
+RECORD_DELETED = b"#"
+# Версия записи растет при каждом обновлении книги. Изменения, подтвержденные в меню
+# после поиска, применяются, только если версия книги с тех пор не изменилась
+VERSION_WIDTH = 10
+VERSION_SLICE = slice(2, 2 + VERSION_WIDTH)
+RECORD_SIZE = 1 + VERSION_WIDTH + 1 + sum(FIELD_WIDTHS.values()) + len(FIELD_WIDTHS) + 1
+HEADER_MAGIC = b"!HOMELIB"
+# 1 - записи без версии, 2 - с версией
+FORMAT_VERSION = 2
+
+# Уплотнение запускается, когда удаленных записей не меньше
+# COMPACTION_MIN_DEAD и не меньше COMPACTION_RATIO от всех записей
+COMPACTION_MIN_DEAD = 100
+COMPACTION_RATIO = 0.25
+COMPACTION_INTERVAL = 60
+
+# Контрольная точка журнала: по таймеру (секунды) или при превышении размера (байты)
+WAL_CHECKPOINT_INTERVAL = 30
+WAL_CHECKPOINT_SIZE = 16 * 1024 * 1024
+
+# Резервные копии: полный снимок раз в BACKUP_INTERVAL секунд, хранится BACKUP_KEEP снимков
+BACKUP_DIR = Path("backups")
+BACKUP_INTERVAL = 3600
+BACKUP_KEEP = 5
+
+# Триграммные индексы для поиска подстроки в текстовых полях.
+# Занимают на порядок больше памяти, чем сама база (около 1 ГБ на 100 тысяч книг),
+# поэтому включаются только флагом --text-indexes
+TEXT_INDEX_FIELDS = ["name", "authors", "genres", "rating"]
+TEXT_INDEXES_ENABLED = False
+
+# Таблица книг в памяти по столбцам (COLUMN TABLE): поиск без чтения файла
+COLUMN_TABLE_ENABLED = False
+
+# Кэш (CACHE): книг по id, результатов поиска и наибольший кэшируемый результат
+BOOK_CACHE_SIZE = 4096
+SEARCH_CACHE_SIZE = 256
+SEARCH_CACHE_MAX_RESULTS = 1000
+
+# Параллельный просмотр файла (поиск без индекса, сводки): число процессов пула
+# (на машине с одним ядром просмотр идет в потоке запроса), наименьшее число записей,
+# начиная с которого запуск в пуле окупается, и наибольший участок одного задания
+SCAN_PROCESSES = os.cpu_count() or 1
+PARALLEL_SCAN_MIN_RECORDS = 200000
+PARALLEL_SCAN_PART_RECORDS = 50000
+
+# Репликация: сколько последних изменений основной сервер держит в памяти для реплик
+# (отставшая сильнее реплика получает файл базы целиком), интервал проверки связи
+# без изменений, время до разрыва молчащего соединения и пауза перед переподключением
+REPLICATION_BACKLOG = 10000
+REPLICATION_HEARTBEAT = 1
+REPLICATION_TIMEOUT = 10
+REPLICATION_RETRY = 2
+
+# Внесение задержек и сбоев для проверки конкуренции за блокировку (по умолчанию выключено):
+# операция -> Fault. Задается флагом --inject ОПЕРАЦИЯ=ЗАДЕРЖКА[:ДОЛЯ_СБОЕВ]
+FAULT_OPERATIONS = ["add_book", "add_books", "modify_books_file", "search_books"]
+Fault = namedtuple("Fault", ["delay", "error_rate"])
+faults = {}
+
+# Верхние границы корзин гистограмм времени операций (секунды)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Сколько секунд ждать блокировку файла, прежде чем ответить "система занята"
+LOCK_TIMEOUT = 30
+
+# Очередь ожидающих подключений сервера
+LISTEN_BACKLOG = 1024
+
+# Наибольшее число книг в одном пакетном добавлении из меню
+MAX_BATCH_SIZE = 100000
+
+# Вывод списков: книг на странице меню и записей в одной порции, отправляемой клиенту
+PAGE_SIZE = 20
+STREAM_CHUNK_RECORDS = 256
+
+# Отсортированные индексы для запросов по диапазону
+RANGE_FIELDS = ["year", "width", "height", "date_added", "date_read"]
+DATE_FIELDS = ["date_added", "date_read"]
+# С какого размера пакета индексы диапазонов досортировываются одним проходом
+# вместо вставки каждой книги (вставка в список - O(n))
+RANGE_INDEX_SORT_BATCH = 100
 
 HEADERS = [
     "id",
@@ -29,20 +167,6 @@ HEADERS = [
     "rating",
 ]
 
-regex_schema = {
-    "name": r"(?!.*([\s])\1)[А-Яа-яЁёA-Za-z0-9\s]{1,100}",
-    "authors": r"(?!.*([\s,])\1)[А-Яа-яЁёA-Za-z\s,]{1,130}",
-    "genres": r"^(?!.*([\s,])\1)[А-Яа-яЁёA-Za-z\s,]{1,100}",
-    "year": r"\d{4}",
-    "width": r"\d+(\.\d+)?",
-    "height": r"\d+(\.\d+)?",
-    "book_type": r"мягкий|твердый",
-    "source": r"покупка|подарок|наследство",
-    "date_added": r"\d{2}-\d{2}-\d{4}",
-    "date_read": r"\d{2}-\d{2}-\d{4}",
-    "rating": r"([1-9]|10)/10 - [А-Яа-яЁёA-Za-z0-9\s\,\.\!\?]{1,200}",
-}
-
 library = """
 
 
@@ -125,31 +249,421 @@ genres_list = [
 ]
 
 
-@contextmanager
-def file_lock(filename, timeout=0.1):
-    lockfile = Path(f"{filename}.lock")
-    thread_name = threading.current_thread().name
-    logging.info(f"[{thread_name}] Пытаюсь захватить блокировку...")
+# FAULT INJECTION
+def inject_fault(operation: str) -> None:
+    """
+    Задержка и сбой операции из faults; вызывается под блокировкой операции.
+    Сбой - TimeoutError, как у занятого файла, поэтому его обрабатывают те же пути
+    """
+    fault = faults.get(operation)
+    if fault is None:
+        return
+    if fault.delay:
+        time.sleep(fault.delay)
+    if fault.error_rate and random.random() < fault.error_rate:
+        raise TimeoutError(f"Внесенный сбой операции {operation}")
+
+
+def parse_fault(text: str) -> tuple:
+    """ОПЕРАЦИЯ=ЗАДЕРЖКА[:ДОЛЯ_СБОЕВ] -> (операция, Fault)"""
+    operation, _, spec = text.partition("=")
+    delay, _, error_rate = spec.partition(":")
+    if operation not in FAULT_OPERATIONS:
+        raise argparse.ArgumentTypeError(
+            f"Неизвестная операция {operation}, доступны: {', '.join(FAULT_OPERATIONS)}"
+        )
+    try:
+        fault = Fault(float(delay or 0), float(error_rate or 0))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Ожидается {operation}=ЗАДЕРЖКА[:ДОЛЯ_СБОЕВ]")
+    if fault.delay < 0 or not 0 <= fault.error_rate <= 1:
+        raise argparse.ArgumentTypeError("Задержка неотрицательна, доля сбоев - от 0 до 1")
+    return operation, fault
+
+
+# METRICS
+# Учет операций: вызовы, ошибки, гистограмма времени, прочитанные записи, байты
+# и ожидание блокировок. Счетчики ввода-вывода относятся к самой внутренней
+# выполняемой операции потока (стек в metrics_context)
+class Histogram:
+    """Гистограмма по корзинам с верхними границами buckets, как histogram в Prometheus"""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    def quantile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает квантиль q"""
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            if count and cumulative >= rank:
+                return bound
+        return 0.0
+
+
+class OperationStats:
+    def __init__(self):
+        self.errors = 0
+        self.latency = Histogram()
+        self.rows = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.lock_wait = 0.0
+
+
+metrics = {}
+metrics_lock = threading.Lock()
+metrics_context = threading.local()
+
+
+def operation_stats(operation: str) -> OperationStats:
+    with metrics_lock:
+        if operation not in metrics:
+            metrics[operation] = OperationStats()
+        return metrics[operation]
+
+
+def operation_stack() -> list:
+    if not hasattr(metrics_context, "stack"):
+        metrics_context.stack = []
+    return metrics_context.stack
+
+
+def count_io(rows: int = 0, bytes_read: int = 0, bytes_written: int = 0, lock_wait: float = 0.0) -> None:
+    """Ввод-вывод и ожидание блокировки текущей операции потока (вне операций - "other")"""
+    stack = operation_stack()
+    stats = stack[-1] if stack else operation_stats("other")
+    with metrics_lock:
+        stats.rows += rows
+        stats.bytes_read += bytes_read
+        stats.bytes_written += bytes_written
+        stats.lock_wait += lock_wait
+
+
+def observe(stats: OperationStats, seconds: float, failed: bool) -> None:
+    with metrics_lock:
+        stats.latency.observe(seconds)
+        if failed:
+            stats.errors += 1
+
+
+def measured_generator(stats: OperationStats, generator: Generator) -> Generator:
+    """
+    Генератор под учетом: время считается только внутри него, без ожидания потребителя
+    (например, отправки порций медленному клиенту)
+    """
+    elapsed = 0.0
+    failed = True
+    try:
+        while True:
+            # В асинхронном режиме шаги выполняются в разных потоках пула
+            stack = operation_stack()
+            stack.append(stats)
+            start = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                failed = False
+                return
+            finally:
+                elapsed += time.perf_counter() - start
+                stack.pop()
+            yield item
+    except GeneratorExit:
+        failed = False
+        raise
+    finally:
+        generator.close()
+        observe(stats, elapsed, failed)
+
+
+def instrumented(operation: str):
+    """
+    Учет вызовов функции как операции operation. Ошибка - исключение или ответ
+    "Ошибка: ..."; у генератора учитывается время выполнения до его исчерпания
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            stats = operation_stats(operation)
+            if inspect.isgeneratorfunction(function):
+                return measured_generator(stats, function(*args, **kwargs))
+            stack = operation_stack()
+            stack.append(stats)
+            start = time.perf_counter()
+            failed = True
+            try:
+                result = function(*args, **kwargs)
+                failed = isinstance(result, str) and is_error(result)
+                return result
+            finally:
+                stack.pop()
+                observe(stats, time.perf_counter() - start, failed)
+        return wrapper
+    return decorator
+
+
+def stats_report() -> List[str]:
+    """Сводка по операциям (команда протокола STATS)"""
+    lines = []
+    with metrics_lock:
+        for operation, stats in sorted(metrics.items()):
+            count = stats.latency.count
+            average = stats.latency.total / count if count else 0.0
+            lines.append(
+                f"{operation}: вызовов {count}, ошибок {stats.errors}, "
+                f"время среднее {average * 1000:.2f} мс, p50 <= {stats.latency.quantile(0.5) * 1000:g} мс, "
+                f"p99 <= {stats.latency.quantile(0.99) * 1000:g} мс, записей прочитано {stats.rows}, "
+                f"байт прочитано {stats.bytes_read}, записано {stats.bytes_written}, "
+                f"ожидание блокировок {stats.lock_wait * 1000:.2f} мс"
+            )
+    return lines
+
+
+def prometheus_text() -> str:
+    """Метрики в текстовом формате Prometheus"""
+    lines = [
+        "# HELP homelib_operation_duration_seconds Время выполнения операции "
+        "(для file_lock - ожидание блокировки)",
+        "# TYPE homelib_operation_duration_seconds histogram",
+    ]
+    counters = [
+        ("errors_total", "Операции, завершившиеся ошибкой", lambda stats: stats.errors),
+        ("rows_scanned_total", "Прочитанные записи файла базы", lambda stats: stats.rows),
+        ("read_bytes_total", "Байты, прочитанные из файла базы", lambda stats: stats.bytes_read),
+        ("written_bytes_total", "Байты, записанные в файл базы и журнал", lambda stats: stats.bytes_written),
+        ("lock_wait_seconds_total", "Ожидание блокировок файла", lambda stats: stats.lock_wait),
+    ]
+    with metrics_lock:
+        items = sorted(metrics.items())
+        for operation, stats in items:
+            label = f'operation="{operation}"'
+            cumulative = 0
+            for bound, count in zip(stats.latency.buckets + (math.inf,), stats.latency.counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else repr(bound)
+                lines.append(f'homelib_operation_duration_seconds_bucket{{{label},le="{le}"}} {cumulative}')
+            lines.append(f"homelib_operation_duration_seconds_sum{{{label}}} {stats.latency.total}")
+            lines.append(f"homelib_operation_duration_seconds_count{{{label}}} {cumulative}")
+        for name, help_text, value in counters:
+            lines.append(f"# HELP homelib_operation_{name} {help_text}")
+            lines.append(f"# TYPE homelib_operation_{name} counter")
+            for operation, stats in items:
+                lines.append(f'homelib_operation_{name}{{operation="{operation}"}} {value(stats)}')
+    lines += [
+        "# HELP homelib_books Книги в базе",
+        "# TYPE homelib_books gauge",
+        f"homelib_books {len(id_index)}",
+    ]
+    return "\n".join(lines) + "\n"
+
 
-    start_time = time.time()
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> None:
+    """Порт метрик: GET /metrics в формате Prometheus, в отдельном потоке"""
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Метрики: http://{host}:{port}/metrics")
+
+
+# LOCKS
+class ReadWriteLock:
+    """
+    Блокировка читателей-писателей внутри процесса.
+    Писатели обслуживаются по очереди в порядке прихода; пока в очереди есть писатель,
+    новые читатели ждут, поэтому поток чтений не может бесконечно задерживать запись
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = deque()
+
+    def acquire(self, shared: bool, timeout: float = None) -> bool:
+        with self._condition:
+            if shared:
+                acquired = self._condition.wait_for(
+                    lambda: not self._writer and not self._waiting_writers, timeout
+                )
+                if acquired:
+                    self._readers += 1
+                return acquired
+
+            ticket = object()
+            self._waiting_writers.append(ticket)
+            acquired = self._condition.wait_for(
+                lambda: (
+                    self._waiting_writers[0] is ticket
+                    and not self._writer
+                    and self._readers == 0
+                ),
+                timeout,
+            )
+            self._waiting_writers.remove(ticket)
+            if acquired:
+                self._writer = True
+            else:
+                self._condition.notify_all()
+            return acquired
+
+    def release(self, shared: bool) -> None:
+        with self._condition:
+            if shared:
+                self._readers -= 1
+            else:
+                self._writer = False
+            self._condition.notify_all()
+
+
+rw_locks = {}
+rw_locks_guard = threading.Lock()
+# Время ожидания блокировок: режим -> счетчики
+lock_stats = {
+    mode: {"acquired": 0, "timeouts": 0, "wait_total": 0.0, "wait_max": 0.0}
+    for mode in ("shared", "exclusive")
+}
+
+
+def get_rw_lock(filename) -> ReadWriteLock:
+    key = str(filename)
+    with rw_locks_guard:
+        if key not in rw_locks:
+            rw_locks[key] = ReadWriteLock()
+        return rw_locks[key]
+
+
+def record_lock_wait(shared: bool, wait: float, acquired: bool) -> None:
+    observe(operation_stats("file_lock"), wait, not acquired)
+    count_io(lock_wait=wait)
+    with rw_locks_guard:
+        stats = lock_stats["shared" if shared else "exclusive"]
+        if acquired:
+            stats["acquired"] += 1
+            stats["wait_total"] += wait
+            stats["wait_max"] = max(stats["wait_max"], wait)
+        else:
+            stats["timeouts"] += 1
+
+
+def lock_report() -> List[str]:
+    """Сводка ожидания блокировок по режимам"""
+    lines = []
+    with rw_locks_guard:
+        for mode, stats in lock_stats.items():
+            average = stats["wait_total"] / stats["acquired"] if stats["acquired"] else 0.0
+            lines.append(
+                f"{mode}: захватов {stats['acquired']}, таймаутов {stats['timeouts']}, "
+                f"ожидание среднее {average * 1000:.2f} мс, максимальное {stats['wait_max'] * 1000:.2f} мс"
+            )
+    return lines
+
+
+def flock_with_timeout(fd: int, shared: bool, deadline: float) -> bool:
+    """Межпроцессная блокировка через flock; ждет с нарастающим интервалом до deadline"""
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    delay = 0.001
     while True:
         try:
-            lockfile.touch(exist_ok=False)
-            logging.info(f"[{thread_name}] ✅ Захватил блокировку!")
-            break
-        except FileExistsError:
-            if time.time() - start_time > timeout:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if time.monotonic() + delay > deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+
+def acquire_file_lock(filename, shared: bool, timeout: float, deadline: float):
+    """Захват ReadWriteLock и flock до deadline; возвращает дескриптор файла блокировки"""
+    thread_name = threading.current_thread().name
+    rw_lock = get_rw_lock(filename)
+    start_time = time.monotonic()
+
+    if not rw_lock.acquire(shared, max(deadline - start_time, 0)):
+        record_lock_wait(shared, time.monotonic() - start_time, False)
+        logging.error(f"[{thread_name}] ❌ Не успел за {timeout} сек!")
+        raise TimeoutError("Не удалось захватить блокировку")
+
+    lock_fd = None
+    try:
+        if fcntl is not None:
+            lock_fd = os.open(f"{filename}.lock", os.O_RDWR | os.O_CREAT)
+            if not flock_with_timeout(lock_fd, shared, deadline):
+                record_lock_wait(shared, time.monotonic() - start_time, False)
                 logging.error(f"[{thread_name}] ❌ Не успел за {timeout} сек!")
                 raise TimeoutError("Не удалось захватить блокировку")
-            time.sleep(0.01)
+    except BaseException:
+        release_file_lock(filename, shared, lock_fd)
+        raise
+    record_lock_wait(shared, time.monotonic() - start_time, True)
+    logging.debug(f"[{thread_name}] ✅ Захватил блокировку ({'чтение' if shared else 'запись'})")
+    return lock_fd
+
 
+def release_file_lock(filename, shared: bool, lock_fd) -> None:
+    if lock_fd is not None:
+        os.close(lock_fd)
+    get_rw_lock(filename).release(shared)
+    logging.debug(f"[{threading.current_thread().name}] 🔓 Освободил блокировку")
+
+
+@contextmanager
+def file_lock(filename, timeout=LOCK_TIMEOUT, shared=False):
+    """
+    Блокировка файла базы: shared=True - для чтения (читателей может быть много),
+    shared=False - для записи. Внутри процесса работает ReadWriteLock,
+    между процессами - flock на файле {filename}.lock.
+    Если файл базы изменил другой процесс, индексы перечитываются до входа в блок:
+    под монопольной блокировкой сразу, читатель для этого ненадолго берет монопольную
+    """
+    deadline = time.monotonic() + timeout
+    is_database = str(filename) == FILENAME
+    lock_fd = acquire_file_lock(filename, shared, timeout, deadline)
+    held = True
     try:
+        if is_database and not shared:
+            reload_changed_file()
+        while is_database and shared and file_changed_elsewhere():
+            held = False
+            release_file_lock(filename, shared, lock_fd)
+            with file_lock(filename, deadline - time.monotonic()):
+                pass
+            lock_fd = acquire_file_lock(filename, shared, timeout, deadline)
+            held = True
         yield
     finally:
-        lockfile.unlink()
-        logging.info(f"[{thread_name}] 🔓 Освободил блокировку")
+        if held:
+            release_file_lock(filename, shared, lock_fd)
 
 
+@instrumented("create_backup")
 def create_backup():
     backup_dir = Path("backups")
     backup_dir.mkdir(exist_ok=True)
@@ -160,73 +674,11 @@ def create_backup():
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     backup_file = backup_dir / f"library_backup_{timestamp}.txt"
     shutil.copy2(FILENAME, backup_file)
+    size = backup_file.stat().st_size
+    count_io(bytes_read=size, bytes_written=size)
     logging.info(f"Создана резервная копия: {backup_file}")
 
 
-def recover_from_backup():
-    backup_dir = Path("backups")
-    if not backup_dir.exists():
-        return False
-    
-    backups = sorted(backup_dir.glob("library_backup_*.txt"), key=os.path.getmtime)
-    if backups:
-        latest_backup = backups[-1]
-        shutil.copy2(latest_backup, FILENAME)
-        logging.info(f"Восстановлено из резервной копии: {latest_backup}")
-        return True
-    return False
-
-
-def validate_regex(field: str, value) -> None:
-    if not re.fullmatch(regex_schema[field], str(value)):
-        raise ValueError(
-            f"Значение {value} не соответствует регулярному выражению {regex_schema[field]}"
-        )
-
-
-def validate_year(year) -> None:
-    validate_regex("year", year)
-    if int(year) > datetime.now().year:
-        raise ValueError("Год издания не может быть больше текущего года")
-    if int(year) < 1500:
-        raise ValueError("Год издания не может меньше 1500")
-
-
-
-def validate_width(width) -> None:
-    validate_regex("width", width)
-    if float(width) > 1000:
-        raise ValueError("Ширина книги не может быть больше 1 метра")
-    elif float(width) <= 0:
-        raise ValueError("Ширина книги не может быть отрицательной или равна 0")
-
-
-def validate_height(height) -> None:
-    validate_regex("height", height)
-    if float(height) > 1000:
-        raise ValueError("Высота книги не может быть больше 1 метра")
-    elif float(height) <= 0:
-        raise ValueError("Высота книги не может быть отрицательной или равна 0")
-
-
-def validate_date_added(date_added, year) -> None:
-    validate_regex("date_added", date_added)
-    date_added_datetime = datetime.strptime(date_added, "%d-%m-%Y")
-    if date_added_datetime >= datetime.now():
-        raise ValueError("Дата добавления не может быть позже текущей даты")
-    if date_added_datetime.year < int(year):
-        raise ValueError("Год добавления не может быть раньше года издания")
-
-
-def validate_date_read(date_read, date_added) -> None:
-    validate_regex("date_read", date_read)
-    if date_read:
-        date_added_datetime = datetime.strptime(date_added, "%d-%m-%Y")
-        date_read_datetime = datetime.strptime(date_read, "%d-%m-%Y")
-        if date_read_datetime < date_added_datetime:
-            raise ValueError("Дата чтения не может быть раньше даты добавления")
-
-
 def dict_to_line(book: dict) -> str:
     return "|".join(str(book[header]) for header in HEADERS)
 
@@ -249,304 +701,2709 @@ def line_to_dict(line: str) -> dict:
     }
 
 
-def authors_set():
-    authors = set()
-    while len(authors) < 100:
-        authors.add(fake.name())
-    return authors
+# RECORDS
+def field_slices() -> dict:
+    """Положение каждого поля внутри записи: после байта состояния, версии и разделителей"""
+    slices = {}
+    position = VERSION_SLICE.stop + 1
+    for header in HEADERS:
+        slices[header] = slice(position, position + FIELD_WIDTHS[header])
+        position += FIELD_WIDTHS[header] + 1
+    return slices
 
 
-# SINGLE BOOK
-def generate_valid_book(authors_list, genres_list) -> dict:
-    name = fake.sentence(nb_words=random.randint(1, 5)).rstrip(".")
-    authors = ",".join(random.sample(authors_list, k=random.randint(1, 3)))
-    genres = ",".join(random.sample(genres_list, k=random.randint(1, 4)))
-    year = str(random.randint(1500, 2025))
-    width = round(random.uniform(10.0, 200.0), 1)
-    height = round(random.uniform(10.0, 200.0), 1)
-    book_type = random.choice(["мягкий", "твердый"])
-    source = random.choice(["покупка", "подарок", "наследство"])
-    # date_added
-    start_date = datetime(int(year), 1, 1)
-    date_added = str(
-        fake.date_between(start_date=start_date, end_date="today").strftime("%d-%m-%Y")
-    )
-    while True:
-        try:
-            validate_date_added(date_added, year)
-            break
-        except ValueError:
-            date_added = str(
-                fake.date_between(start_date=start_date, end_date="today").strftime(
-                    "%d-%m-%Y"
-                )
-            )
-    # date_read
-    date_added_dt = datetime.strptime(date_added, "%d-%m-%Y")
-    date_read = str(
-        fake.date_between(start_date=date_added_dt, end_date="today").strftime(
-            "%d-%m-%Y"
-        )
-    )
-    while True:
-        try:
-            validate_date_read(date_read, date_added)
-            break
-        except ValueError:
-            date_read = str(
-                fake.date_between(start_date=date_added_dt, end_date="today").strftime(
-                    "%d-%m-%Y"
-                )
-            )
-    # rating
-    rating_value = random.randint(1, 10)
-    description = fake.sentence(nb_words=random.randint(3, 10), variable_nb_words=True)
-    rating = f"{rating_value}/10 - {description}"
-    return {
-        "name": name,
-        "authors": authors,
-        "genres": genres,
-        "year": year,
-        "width": width,
-        "height": height,
-        "book_type": book_type,
-        "source": source,
-        "date_added": date_added,
-        "date_read": date_read,
-        "rating": rating,
-    }
+FIELD_SLICES = field_slices()
 
 
-def get_next_id() -> int:
-    """Генерация ID"""
-    if not Path(FILENAME).exists():
-        return 1
+def dict_to_record(book: dict, flag: bytes = RECORD_ALIVE) -> bytes:
+    """Запись фиксированной длины: байт состояния, версия и дополненные пробелами поля"""
+    fields = [str(book.get("version", 1)).encode().ljust(VERSION_WIDTH)]
+    for header in HEADERS:
+        value = str(book[header]).encode()
+        if len(value) > FIELD_WIDTHS[header]:
+            raise ValueError(
+                f"Значение поля {header} длиннее {FIELD_WIDTHS[header]} байт"
+            )
+        fields.append(value.ljust(FIELD_WIDTHS[header]))
+    return flag + b"|" + b"|".join(fields) + b"\n"
 
-    with open(FILENAME, "r", encoding="utf-8") as file:
-        lines = file.readlines()
-        if lines:
-            last_book = line_to_dict(lines[-1])
-            id = int(last_book["id"]) + 1
-            return id
-    return 1
 
+def record_to_dict(record: bytes) -> dict:
+    book = {
+        header: record[field_slice].rstrip(b" ").decode()
+        for header, field_slice in FIELD_SLICES.items()
+    }
+    book["version"] = int(record[VERSION_SLICE])
+    return book
 
-def is_unique_book(book: dict) -> bool:
-    """Проверка на уникальность книги"""
-    original_filename = Path(FILENAME)
-    with original_filename.open("r") as file:
-        for line in file:
-            existing_book = line_to_dict(line)
-            if (
-                existing_book["name"] == book["name"]
-                and existing_book["authors"] == book["authors"]
-                and existing_book["year"] == book["year"]
-                and existing_book["genres"] == book["genres"]
-            ):
-                return False
-    return True
 
+def record_id(record: bytes) -> int:
+    return int(record[FIELD_SLICES["id"]])
 
-def add_book(book: dict):
-    """ Операция добавление книги - добавление ID + проверка на уникальность"""
-    create_backup()
-    book_id = get_next_id()
-    book["id"] = book_id
-    try:
-        with file_lock(FILENAME):
-            if is_unique_book(book):
-                with open(FILENAME, ("a")) as file:
-                    time.sleep(0.3)
-                    file.write(dict_to_line(book) + "\n")
-                res = f"Добавлена книга: {book['name']} (ID: {book_id})"
-                return res
-            else:
-                res = f"Книга уже добавлена: {book['name']}, написанная {book['authors']}"
-                return res
-    except TimeoutError:
-        return "Ошибка: не удалось выполнить обновление - система занята, попробуйте позже"
 
+def is_deleted(record: bytes) -> bool:
+    return record[:1] == RECORD_DELETED
 
-# MULTIPLE BOOKS
-def modify_books_file(new_books: List[dict] = None, update=False) -> str:
+
+def make_header(next_id: int = 1, changes: int = 0) -> bytes:
     """
-    Редактируем файл базы данных для операций удаления и редактирования
-    Функция обеспечивает атомарность операций - изменения либо применяются полностью, либо не применяются вообще.
+    Служебная запись в нулевом слоте файла: версия формата, следующий свободный id
+    и счетчик изменений, по которому процессы узнают о чужих записях
     """
-    res = ""
-    temp_filename = Path("temp.txt")
-    found = False
-    original_filename = Path(FILENAME)
+    header = b"|".join(
+        [HEADER_MAGIC, str(FORMAT_VERSION).encode(), str(next_id).encode(), str(changes).encode()]
+    )
+    return (header + b"|").ljust(RECORD_SIZE - 1) + b"\n"
+
+
+def read_header(file) -> dict:
+    file.seek(0)
+    # Заголовок - первая строка файла: в формате 1 записи короче RECORD_SIZE
+    parts = file.read(RECORD_SIZE).split(b"\n")[0].split(b"|")
+    return {
+        "version": int(parts[1]),
+        # В заголовках, записанных до появления счетчиков, полей next_id и changes нет
+        "next_id": int(parts[2]) if len(parts) > 3 else None,
+        "changes": int(parts[3]) if len(parts) > 4 else 0,
+    }
+
+
+def iter_records(file, chunk_records: int = 1024, start: int = RECORD_SIZE):
+    """Последовательное чтение записей (без заголовка): пары (смещение, запись)"""
+    offset = file.seek(start)
+    # В метрики попадают только отданные записи: остаток порции, прочитанной вперед,
+    # при раннем выходе (поиск страницы, первая найденная книга) не считается
+    rows = 0
     try:
-        with file_lock(original_filename):
-            with original_filename.open("r") as file, temp_filename.open("w") as temp_file:
-                time.sleep(0.3)
-                for line in file:
-                    book = line_to_dict(line)
-                    # Проверяем, есть ли книга в списке для обновления
-                    for new_book in new_books:
-                        if book["id"] == new_book["id"]:
-                            found = True
-
-                            # Обновляем поля книги
-                            if update:
-                                book.update(new_book)
-                                temp_file.write(dict_to_line(book) + "\n")
-                                res += (
-                                    f"Обновлена книга: {book['name']} (ID: {book['id']})\n"
-                                )
-                                break
-                            else:
-                                res += f"Удалена книга: {book['name']} (ID: {book['id']})\n"
-                                break
-                    else:
-                        temp_file.write(line)
+        while True:
+            chunk = file.read(RECORD_SIZE * chunk_records)
+            if len(chunk) < RECORD_SIZE:
+                break
+            for start in range(0, len(chunk) - RECORD_SIZE + 1, RECORD_SIZE):
+                rows += 1
+                yield offset + start, chunk[start:start + RECORD_SIZE]
+            offset += len(chunk)
+            count_io(rows=rows, bytes_read=rows * RECORD_SIZE)
+            rows = 0
+    finally:
+        count_io(rows=rows, bytes_read=rows * RECORD_SIZE)
 
-            if found:
-                original_filename.unlink()
-                temp_filename.rename(original_filename)
-            else:
-                temp_filename.unlink()
 
-        return res
-    except TimeoutError:
-        return "Ошибка: не удалось выполнить обновление - система занята, попробуйте позже"
+def iter_books(file):
+    """Живые (не удаленные) книги файла"""
+    for _, record in iter_records(file):
+        if not is_deleted(record):
+            yield record_to_dict(record)
 
 
-def update_books(client_socket, field: str, value: str, new_field, new_value) -> str:
-    """ Обновление поля в строке"""
-    books = search_books(field, value)
-    for book in books:
-        book[new_field] = new_value
-    results = "Обновленные книги:\n"
-    results += print_books(books)
-    if not books:
-        return ""
-    client_socket.send(str(results).encode())
+def find_record_after(file, book_id: int) -> int:
+    """
+    Смещение первой записи с id больше book_id. Записи в файле упорядочены по id:
+    новые дописываются в конец, а уплотнение сохраняет порядок
+    """
+    lo, hi = 1, file.seek(0, os.SEEK_END) // RECORD_SIZE
+    while lo < hi:
+        middle = (lo + hi) // 2
+        file.seek(middle * RECORD_SIZE)
+        if record_id(file.read(RECORD_SIZE)) <= book_id:
+            lo = middle + 1
+        else:
+            hi = middle
+    return lo * RECORD_SIZE
 
 
-    client_socket.send("Обновить? (д/н): ".encode())
-    choice = client_socket.recv(1024).decode().strip().lower()
-    while choice not in ("д", "н", "y", "n"):
-        client_socket.send("Некорректный ввод\n".encode())
-        client_socket.send("Обновить? (д/н): ".encode())
-        choice = client_socket.recv(1024).decode().strip().lower()
-    if choice == "д" or choice == "y":
-        return modify_books_file(books, True)
-    return ""
+def read_book_at(file, offset: int):
+    """Чтение книги по смещению; None, если запись удалена или отсутствует"""
+    file.seek(offset)
+    record = file.read(RECORD_SIZE)
+    count_io(rows=1, bytes_read=len(record))
+    if len(record) < RECORD_SIZE or is_deleted(record):
+        return None
+    return record_to_dict(record)
+
 
+# Пул процессов для параллельного просмотра, создается при первом большом просмотре
+scan_pool = None
+scan_pool_lock = threading.Lock()
 
-def delete_books(client_socket, field: str, value: str) -> str:
+
+def scan_partitions(file):
     """
-    Проходит по файлу, ищет в поле field совпадения с value.
-    Если находит, то записывает все строки до нее и после нее в файл temp.txt,
-    затем удаляет файл home_library.txt и переименовывает temp.txt в home_library.txt.
+    Участки файла (начало, конец) для параллельного просмотра - не меньше, чем процессов
+    пула, и не больше PARALLEL_SCAN_PART_RECORDS записей - или None, если файл небольшой
+    или пул отключен
     """
-    books = search_books(field, value)
-    results = "Найденные книги:\n"
-    results += print_books(books)
-    client_socket.send(str(results).encode())
-    if not books:
-        return ""
-    client_socket.send("Удалить? (д/н): \n".encode())
-    choice = client_socket.recv(1024).decode().strip().lower()
-    while choice not in ("д", "н", "y", "n"):
-        client_socket.send("Некорректный ввод\n".encode())
-        client_socket.send("Удалить? (д/н): ".encode())
-        choice = client_socket.recv(1024).decode().strip().lower()
-    if choice == "д" or choice == "y":
-        return modify_books_file(books)
-    return ""
+    size = os.fstat(file.fileno()).st_size
+    records = size // RECORD_SIZE - 1
+    if SCAN_PROCESSES <= 1 or records < PARALLEL_SCAN_MIN_RECORDS:
+        return None
+    per_part = min(-(-records // SCAN_PROCESSES), PARALLEL_SCAN_PART_RECORDS) * RECORD_SIZE
+    last_record = (records + 1) * RECORD_SIZE
+    return [
+        (start, min(start + per_part, last_record))
+        for start in range(RECORD_SIZE, last_record, per_part)
+    ]
 
 
-def print_all_books():
-    """ Вывести книги"""
-    original_filename = Path(FILENAME)
-    res = ""
-    with original_filename.open("r") as file:
-        for line in file:
-            book = line_to_dict(line)
-            res += (
-                f"ID: {book['id']},\n"
-                f"\tНазвание: {book['name']},\n"
-                f"\tАвторы: {book['authors']},\n"
-                f"\tГод: {book['year']},\n"
-                f"\tЖанры: {book['genres']},\n"
-                f"\tШирина: {book['width']},\n"
-                f"\tВысота: {book['height']},\n"
-                f"\tТип книги: {book['book_type']},\n"
-                f"\tИсточник: {book['source']},\n"
-                f"\tДата добавления: {book['date_added']},\n"
-                f"\tДата прочтения: {book['date_read']},\n"
-                f"\tРейтинг: {book['rating']}\n"
+def get_scan_pool() -> ProcessPoolExecutor:
+    global scan_pool
+    with scan_pool_lock:
+        if scan_pool is None:
+            # spawn, а не fork: сервер многопоточный, и копия его блокировок в дочернем
+            # процессе могла бы остаться захваченной навсегда
+            scan_pool = ProcessPoolExecutor(
+                SCAN_PROCESSES, mp_context=multiprocessing.get_context("spawn")
             )
-    return res
+        return scan_pool
 
 
-def print_books(books: List[dict]) -> str:
-    """ Вывести книгу"""
-    if not books:
-        res = "Нет книг для отображения.\n"
-        return res
-    res = ""
-    res += f"Отображено {len(books)} книг(и):\n"
-    for book in books:
-        try:
-            res += (
-                f"ID: {book['id']},\n"
-                + f"\tНазвание: {book['name']},\n"
-                + f"\tАвторы: {book['authors']},\n"
-                + f"\tГод: {book['year']},\n"
-                + f"\tЖанры: {book['genres']},\n"
-                + f"\tШирина: {book['width']},\n"
-                + f"\tВысота: {book['height']},\n"
-                + f"\tТип книги: {book['book_type']},\n"
-                + f"\tИсточник: {book['source']},\n"
-                + f"\tДата добавления: {book['date_added']},\n"
-                + f"\tДата прочтения: {book['date_read']},\n"
-                + f"\tРейтинг: {book['rating']}\n"
-            )
-        except KeyError:
-            res += (f"\tНазвание: {book['name']},\n"
-                + f"\tАвторы: {book['authors']},\n"
-                + f"\tГод: {book['year']},\n"
-                + f"\tЖанры: {book['genres']},\n"
-                + f"\tШирина: {book['width']},\n"
-                + f"\tВысота: {book['height']},\n"
-                + f"\tТип книги: {book['book_type']},\n"
-                + f"\tИсточник: {book['source']},\n"
-                + f"\tДата добавления: {book['date_added']},\n"
-                + f"\tДата прочтения: {book['date_read']},\n"
-                + f"\tРейтинг: {book['rating']}\n"
-            )
+def parallel_scan(file, parts: list, function, *args) -> Generator:
+    """
+    Результаты function(путь, начало, конец, *args) для участков parts в порядке участков.
+    В работе одновременно не больше SCAN_PROCESSES участков, поэтому если потребитель
+    остановился (набрал нужное число книг), остальные участки не просматриваются.
+    Вызывается под блокировкой: процессы пула читают файл, пока она удерживается
+    """
+    path = os.path.abspath(file.name)
+    pool = get_scan_pool()
+    parts = iter(parts)
+    futures = deque(
+        pool.submit(function, path, start, stop, *args)
+        for start, stop in itertools.islice(parts, SCAN_PROCESSES)
+    )
+    try:
+        while futures:
+            result = futures.popleft().result()
+            for start, stop in itertools.islice(parts, 1):
+                futures.append(pool.submit(function, path, start, stop, *args))
+            yield result
+    finally:
+        for future in futures:
+            future.cancel()
 
-    return res
+
+def scan_range(mapped, field: str, value: str, first: int, last: int, chunk_records: int = 8192):
+    """Смещения живых записей участка [first, last) отображенного файла, в поле field которых есть value"""
+    field_slice = FIELD_SLICES[field]
+    field_struct = struct.Struct(
+        f"{field_slice.start}x{field_slice.stop - field_slice.start}s{RECORD_SIZE - field_slice.stop}x"
+    )
+    first_field = operator.itemgetter(0)
+    for chunk_start in range(first, last, RECORD_SIZE * chunk_records):
+        chunk_stop = min(chunk_start + RECORD_SIZE * chunk_records, last)
+        # Вырезание, обрезка и склейка полей идут без байт-кода Python: map выполняется в C
+        with memoryview(mapped)[chunk_start:chunk_stop] as chunk:
+            fields = map(first_field, field_struct.iter_unpack(chunk))
+            text = b"\n".join(map(bytes.rstrip, fields, itertools.repeat(b" ")))
+        text = text.decode().lower()
+        row, line_start = 0, 0
+        position = text.find(value)
+        while position >= 0:
+            row += text.count("\n", line_start, position)
+            offset = chunk_start + row * RECORD_SIZE
+            if mapped[offset:offset + 1] != RECORD_DELETED:
+                yield offset
+            line_start = text.find("\n", position) + 1
+            if line_start == 0:
+                break
+            row += 1
+            position = text.find(value, line_start)
 
 
-def search_books(field: str, value: str) -> List[dict]:
+def scan_part(path: str, first: int, last: int, field: str, value: str) -> array:
     """
-    Ищет в поле field совпадения c value, возвращает список словарей книг
+    Просмотр участка файла в процессе пула: смещения подходящих записей. Записи целиком
+    читает вызывающий процесс из своего отображения файла, поэтому между процессами
+    передается по 8 байт на книгу
     """
-    result = []
-    with open(FILENAME, "r") as file:
-        for line in file:
-            book = line_to_dict(line)
-            value_book = book[field]
-            if field in ["year", "width", "height"]:
-                if book[field] == value:
-                    result.append(book)
-            elif field == "id":
-                if book[field] == value:
-                    return [book]
-            else:
-                if str(value).lower() in value_book.lower():
-                    result.append(book)
-                    
-    return result
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return array("q", scan_range(mapped, field, value, first, last))
 
 
-def display_menu():
-    return (
+def scan_books(file, field: str, value: str):
+    """
+    Поиск подстроки value (без учета регистра) в поле field по отображенному в память файлу.
+    Поле каждой записи порции вырезает struct.iter_unpack без декодирования, порция
+    склеивается в один текст через перевод строки, декодируется и переводится в нижний
+    регистр целиком, а поиск идет по нему str.find. Номер записи - число переводов строки
+    до совпадения; книга собирается только для подходящих записей. Большой файл
+    просматривают параллельно процессы пула по участкам, по порядку: если потребителю
+    хватило первых книг, следующие участки не просматриваются
+    """
+    value = str(value).lower()
+    size = os.fstat(file.fileno()).st_size
+    if size <= RECORD_SIZE or "\n" in value:
+        return
+    count_io(rows=size // RECORD_SIZE - 1, bytes_read=size - RECORD_SIZE)
+    parts = scan_partitions(file)
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if parts is not None:
+            offsets = itertools.chain.from_iterable(
+                parallel_scan(file, parts, scan_part, field, value)
+            )
+        else:
+            offsets = scan_range(mapped, field, value, RECORD_SIZE, size - size % RECORD_SIZE)
+        for offset in offsets:
+            yield record_to_dict(mapped[offset:offset + RECORD_SIZE])
+
+
+def count_range(mapped, fields: List[str], widths: dict, first: int, last: int,
+                chunk_records: int = 8192) -> Counter:
+    """count_field_values для участка [first, last) отображенного файла"""
+    counts = Counter()
+    order = sorted(range(len(fields)), key=lambda i: FIELD_SLICES[fields[i]].start)
+    layout, position = "c", 1
+    for i in order:
+        field_slice = FIELD_SLICES[fields[i]]
+        width = min(widths.get(fields[i], math.inf), field_slice.stop - field_slice.start)
+        layout += f"{field_slice.start - position}x{width}s"
+        position = field_slice.start + width
+    record_struct = struct.Struct(f"{layout}{RECORD_SIZE - position}x")
+    for chunk_start in range(first, last, RECORD_SIZE * chunk_records):
+        chunk_stop = min(chunk_start + RECORD_SIZE * chunk_records, last)
+        with memoryview(mapped)[chunk_start:chunk_stop] as chunk:
+            counts.update(record_struct.iter_unpack(chunk))
+    # Поля в struct идут в порядке записи, а результат - в порядке fields
+    restore = [order.index(i) + 1 for i in range(len(fields))]
+    result = Counter()
+    for values, count in counts.items():
+        if values[0] != RECORD_DELETED:
+            result[tuple(values[i].rstrip(b" ").decode(errors="ignore") for i in restore)] += count
+    return result
+
+
+def count_part(path: str, first: int, last: int, fields: List[str], widths: dict) -> Counter:
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return count_range(mapped, fields, widths, first, last)
+
+
+def count_field_values(file, fields: List[str], widths: dict = None) -> Counter:
+    """
+    Число живых записей для каждого сочетания значений полей fields (Counter кортежей строк)
+    по отображенному в память файлу. struct вырезает из записи только байт состояния и
+    нужные поля (из поля в widths - только первые байты), а подсчет одинаковых сочетаний
+    идет в Counter без байт-кода Python; декодируются только различные сочетания.
+    Участки большого файла считают процессы пула, их счетчики складываются
+    """
+    widths = widths or {}
+    size = os.fstat(file.fileno()).st_size
+    if size < 2 * RECORD_SIZE:
+        return Counter()
+    count_io(rows=size // RECORD_SIZE - 1, bytes_read=size - RECORD_SIZE)
+    parts = scan_partitions(file)
+    if parts is not None:
+        result = Counter()
+        for counts in parallel_scan(file, parts, count_part, fields, widths):
+            result.update(counts)
+        return result
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return count_range(mapped, fields, widths, RECORD_SIZE, size - size % RECORD_SIZE)
+
+
+def ensure_storage() -> None:
+    """
+    Подготовка файла базы: создание заголовка для нового файла, перевод старого формата
+    (строки переменной длины) в записи фиксированной длины, а записей без версии - в записи с версией
+    """
+    original_filename = Path(FILENAME)
+    if not original_filename.exists() or original_filename.stat().st_size == 0:
+        original_filename.write_bytes(make_header())
+        return
+    with original_filename.open("rb") as file:
+        is_records = file.read(len(HEADER_MAGIC)) == HEADER_MAGIC
+        version = read_header(file)["version"] if is_records else None
+    if version == FORMAT_VERSION:
+        return
+
+    create_backup()
+    if version is not None:
+        add_record_versions()
+        return
+    temp_filename = Path(f"{FILENAME}.migrate")
+    count = 0
+    max_id = 0
+    with original_filename.open("r", encoding="utf-8") as file, temp_filename.open("wb") as temp_file:
+        temp_file.write(make_header())
+        for line in file:
+            if line.strip():
+                book = line_to_dict(line)
+                temp_file.write(dict_to_record(book))
+                max_id = max(max_id, int(book["id"]))
+                count += 1
+        temp_file.seek(0)
+        temp_file.write(make_header(max_id + 1))
+    os.replace(temp_filename, original_filename)
+    logging.info(f"Файл базы переведен в формат фиксированной длины: {count} книг")
+
+
+def write_versioned_records(file, temp_file) -> int:
+    """
+    Запись содержимого файла формата 1 в temp_file в формате 2: каждая запись
+    получает версию 1. Возвращает число записей
+    """
+    old_size = RECORD_SIZE - VERSION_WIDTH - 1
+    version = b"1".ljust(VERSION_WIDTH) + b"|"
+    id_slice = slice(2, 2 + FIELD_WIDTHS["id"])
+    count = 0
+    max_id = 0
+    header = read_header(file)
+    temp_file.write(make_header())
+    file.seek(old_size)
+    while True:
+        chunk = file.read(old_size * 1024)
+        if len(chunk) < old_size:
+            break
+        for start in range(0, len(chunk) - old_size + 1, old_size):
+            record = chunk[start:start + old_size]
+            temp_file.write(record[:2] + version + record[2:])
+            max_id = max(max_id, int(record[id_slice]))
+            count += 1
+    temp_file.seek(0)
+    temp_file.write(make_header(header["next_id"] or max_id + 1, header["changes"] + 1))
+    temp_file.flush()
+    os.fsync(temp_file.fileno())
+    return count
+
+
+def add_record_versions() -> None:
+    """
+    Перевод файла формата 1 (записи без версии) в формат 2: каждая запись получает версию 1.
+    Журнал ссылается на смещения формата 1, поэтому применяется до перевода
+    """
+    original_filename = Path(FILENAME)
+    temp_filename = Path(f"{FILENAME}.migrate")
+    with file_lock(original_filename):
+        with original_filename.open("r+b") as file, temp_filename.open("wb") as temp_file:
+            wal.replay(file)
+            count = write_versioned_records(file, temp_file)
+        # Снимки до перевода - в формате 1. Новый снимок снимается до отметки
+        # в журнале: записи архива после него относятся только к формату 2
+        write_snapshot(temp_filename, wal.current_lsn())
+        os.replace(temp_filename, original_filename)
+        with original_filename.open("r+b") as file:
+            mark_rewrite(file)
+    logging.info(f"Записи базы дополнены версиями: {count} записей")
+
+
+# INDEXES
+# Индекс первичного ключа: id книги -> смещение записи в файле (в байтах)
+id_index = {}
+# Число удаленных (помеченных) записей, ожидающих уплотнения
+dead_slots = 0
+compaction_needed = threading.Event()
+# Триграммные индексы: поле -> триграмма -> множество id книг
+text_indexes = {field: {} for field in TEXT_INDEX_FIELDS}
+# Индексы диапазонов: поле -> отсортированный список пар (ключ, id книги).
+# Ключ - число, для дат - порядковый номер дня
+range_indexes = {field: [] for field in RANGE_FIELDS}
+# Индекс уникальности: (название, авторы, год, жанры) -> множество id книг
+unique_index = {}
+UNIQUE_FIELDS = ["name", "authors", "year", "genres"]
+
+
+def trigrams(text: str) -> set:
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def range_key(field: str, value: str) -> float:
+    """Ключ индекса диапазона: число или порядковый номер дня для дат DD-MM-YYYY"""
+    if field in DATE_FIELDS:
+        return datetime.strptime(value, "%d-%m-%Y").toordinal()
+    return float(value)
+
+
+def unique_key(book: dict) -> tuple:
+    """Ключ уникальности в том виде, в котором поля хранятся в файле"""
+    return tuple(str(book[field]).rstrip(" ") for field in UNIQUE_FIELDS)
+
+
+def index_book(book: dict, offset: int, keep_sorted: bool = True) -> None:
+    """
+    Добавление книги в индексы. При keep_sorted=False пары диапазонных индексов
+    дописываются в конец, и после всех книг нужен sort_range_indexes
+    """
+    book_id = int(book["id"])
+    id_index[book_id] = offset
+    unique_index.setdefault(unique_key(book), set()).add(book_id)
+    for field, index in range_indexes.items():
+        try:
+            entry = (range_key(field, str(book[field])), book_id)
+        except ValueError:
+            continue
+        if keep_sorted:
+            bisect.insort(index, entry)
+        else:
+            index.append(entry)
+    if TEXT_INDEXES_ENABLED:
+        for field, index in text_indexes.items():
+            for gram in trigrams(str(book[field])):
+                index.setdefault(gram, set()).add(book_id)
+    if COLUMN_TABLE_ENABLED:
+        column_table.insert(book)
+
+
+def sort_range_indexes() -> None:
+    """Упорядочение диапазонных индексов после добавления книг с keep_sorted=False"""
+    for index in range_indexes.values():
+        index.sort()
+
+
+def unindex_book(book: dict) -> None:
+    """Удаление книги из индексов"""
+    book_id = int(book["id"])
+    id_index.pop(book_id, None)
+    key = unique_key(book)
+    ids = unique_index.get(key)
+    if ids is not None:
+        ids.discard(book_id)
+        if not ids:
+            del unique_index[key]
+    for field, index in range_indexes.items():
+        try:
+            entry = (range_key(field, str(book[field])), book_id)
+        except ValueError:
+            continue
+        i = bisect.bisect_left(index, entry)
+        if i < len(index) and index[i] == entry:
+            del index[i]
+    if TEXT_INDEXES_ENABLED:
+        for field, index in text_indexes.items():
+            for gram in trigrams(str(book[field])):
+                ids = index.get(gram)
+                if ids is not None:
+                    ids.discard(book_id)
+                    if not ids:
+                        del index[gram]
+    if COLUMN_TABLE_ENABLED:
+        column_table.delete(book_id)
+
+
+def text_candidates(field: str, value: str) -> set:
+    """id книг, в поле field которых есть все триграммы value (value не короче 3 символов)"""
+    index = text_indexes[field]
+    postings = sorted((index.get(gram, set()) for gram in trigrams(value)), key=len)
+    candidates = set(postings[0])
+    for ids in postings[1:]:
+        if not candidates:
+            break
+        candidates &= ids
+    return candidates
+
+
+def parse_range(field: str, value: str):
+    """
+    Разбор запроса по диапазону: "a..b", "a..", "..b", ">=a", ">a", "<=b", "<b",
+    "after a" / "после a", "before b" / "до b".
+    Возвращает (нижняя граница, включительно, верхняя граница, включительно) или None,
+    если value - не диапазон
+    """
+    value = value.strip().lower()
+    if ".." in value:
+        lo, hi = (part.strip() for part in value.split("..", 1))
+        return (
+            range_key(field, lo) if lo else None,
+            True,
+            range_key(field, hi) if hi else None,
+            True,
+        )
+    for prefix, is_lower, inclusive in (
+        (">=", True, True),
+        ("<=", False, True),
+        (">", True, False),
+        ("<", False, False),
+        ("after ", True, False),
+        ("после ", True, False),
+        ("before ", False, False),
+        ("до ", False, False),
+    ):
+        if value.startswith(prefix):
+            key = range_key(field, value[len(prefix):].strip())
+            if is_lower:
+                return key, inclusive, None, True
+            return None, True, key, inclusive
+    return None
+
+
+def range_slice(field: str, lo=None, lo_inclusive=True, hi=None, hi_inclusive=True) -> slice:
+    """Участок индекса диапазона поля field, значения которого попадают в диапазон"""
+    index = range_indexes[field]
+    start = 0
+    if lo is not None:
+        start = bisect.bisect_left(index, (lo, -math.inf if lo_inclusive else math.inf))
+    end = len(index)
+    if hi is not None:
+        end = bisect.bisect_left(index, (hi, math.inf if hi_inclusive else -math.inf))
+    return slice(start, max(start, end))
+
+
+def range_ids(field: str, lo=None, lo_inclusive=True, hi=None, hi_inclusive=True) -> List[int]:
+    """id книг, у которых значение поля field попадает в диапазон"""
+    bounds = range_slice(field, lo, lo_inclusive, hi, hi_inclusive)
+    return [book_id for _, book_id in range_indexes[field][bounds]]
+
+
+def iter_read_books(ids):
+    """Чтение книг по id через индекс первичного ключа, в порядке записей в файле"""
+    offsets = sorted(id_index[book_id] for book_id in ids if book_id in id_index)
+    with open(FILENAME, "rb") as file:
+        for offset in offsets:
+            book = read_book_at(file, offset)
+            if book is not None:
+                yield book
+
+
+def read_books(ids) -> List[dict]:
+    return list(iter_read_books(ids))
+
+
+def rebuild_indexes() -> None:
+    """Перестроение индексов одним проходом по файлу"""
+    global dead_slots, cache_changes
+    id_index.clear()
+    unique_index.clear()
+    for index in text_indexes.values():
+        index.clear()
+    for index in range_indexes.values():
+        index.clear()
+    column_table.__init__()
+    dead_slots = 0
+    with open(FILENAME, "rb") as file:
+        cache_changes = read_header(file)["changes"]
+        for offset, record in iter_records(file):
+            if is_deleted(record):
+                dead_slots += 1
+            else:
+                # Вставка в отсортированный список - O(n), поэтому сортировка один раз в конце
+                index_book(record_to_dict(record), offset, keep_sorted=False)
+    sort_range_indexes()
+    logging.info(f"Индексы перестроены: {len(id_index)} книг")
+
+
+def index_snapshot() -> dict:
+    """Индексы вместе с размером и временем изменения файла базы, которым они соответствуют"""
+    stat = os.stat(FILENAME)
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "id_index": id_index,
+        "dead_slots": dead_slots,
+        "text_indexes": text_indexes if TEXT_INDEXES_ENABLED else None,
+        "range_indexes": range_indexes,
+        "unique_index": unique_index,
+        "column_table": column_table if COLUMN_TABLE_ENABLED else None,
+    }
+
+
+def write_index_snapshot(snapshot: dict) -> Path:
+    """Запись снимка индексов во временный файл; возвращает его путь"""
+    # Снимок сохраняют и другие потоки и серверы с тем же файлом базы
+    temp_filename = Path(f"{INDEX_FILENAME}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with temp_filename.open("wb") as file:
+            pickle.dump(snapshot, file)
+    except BaseException:
+        temp_filename.unlink(missing_ok=True)
+        raise
+    return temp_filename
+
+
+def save_indexes() -> None:
+    """Сохранение индексов на диск вместе с размером и временем изменения файла базы"""
+    global saved_index_changes
+    os.replace(write_index_snapshot(index_snapshot()), INDEX_FILENAME)
+    saved_index_changes = cache_changes
+
+
+def load_indexes() -> None:
+    """Загрузка индексов с диска; если файл базы менялся после сохранения - перестроение"""
+    global dead_slots, column_table, cache_changes, saved_index_changes
+    try:
+        with open(INDEX_FILENAME, "rb") as file:
+            snapshot = pickle.load(file)
+        stat = os.stat(FILENAME)
+        if (
+            (snapshot["size"], snapshot["mtime"]) == (stat.st_size, stat.st_mtime_ns)
+            and (snapshot["text_indexes"] is not None) == TEXT_INDEXES_ENABLED
+            and (snapshot["column_table"] is not None) == COLUMN_TABLE_ENABLED
+        ):
+            id_index.clear()
+            id_index.update(snapshot["id_index"])
+            dead_slots = snapshot["dead_slots"]
+            unique_index.clear()
+            unique_index.update(snapshot["unique_index"])
+            for field, index in range_indexes.items():
+                index[:] = snapshot["range_indexes"][field]
+            if TEXT_INDEXES_ENABLED:
+                for field, index in text_indexes.items():
+                    index.clear()
+                    index.update(snapshot["text_indexes"][field])
+            if COLUMN_TABLE_ENABLED:
+                column_table = snapshot["column_table"]
+            with open(FILENAME, "rb") as file:
+                cache_changes = saved_index_changes = read_header(file)["changes"]
+            logging.info(f"Индексы загружены: {len(id_index)} книг")
+            return
+    except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+        pass
+    rebuild_indexes()
+    save_indexes()
+
+
+# COLUMN TABLE
+# Необязательная таблица книг в памяти по столбцам, строки упорядочены по id:
+# - year, width, height и даты (порядковые номера дней) - массивы array чисел;
+# - book_type и source - коды перечисления;
+# - authors и genres - коды словаря отдельных авторов и жанров;
+# - name и rating - один буфер UTF-8 на столбец.
+# Поиск при включенной таблице не обращается к файлу: условие вычисляется по столбцу
+# целиком через map/compress, словарь книги собирается только для найденных строк
+ENUM_FIELDS = ["book_type", "source"]
+LIST_FIELDS = ["authors", "genres"]
+TEXT_FIELDS = ["name", "rating"]
+
+
+class EnumColumn:
+    """Столбец с небольшим набором значений: в строках - однобайтовые коды"""
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+        self.column = array("B")
+
+    def encode(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def insert(self, row: int) -> None:
+        self.column.insert(row, 0)
+
+    def set(self, row: int, value: str) -> None:
+        self.column[row] = self.encode(value)
+
+    def get(self, row: int) -> str:
+        return self.values[self.column[row]]
+
+    def matches(self, value: str):
+        """Признак "value входит в значение" для каждой строки; проверка - один раз на значение"""
+        codes = {code for code, text in enumerate(self.values) if value in text.lower()}
+        return map(codes.__contains__, self.column)
+
+
+class PackedColumn:
+    """
+    Столбец переменной длины одним буфером: у строки таблицы - начало и длина в буфере.
+    Новое значение, которое не помещается на место старого, дописывается в конец;
+    буфер переупаковывается, когда мусора становится больше половины
+    """
+
+    def __init__(self, typecode: str):
+        self.data = array(typecode)
+        self.starts = array("Q")
+        self.lengths = array("H")
+        self.garbage = 0
+
+    def insert(self, row: int) -> None:
+        self.starts.insert(row, len(self.data))
+        self.lengths.insert(row, 0)
+
+    def put(self, row: int, items) -> None:
+        length = self.lengths[row]
+        if len(items) <= length:
+            start = self.starts[row]
+            self.data[start:start + len(items)] = items
+        else:
+            self.starts[row] = len(self.data)
+            self.data.extend(items)
+        self.garbage += length - len(items) if len(items) <= length else length
+        self.lengths[row] = len(items)
+        if self.garbage > len(self.data) // 2:
+            self.repack()
+
+    def items(self, row: int):
+        start = self.starts[row]
+        return self.data[start:start + self.lengths[row]]
+
+    def all_items(self):
+        """Значения всех строк по порядку; срезы берутся без байт-кода Python"""
+        return map(
+            self.data.__getitem__,
+            map(slice, self.starts, map(operator.add, self.starts, self.lengths)),
+        )
+
+    def repack(self) -> None:
+        data = array(self.data.typecode)
+        for row, items in enumerate(self.all_items()):
+            self.starts[row] = len(data)
+            data.extend(items)
+        self.data, self.garbage = data, 0
+
+
+class TextColumn(PackedColumn):
+    """Строки в кодировке UTF-8"""
+
+    def __init__(self):
+        super().__init__("B")
+
+    def set(self, row: int, value: str) -> None:
+        self.put(row, array("B", value.encode()))
+
+    def get(self, row: int) -> str:
+        return self.items(row).tobytes().decode()
+
+    def matching_rows(self, value: str):
+        """
+        Строки, в значении которых есть value без учета регистра: все значения
+        склеиваются через перевод строки, декодируются и переводятся в нижний регистр
+        одним вызовом, номер строки - число переводов строки до совпадения
+        """
+        text = b"\n".join(map(array.tobytes, self.all_items())).decode().lower()
+        row, line_start = 0, 0
+        position = text.find(value) if "\n" not in value else -1
+        while position >= 0:
+            row += text.count("\n", line_start, position)
+            yield row
+            line_start = text.find("\n", position) + 1
+            if line_start == 0:
+                return
+            row += 1
+            position = text.find(value, line_start)
+
+
+class ListColumn(PackedColumn):
+    """Список через запятую (авторы, жанры): в строках - коды словаря отдельных элементов"""
+
+    def __init__(self):
+        super().__init__("I")
+        self.values = []
+        self.codes = {}
+
+    def encode(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def set(self, row: int, value: str) -> None:
+        self.put(row, array("I", map(self.encode, value.split(","))))
+
+    def get(self, row: int) -> str:
+        return ",".join(map(self.values.__getitem__, self.items(row)))
+
+    def matches(self, value: str):
+        """
+        Признак "value входит в значение" для каждой строки. Подстрока без запятой
+        целиком лежит в одном элементе, поэтому условие проверяется один раз на элемент
+        """
+        if "," in value:
+            return (value in self.get(row).lower() for row in range(len(self.starts)))
+        codes = {code for code, text in enumerate(self.values) if value in text.lower()}
+        return map(operator.not_, map(codes.isdisjoint, self.all_items()))
+
+
+class ColumnTable:
+    def __init__(self):
+        self.ids = array("q")
+        self.versions = array("q")
+        # У удаленной книги строка остается до compact(), чтобы обновление
+        # (удаление из индексов и добавление) не меняло порядок строк
+        self.alive = bytearray()
+        self.dead = 0
+        self.numbers = {field: array("d") for field in RANGE_FIELDS}
+        # Исходные строки чисел и дат, которые не восстанавливаются из ключа (например, "100")
+        self.overrides = {}
+        self.columns = {field: EnumColumn() for field in ENUM_FIELDS}
+        self.columns.update((field, ListColumn()) for field in LIST_FIELDS)
+        self.columns.update((field, TextColumn()) for field in TEXT_FIELDS)
+
+    def __len__(self) -> int:
+        return len(self.ids) - self.dead
+
+    def row_of(self, book_id: int):
+        row = bisect.bisect_left(self.ids, book_id)
+        return row if row < len(self.ids) and self.ids[row] == book_id else None
+
+    @staticmethod
+    def format_number(field: str, key: float):
+        if math.isnan(key):
+            return None
+        if field in DATE_FIELDS:
+            return date.fromordinal(int(key)).strftime("%d-%m-%Y")
+        return str(int(key)) if field == "year" else str(key)
+
+    def insert(self, book: dict) -> None:
+        book_id = int(book["id"])
+        row = bisect.bisect_left(self.ids, book_id)
+        if row == len(self.ids) or self.ids[row] != book_id:
+            # Обычно id новой книги больше всех, и строка добавляется в конец
+            self.ids.insert(row, book_id)
+            self.versions.insert(row, 0)
+            self.alive.insert(row, 1)
+            for column in self.numbers.values():
+                column.insert(row, math.nan)
+            for column in self.columns.values():
+                column.insert(row)
+        elif not self.alive[row]:
+            self.alive[row] = 1
+            self.dead -= 1
+        self.versions[row] = int(book.get("version", 1))
+        for field, column in self.numbers.items():
+            value = str(book[field])
+            try:
+                key = float(range_key(field, value))
+            except ValueError:
+                key = math.nan
+            column[row] = key
+            if self.format_number(field, key) == value:
+                self.overrides.pop((field, book_id), None)
+            else:
+                self.overrides[(field, book_id)] = value
+        for field, column in self.columns.items():
+            column.set(row, str(book[field]))
+
+    def delete(self, book_id: int) -> None:
+        row = self.row_of(book_id)
+        if row is not None and self.alive[row]:
+            self.alive[row] = 0
+            self.dead += 1
+
+    def value(self, field: str, row: int) -> str:
+        if field == "id":
+            return str(self.ids[row])
+        if field in self.numbers:
+            override = self.overrides.get((field, self.ids[row]))
+            return override if override is not None else self.format_number(field, self.numbers[field][row])
+        return self.columns[field].get(row)
+
+    def book(self, row: int) -> dict:
+        book = {field: self.value(field, row) for field in HEADERS}
+        book["version"] = self.versions[row]
+        return book
+
+    def compact(self) -> None:
+        """Удаление строк удаленных книг"""
+        if not self.dead:
+            return
+        books = [self.book(row) for row in self.rows_where()]
+        self.__init__()
+        for book in books:
+            self.insert(book)
+
+    def rows_where(self, *masks):
+        """Номера живых строк, для которых все признаки истинны"""
+        mask = self.alive
+        for other in masks:
+            mask = map(operator.and_, mask, other)
+        return itertools.compress(range(len(self.ids)), mask)
+
+    def search(self, field: str, value: str):
+        """Книги, у которых поле field совпадает с value, - как iter_search_books"""
+        value = str(value)
+        if field == "id":
+            row = self.row_of(int(value)) if value.isdigit() else None
+            if row is not None and self.alive[row]:
+                yield self.book(row)
+            return
+        if field in self.numbers:
+            column = self.numbers[field]
+            try:
+                bounds = parse_range(field, value)
+            except ValueError:
+                return
+            if bounds is not None:
+                lo, lo_inclusive, hi, hi_inclusive = bounds
+                masks = []
+                if lo is not None:
+                    masks.append(map(float(lo).__le__ if lo_inclusive else float(lo).__lt__, column))
+                if hi is not None:
+                    masks.append(map(float(hi).__ge__ if hi_inclusive else float(hi).__gt__, column))
+                if not masks:
+                    # Открытый с обеих сторон диапазон - все книги с разобранным значением
+                    masks.append(map(operator.eq, column, column))
+                yield from map(self.book, self.rows_where(*masks))
+                return
+            if field not in DATE_FIELDS:
+                try:
+                    key = float(range_key(field, value))
+                except ValueError:
+                    return
+                for row in self.rows_where(map(key.__eq__, column)):
+                    if self.value(field, row) == value:
+                        yield self.book(row)
+                return
+        value = value.lower()
+        column = self.columns.get(field)
+        if isinstance(column, TextColumn):
+            rows = (row for row in column.matching_rows(value) if self.alive[row])
+        elif column is not None:
+            rows = self.rows_where(column.matches(value))
+        else:
+            rows = (row for row in self.rows_where() if value in self.value(field, row).lower())
+        yield from map(self.book, rows)
+
+
+column_table = ColumnTable()
+
+
+# CACHE
+# Кэш книг по id и результатов поиска по (поле, значение). Запись этого процесса
+# удаляет из кэша ровно затронутые книги и запросы; запись другого процесса обнаруживается
+# при захвате блокировки по счетчику изменений в заголовке файла, и тогда индексы
+# перечитываются, а кэш очищается целиком
+class LRUCache:
+    """Ограниченный кэш с вытеснением давно не использованных записей и счетчиками"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.guard = threading.Lock()
+
+    def get(self, key):
+        with self.guard:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value) -> None:
+        with self.guard:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, predicate) -> None:
+        """Удаление записей, для которых predicate(ключ, значение) истинно"""
+        with self.guard:
+            for key in [key for key, value in self.entries.items() if predicate(key, value)]:
+                del self.entries[key]
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self.guard:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def report(self, name: str) -> str:
+        with self.guard:
+            total = self.hits + self.misses
+            ratio = self.hits / total * 100 if total else 0.0
+            return (
+                f"{name}: записей {len(self.entries)}/{self.capacity}, попаданий {self.hits} ({ratio:.1f}%), "
+                f"промахов {self.misses}, вытеснений {self.evictions}, сбросов {self.invalidations}"
+            )
+
+
+book_cache = LRUCache(BOOK_CACHE_SIZE)
+# (поле, значение) -> (множество id, кортеж книг)
+search_cache = LRUCache(SEARCH_CACHE_SIZE)
+# Счетчик изменений файла, которому соответствуют индексы и кэш (None - индексы не загружены)
+cache_changes = None
+# Счетчик изменений, на котором индексы последний раз сохранены на диск
+saved_index_changes = None
+
+
+def file_changed_elsewhere() -> bool:
+    """Изменил ли файл базы другой процесс после загрузки индексов. Вызывается под блокировкой"""
+    if cache_changes is None:
+        return False
+    try:
+        with open(FILENAME, "rb") as file:
+            return read_header(file)["changes"] != cache_changes
+    except OSError:
+        return False
+
+
+def reload_changed_file() -> None:
+    """
+    Индексы и кэш после записи другого процесса: индексы перечитываются со снимка
+    или перестраиваются по файлу. Вызывается под монопольной блокировкой
+    """
+    if not file_changed_elsewhere():
+        return
+    logging.info("Файл базы изменен другим процессом: индексы перечитываются")
+    load_indexes()
+    book_cache.clear()
+    search_cache.clear()
+
+
+def book_matches(book: dict, field: str, value: str) -> bool:
+    """Подходит ли книга под поиск search_books(field, value)"""
+    value = str(value)
+    if field == QUERY_FIELD:
+        try:
+            return query_matches(parse_query(value), book)
+        except ValueError:
+            return False
+    if field == "id":
+        return value.isdigit() and int(value) == int(book["id"])
+    if field in RANGE_FIELDS:
+        try:
+            bounds = parse_range(field, value)
+        except ValueError:
+            return False
+        if bounds is not None:
+            try:
+                key = range_key(field, str(book[field]))
+            except ValueError:
+                return False
+            lo, lo_inclusive, hi, hi_inclusive = bounds
+            return (
+                (lo is None or key > lo or (lo_inclusive and key == lo))
+                and (hi is None or key < hi or (hi_inclusive and key == hi))
+            )
+        if field not in DATE_FIELDS:
+            try:
+                range_key(field, value)
+            except ValueError:
+                return False
+            return str(book[field]) == value
+    return value.lower() in str(book[field]).lower()
+
+
+def invalidate_cache(old_books: List[dict], new_books: List[dict]) -> None:
+    """
+    Удаление из кэша книг, которые изменились, и запросов, результат которых мог измениться:
+    содержавших старую версию книги или подходящих под новую. Вызывается под монопольной блокировкой
+    """
+    changed_ids = {int(book["id"]) for book in itertools.chain(old_books, new_books)}
+    book_cache.invalidate(lambda book_id, book: book_id in changed_ids)
+    if len(new_books) > SEARCH_CACHE_SIZE:
+        # Для большого пакета проверка каждого запроса дороже, чем сброс
+        search_cache.clear()
+        return
+    search_cache.invalidate(
+        lambda key, entry: not changed_ids.isdisjoint(entry[0])
+        or any(book_matches(book, *key) for book in new_books)
+    )
+
+
+def find_books_cached(field: str, value: str):
+    """
+    Кортеж найденных книг из кэша или с диска; результат больше SEARCH_CACHE_MAX_RESULTS
+    книг не кэшируется, тогда возвращается None. Вызывается под блокировкой
+    """
+    if field == "id":
+        book = book_cache.get(int(value)) if str(value).isdigit() else None
+        if book is not None:
+            return (book,)
+        books = tuple(iter_search_books(field, value))
+        for book in books:
+            book_cache.put(int(book["id"]), book)
+        return books
+    key = (field, str(value))
+    entry = search_cache.get(key)
+    if entry is not None:
+        return entry[1]
+    books = tuple(itertools.islice(iter_search_books(field, value), SEARCH_CACHE_MAX_RESULTS + 1))
+    if len(books) > SEARCH_CACHE_MAX_RESULTS:
+        return None
+    search_cache.put(key, (frozenset(int(book["id"]) for book in books), books))
+    return books
+
+
+def cache_report() -> List[str]:
+    return [book_cache.report("книги по id"), search_cache.report("результаты поиска")]
+
+
+# COMPACTION
+def needs_compaction() -> bool:
+    return (
+        dead_slots >= COMPACTION_MIN_DEAD
+        and dead_slots >= COMPACTION_RATIO * (dead_slots + len(id_index))
+    )
+
+
+@instrumented("compact_books_file")
+def compact_books_file() -> int:
+    """
+    Уплотнение: переписывает файл без удаленных записей, сохраняя порядок книг.
+    Возвращает число освобожденных слотов
+    """
+    global dead_slots
+    original_filename = Path(FILENAME)
+    temp_filename = Path(f"{FILENAME}.compact")
+    with file_lock(original_filename):
+        new_offsets = {}
+        with original_filename.open("r+b") as file, temp_filename.open("wb") as temp_file:
+            # Записи журнала ссылаются на старые смещения - переносим их до перезаписи файла
+            wal.checkpoint(file)
+            file.seek(0)
+            temp_file.write(file.read(RECORD_SIZE))
+            for _, record in iter_records(file):
+                if not is_deleted(record):
+                    new_offsets[record_id(record)] = temp_file.tell()
+                    temp_file.write(record)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        # Смещения записей изменились, и следующие записи журнала нельзя применять
+        # к прежним снимкам - начинаем от уплотненного файла новый снимок
+        write_snapshot(temp_filename, wal.current_lsn())
+        os.replace(temp_filename, original_filename)
+        with original_filename.open("r+b") as file:
+            mark_rewrite(file)
+        id_index.update(new_offsets)
+        if COLUMN_TABLE_ENABLED:
+            column_table.compact()
+        reclaimed, dead_slots = dead_slots, 0
+        save_indexes()
+    logging.info(f"Уплотнение завершено: освобождено {reclaimed} записей")
+    return reclaimed
+
+
+def compactor(interval: float = COMPACTION_INTERVAL) -> None:
+    """Фоновый поток уплотнения: просыпается по таймеру или после удалений"""
+    while True:
+        compaction_needed.wait(interval)
+        compaction_needed.clear()
+        if not needs_compaction():
+            continue
+        try:
+            compact_books_file()
+        except TimeoutError:
+            logging.info("Уплотнение отложено: файл занят")
+
+
+# WRITE-AHEAD LOG
+# Файл журнала: заголовок (магия, LSN начала файла) и записи. Запись журнала - одно
+# изменение базы: заголовок записи (длина данных, crc32, LSN конца записи, время)
+# и список позиционных записей в файл базы (смещение, длина, байты)
+WAL_MAGIC = b"WAL1"
+WAL_HEADER = struct.Struct("<4sQ")
+WAL_ENTRY = struct.Struct("<IIQd")
+WAL_WRITE = struct.Struct("<QI")
+
+
+def encode_wal_entry(writes: List[tuple], lsn_before: int) -> tuple:
+    """Байты записи журнала и LSN ее конца"""
+    payload = b"".join(WAL_WRITE.pack(offset, len(data)) + data for offset, data in writes)
+    lsn = lsn_before + WAL_ENTRY.size + len(payload)
+    entry = WAL_ENTRY.pack(len(payload), zlib.crc32(payload), lsn, time.time()) + payload
+    return entry, lsn
+
+
+def iter_wal_entries(path):
+    """Целые записи журнала: (LSN, время, [(смещение, данные)]); оборванный хвост пропускается"""
+    with open(path, "rb") as file:
+        header = file.read(WAL_HEADER.size)
+        if len(header) < WAL_HEADER.size or not header.startswith(WAL_MAGIC):
+            return
+        while True:
+            raw = file.read(WAL_ENTRY.size)
+            if len(raw) < WAL_ENTRY.size:
+                return
+            length, crc, lsn, timestamp = WAL_ENTRY.unpack(raw)
+            payload = file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            yield lsn, timestamp, decode_wal_writes(payload)
+
+
+def decode_wal_writes(payload: bytes) -> List[tuple]:
+    """Позиционные записи из данных записи журнала: [(смещение, данные)]"""
+    writes = []
+    position = 0
+    while position < len(payload):
+        offset, size = WAL_WRITE.unpack_from(payload, position)
+        position += WAL_WRITE.size
+        writes.append((offset, payload[position:position + size]))
+        position += size
+    return writes
+
+
+def parse_wal_entries(data: bytes) -> List[tuple]:
+    """Записи журнала, переданные подряд (репликация): [(LSN, время, записи)]"""
+    entries = []
+    position = 0
+    while position < len(data):
+        if len(data) - position < WAL_ENTRY.size:
+            raise ValueError("Оборванная запись журнала")
+        length, crc, lsn, timestamp = WAL_ENTRY.unpack_from(data, position)
+        position += WAL_ENTRY.size
+        payload = data[position:position + length]
+        position += length
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            raise ValueError("Поврежденная запись журнала")
+        entries.append((lsn, timestamp, decode_wal_writes(payload)))
+    return entries
+
+
+def apply_writes(file, writes: List[tuple]) -> None:
+    for offset, data in writes:
+        file.seek(offset)
+        file.write(data)
+    count_io(bytes_written=sum(len(data) for _, data in writes))
+
+
+class WriteAheadLog:
+    """
+    Журнал упреждающей записи. Изменение добавляется в журнал и применяется к файлу базы
+    под монопольной блокировкой, а клиенту отвечают после fsync журнала (sync).
+    Один fsync покрывает все записи, добавленные до его начала, поэтому параллельные
+    клиенты фиксируются группой. Контрольная точка (checkpoint) сбрасывает файл базы
+    на диск и очищает журнал
+    """
+
+    def __init__(self, path, archive_dir=None):
+        self.path = Path(path)
+        # Каталог, куда контрольная точка переносит журнал перед очисткой (для резервных копий)
+        self.archive_dir = archive_dir
+        self._fd = None
+        self._condition = threading.Condition()
+        self._syncing = False
+        self._durable_lsn = 0
+
+    def _open(self) -> int:
+        if self._fd is None:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+            if os.fstat(fd).st_size < WAL_HEADER.size:
+                os.pwrite(fd, WAL_HEADER.pack(WAL_MAGIC, 0), 0)
+            self._fd = fd
+        return self._fd
+
+    def _position(self) -> tuple:
+        """(LSN начала файла журнала, размер файла)"""
+        fd = self._open()
+        _, base_lsn = WAL_HEADER.unpack(os.pread(fd, WAL_HEADER.size, 0))
+        return base_lsn, os.fstat(fd).st_size
+
+    def size(self) -> int:
+        with self._condition:
+            return self._position()[1]
+
+    def current_lsn(self) -> int:
+        with self._condition:
+            base_lsn, size = self._position()
+            return base_lsn + size
+
+    def _truncate(self, end_lsn: int) -> None:
+        # Сначала новый LSN начала, потом обрезка: при сбое между ними
+        # в журнале останутся уже примененные записи, повторять их безопасно
+        os.pwrite(self._fd, WAL_HEADER.pack(WAL_MAGIC, end_lsn), 0)
+        os.ftruncate(self._fd, WAL_HEADER.size)
+        os.fsync(self._fd)
+        self._durable_lsn = max(self._durable_lsn, end_lsn)
+        self._condition.notify_all()
+
+    def append(self, writes: List[tuple]) -> int:
+        """Добавление изменения в журнал (без fsync). Вызывается под монопольной блокировкой"""
+        with self._condition:
+            base_lsn, size = self._position()
+            entry, lsn = encode_wal_entry(writes, base_lsn + size)
+            os.pwrite(self._fd, entry, size)
+            count_io(bytes_written=len(entry))
+            return lsn
+
+    def sync(self, lsn: int) -> None:
+        """Ожидание, пока журнал до lsn не окажется на диске"""
+        with self._condition:
+            while self._durable_lsn < lsn:
+                if self._syncing:
+                    self._condition.wait()
+                    continue
+                self._syncing = True
+                base_lsn, size = self._position()
+                synced = False
+                self._condition.release()
+                try:
+                    os.fsync(self._fd)
+                    synced = True
+                finally:
+                    self._condition.acquire()
+                    self._syncing = False
+                    if synced:
+                        self._durable_lsn = max(self._durable_lsn, base_lsn + size)
+                    self._condition.notify_all()
+
+    def checkpoint(self, file) -> bool:
+        """
+        Перенос журнала в файл базы: fsync файла базы, затем очистка журнала.
+        Вызывается под монопольной блокировкой, file - файл базы, открытый на запись
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: not self._syncing)
+            base_lsn, size = self._position()
+            if size <= WAL_HEADER.size:
+                return False
+            file.flush()
+            os.fsync(file.fileno())
+            if self.archive_dir is not None:
+                archive_wal_segment(self.archive_dir, base_lsn, os.pread(self._fd, size, 0))
+            self._truncate(base_lsn + size)
+            return True
+
+    def reset(self) -> None:
+        """Отбрасывание журнала без применения (после восстановления из резервной копии)"""
+        with self._condition:
+            self._condition.wait_for(lambda: not self._syncing)
+            base_lsn, size = self._position()
+            self._truncate(base_lsn + size)
+
+    def replay(self, file) -> int:
+        """Применение к файлу базы записей, не перенесенных контрольной точкой"""
+        if not self.path.exists():
+            return 0
+        count = 0
+        for _, _, writes in iter_wal_entries(self.path):
+            apply_writes(file, writes)
+            count += 1
+        self.checkpoint(file)
+        return count
+
+
+wal = WriteAheadLog(WAL_FILENAME, archive_dir=BACKUP_DIR)
+checkpoint_needed = threading.Event()
+backup_needed = threading.Event()
+
+
+def commit_writes(file, writes: List[tuple], next_id: int = None) -> int:
+    """
+    Изменение файла базы через журнал: запись в журнал, затем в файл. Вместе с изменением
+    записывается заголовок с увеличенным счетчиком изменений (и новым next_id, если задан).
+    Вызывается под монопольной блокировкой; после ее снятия нужно дождаться wal.sync(lsn)
+    """
+    global cache_changes
+    header = read_header(file)
+    changes = header["changes"] + 1
+    header_write = (0, make_header(header["next_id"] if next_id is None else next_id, changes))
+    writes = [header_write] + writes
+    lsn = wal.append(writes)
+    apply_writes(file, writes)
+    if replication_feed is not None:
+        replication_feed.publish(writes, lsn)
+    # Кэш этого процесса уже согласован с записью: затронутое удаляет invalidate_cache
+    cache_changes = changes
+    if wal.size() > WAL_CHECKPOINT_SIZE:
+        checkpoint_needed.set()
+    return lsn
+
+
+@instrumented("checkpoint")
+def checkpoint() -> bool:
+    """
+    Контрольная точка и снимок индексов. Сериализация индексов занимает секунды
+    на большой базе, поэтому идет без блокировки: снимок заменяет прежний, только
+    если за это время счетчик изменений не сдвинулся, то есть индексы не менялись
+    """
+    global saved_index_changes
+    with file_lock(FILENAME), open(FILENAME, "r+b") as file:
+        done = wal.checkpoint(file)
+        # Снимок, отброшенный при прошлой контрольной точке, сохраняется при следующей
+        if cache_changes == saved_index_changes:
+            return done
+        snapshot = index_snapshot()
+        changes = cache_changes
+    try:
+        temp_filename = write_index_snapshot(snapshot)
+    except RuntimeError:
+        # Словарь или множество индекса изменились во время сериализации
+        return done
+    # Под блокировкой чтения запись не может быть в середине изменения индексов
+    with file_lock(FILENAME, shared=True):
+        if cache_changes == changes:
+            os.replace(temp_filename, INDEX_FILENAME)
+            saved_index_changes = changes
+            return done
+    temp_filename.unlink()
+    return done
+
+
+def checkpointer(interval: float = WAL_CHECKPOINT_INTERVAL) -> None:
+    """Фоновый поток контрольных точек: по таймеру или когда журнал вырос"""
+    while True:
+        checkpoint_needed.wait(interval)
+        checkpoint_needed.clear()
+        try:
+            if checkpoint():
+                logging.info("Контрольная точка: журнал перенесен в файл базы")
+        except TimeoutError:
+            logging.info("Контрольная точка отложена: файл занят")
+
+
+def recover_from_wal() -> int:
+    """Восстановление после сбоя: повтор записей журнала при запуске сервера"""
+    with file_lock(FILENAME), open(FILENAME, "r+b") as file:
+        count = wal.replay(file)
+    if count:
+        logging.info(f"Из журнала восстановлено изменений: {count}")
+    return count
+
+
+# BACKUPS
+# Резервные копии: полные снимки файла базы (snapshot_<LSN>.txt, время снимка - mtime файла)
+# и архив журнала (wal_<LSN начала>_<LSN конца>.seg), который пополняет контрольная точка.
+# Состояние на любой момент - последний снимок до него плюс записи архива после снимка
+def snapshot_path(lsn: int) -> Path:
+    return BACKUP_DIR / f"snapshot_{lsn:020d}.txt"
+
+
+def list_snapshots() -> List[tuple]:
+    """Снимки по возрастанию LSN: (LSN, путь)"""
+    return sorted(
+        (int(path.stem.split("_")[1]), path) for path in BACKUP_DIR.glob("snapshot_*.txt")
+    )
+
+
+def list_wal_segments() -> List[tuple]:
+    """Архив журнала по возрастанию LSN: (LSN начала, LSN конца, путь)"""
+    segments = []
+    for path in BACKUP_DIR.glob("wal_*.seg"):
+        _, base_lsn, end_lsn = path.stem.split("_")
+        segments.append((int(base_lsn), int(end_lsn), path))
+    return sorted(segments)
+
+
+def write_durable(path: Path, data: bytes) -> None:
+    temp_path = path.with_suffix(".tmp")
+    with temp_path.open("wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def archive_wal_segment(archive_dir: Path, base_lsn: int, data: bytes) -> None:
+    """Сохранение содержимого журнала перед его очисткой"""
+    if len(data) <= WAL_HEADER.size:
+        return
+    archive_dir.mkdir(exist_ok=True)
+    end_lsn = base_lsn + len(data)
+    write_durable(archive_dir / f"wal_{base_lsn:020d}_{end_lsn:020d}.seg", data)
+
+
+def write_snapshot(source, lsn: int) -> Path:
+    """Полный снимок файла базы, соответствующий журналу до lsn. Вызывается под блокировкой"""
+    BACKUP_DIR.mkdir(exist_ok=True)
+    path = snapshot_path(lsn)
+    temp_path = path.with_suffix(".tmp")
+    shutil.copyfile(source, temp_path)
+    with temp_path.open("rb") as file:
+        os.fsync(file.fileno())
+    size = temp_path.stat().st_size
+    count_io(bytes_read=size, bytes_written=size)
+    os.replace(temp_path, path)
+    prune_backups()
+    logging.info(f"Создан снимок базы: {path}")
+    return path
+
+
+def prune_backups() -> None:
+    """Хранятся BACKUP_KEEP последних снимков и архив журнала, нужный для них"""
+    snapshots = list_snapshots()
+    for _, path in snapshots[:-BACKUP_KEEP]:
+        path.unlink()
+    oldest_lsn = snapshots[-BACKUP_KEEP:][0][0]
+    for _, end_lsn, path in list_wal_segments():
+        if end_lsn <= oldest_lsn:
+            path.unlink()
+
+
+@instrumented("take_snapshot")
+def take_snapshot() -> Path:
+    # Под блокировкой чтения файл не меняется, и в нем применен весь журнал
+    with file_lock(FILENAME, shared=True):
+        return write_snapshot(FILENAME, wal.current_lsn())
+
+
+def backup_worker(interval: float = BACKUP_INTERVAL) -> None:
+    """Фоновый поток резервного копирования: снимок при запуске (если его нет) и по таймеру"""
+    if not list_snapshots():
+        backup_needed.set()
+    while True:
+        backup_needed.wait(interval)
+        backup_needed.clear()
+        try:
+            take_snapshot()
+        except TimeoutError:
+            logging.info("Снимок отложен: файл занят")
+            backup_needed.set()
+            time.sleep(1)
+
+
+def wal_entries_after(lsn: int):
+    """Записи архива и текущего журнала с LSN больше заданного, по порядку"""
+    sources = [path for _, end_lsn, path in list_wal_segments() if end_lsn > lsn]
+    sources.append(WAL_FILENAME)
+    for path in sources:
+        if not Path(path).exists():
+            continue
+        for entry in iter_wal_entries(path):
+            if entry[0] > lsn:
+                yield entry
+
+
+def recover_from_backup(target: datetime = None) -> bool:
+    """
+    Восстановление базы на момент target (по умолчанию - последнее состояние):
+    последний снимок до этого момента и записи журнала после снимка
+    """
+    deadline = target.timestamp() if target else math.inf
+    snapshots = [
+        (lsn, path) for lsn, path in list_snapshots() if path.stat().st_mtime <= deadline
+    ]
+    if not snapshots:
+        return False
+    snapshot_lsn, snapshot = snapshots[-1]
+    temp_filename = Path(f"{FILENAME}.restore")
+    with file_lock(FILENAME):
+        shutil.copyfile(snapshot, temp_filename)
+        applied = 0
+        with temp_filename.open("r+b") as file:
+            for _, timestamp, writes in wal_entries_after(snapshot_lsn):
+                if timestamp > deadline:
+                    break
+                apply_writes(file, writes)
+                applied += 1
+        # Снимок до перевода в формат 2 вместе с журналом после него - в формате 1
+        with temp_filename.open("rb") as file:
+            upgrade = read_header(file)["version"] < FORMAT_VERSION
+        if upgrade:
+            versioned_filename = Path(f"{FILENAME}.migrate")
+            with temp_filename.open("rb") as file, versioned_filename.open("wb") as temp_file:
+                write_versioned_records(file, temp_file)
+            os.replace(versioned_filename, temp_filename)
+        with temp_filename.open("r+b") as file:
+            # Счетчик изменений должен вырасти, иначе кэши процессов не заметят подмену файла
+            live_changes = 0
+            if Path(FILENAME).exists():
+                with open(FILENAME, "rb") as live_file:
+                    live_changes = read_header(live_file)["changes"]
+            header = read_header(file)
+            file.seek(0)
+            file.write(make_header(header["next_id"], max(live_changes, header["changes"]) + 1))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_filename, FILENAME)
+        # Журнал относится к замененному состоянию; новый снимок отделяет
+        # восстановленное состояние от записей архива, которые в него не вошли
+        wal.reset()
+        with open(FILENAME, "r+b") as file:
+            wal.sync(mark_rewrite(file))
+        write_snapshot(FILENAME, wal.current_lsn())
+        rebuild_indexes()
+        save_indexes()
+    logging.info(f"Восстановлено из снимка {snapshot}, применено изменений журнала: {applied}")
+    return True
+
+
+# REPLICATION
+# Основной сервер передает репликам изменения записями журнала. Реплика подключается
+# к порту репликации строкой "REPLICATE <LSN>" ("REPLICATE" - если своего LSN еще нет) и получает:
+#   "WAL <длина>" и записи журнала подряд - изменения после ее LSN;
+#   "SNAPSHOT <LSN> <время> <длина>" и файл базы - если нужных записей уже нет в памяти
+#   или файл был переписан целиком (уплотнение, восстановление из копии);
+#   "PING <LSN> <время>" - раз в REPLICATION_HEARTBEAT секунд без изменений.
+# Время - момент последнего изменения на основном сервере, по нему реплика считает отставание
+class ReplicationFeed:
+    """
+    Последние изменения базы для реплик: (LSN начала, LSN конца, байты записи журнала).
+    Потоки отправки ждут новых изменений на условии
+    """
+
+    def __init__(self, lsn: int, backlog: int = REPLICATION_BACKLOG):
+        self.condition = threading.Condition()
+        self.entries = deque(maxlen=backlog)
+        self.end_lsn = lsn
+        self.commit_time = time.time()
+        # Адрес реплики -> LSN, до которого ей отправлены изменения
+        self.followers = {}
+
+    def start_lsn(self) -> int:
+        """Наименьший LSN, с которого реплику можно догнать записями из памяти"""
+        return self.entries[0][0] if self.entries else self.end_lsn
+
+    def publish(self, writes: List[tuple], lsn: int) -> None:
+        """Новое изменение; вызывается из commit_writes под монопольной блокировкой"""
+        with self.condition:
+            # Контрольная точка пропускает в LSN заголовок очищенного журнала,
+            # поэтому начало записи берется от lsn, а не от конца предыдущей
+            start_lsn = lsn - WAL_ENTRY.size - sum(WAL_WRITE.size + len(data) for _, data in writes)
+            if start_lsn < self.end_lsn:
+                # Лента разошлась с журналом - отставшие реплики получат файл целиком
+                self.restart(lsn)
+                return
+            entry, _ = encode_wal_entry(writes, start_lsn)
+            self.entries.append((start_lsn, lsn, entry))
+            self.end_lsn = lsn
+            self.commit_time = time.time()
+            self.condition.notify_all()
+
+    def restart(self, lsn: int) -> None:
+        """Файл базы переписан целиком: состояние до lsn реплики получат только снимком"""
+        with self.condition:
+            self.entries.clear()
+            self.end_lsn = lsn
+            self.commit_time = time.time()
+            self.condition.notify_all()
+
+    def wait_after(self, lsn: int, timeout: float):
+        """
+        Изменения после lsn, при их отсутствии - ожидание до timeout секунд:
+        (LSN конца, время последнего изменения, байты записей журнала).
+        None, если реплику нельзя догнать записями из памяти
+        """
+        with self.condition:
+            if lsn == self.end_lsn:
+                self.condition.wait(timeout)
+            if not self.start_lsn() <= lsn <= self.end_lsn:
+                return None
+            entries = []
+            for start_lsn, _, entry in reversed(self.entries):
+                if start_lsn < lsn:
+                    break
+                entries.append(entry)
+            return self.end_lsn, self.commit_time, b"".join(reversed(entries))
+
+
+replication_feed = None
+follower = None
+
+
+def mark_rewrite(file) -> int:
+    """
+    Отметка в журнале, что файл базы переписан целиком: LSN растет, и реплики
+    получают новый файл снимком. Вызывается под монопольной блокировкой
+    """
+    if replication_feed is None:
+        return commit_writes(file, [])
+    # Поток отправки не должен успеть передать отметку как обычное изменение
+    with replication_feed.condition:
+        lsn = commit_writes(file, [])
+        replication_feed.restart(lsn)
+    return lsn
+
+
+def send_snapshot(sock) -> int:
+    """Отправка файла базы реплике; возвращает LSN, которому соответствует файл"""
+    temp_filename = Path(f"{FILENAME}.{threading.get_ident()}.send")
+    try:
+        # Копия снимается под блокировкой чтения, а передается уже без нее,
+        # чтобы медленная реплика не задерживала запись
+        with file_lock(FILENAME, shared=True):
+            lsn, commit_time = replication_feed.end_lsn, replication_feed.commit_time
+            shutil.copyfile(FILENAME, temp_filename)
+        wal.sync(lsn)
+        with temp_filename.open("rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            sock.sendall(f"SNAPSHOT {lsn} {commit_time} {size}\n".encode())
+            sock.sendfile(file)
+    finally:
+        temp_filename.unlink(missing_ok=True)
+    return lsn
+
+
+def serve_follower(sock, addr) -> None:
+    """Поток отправки изменений одной реплике"""
+    name = f"{addr[0]}:{addr[1]}"
+    try:
+        with sock, sock.makefile("rb") as reader:
+            sock.settimeout(REPLICATION_TIMEOUT)
+            words = reader.readline(64).decode(errors="replace").split()
+            if not words or words[0] != "REPLICATE" or not all(word.isdigit() for word in words[1:2]):
+                sock.sendall(b"ERR REPLICATE [LSN]\n")
+                return
+            lsn = int(words[1]) if len(words) > 1 else -1
+            logging.info(f"Реплика {name} подключена, LSN {lsn}")
+            while True:
+                replication_feed.followers[name] = lsn
+                batch = replication_feed.wait_after(lsn, REPLICATION_HEARTBEAT)
+                if batch is None:
+                    lsn = send_snapshot(sock)
+                    logging.info(f"Реплике {name} отправлен снимок базы, LSN {lsn}")
+                    continue
+                end_lsn, commit_time, data = batch
+                if data:
+                    # Реплика получает только изменения, уже записанные на диск здесь
+                    wal.sync(end_lsn)
+                    sock.sendall(b"WAL %d\n" % len(data) + data)
+                    lsn = end_lsn
+                else:
+                    sock.sendall(f"PING {end_lsn} {commit_time}\n".encode())
+    except OSError as error:
+        logging.info(f"Реплика {name} отключена: {error}")
+    finally:
+        replication_feed.followers.pop(name, None)
+
+
+def accept_followers(server) -> None:
+    while True:
+        sock, addr = server.accept()
+        threading.Thread(target=serve_follower, args=(sock, addr), daemon=True).start()
+
+
+def start_replication(host: str, port: int) -> None:
+    """Порт репликации основного сервера: отдельный поток на каждую реплику"""
+    global replication_feed
+    replication_feed = ReplicationFeed(wal.current_lsn())
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(LISTEN_BACKLOG)
+    threading.Thread(target=accept_followers, args=(server,), daemon=True).start()
+    print(f"Репликация: изменения передаются репликам на {host}:{port}")
+
+
+def apply_replicated(writes: List[tuple]) -> None:
+    """
+    Применение изменений основного сервера на реплике. Индексы и кэш обновляются по старому
+    и новому содержимому каждой записи, поэтому повторное применение тех же изменений безопасно
+    """
+    global cache_changes, dead_slots
+    old_books = []
+    new_books = []
+    with file_lock(FILENAME), open(FILENAME, "r+b") as file:
+        for offset, data in writes:
+            if offset < RECORD_SIZE:
+                # Заголовок файла
+                apply_writes(file, [(offset, data)])
+                continue
+            for position in range(offset, offset + len(data), RECORD_SIZE):
+                record = data[position - offset:position - offset + RECORD_SIZE]
+                file.seek(position)
+                old_record = file.read(RECORD_SIZE)
+                file.seek(position)
+                file.write(record)
+                if len(old_record) == RECORD_SIZE and not is_deleted(old_record):
+                    old_book = record_to_dict(old_record)
+                    unindex_book(old_book)
+                    old_books.append(old_book)
+                    if is_deleted(record):
+                        dead_slots += 1
+                if not is_deleted(record):
+                    book = record_to_dict(record)
+                    index_book(book, position)
+                    new_books.append(book)
+        file.flush()
+        invalidate_cache(old_books, new_books)
+        cache_changes = read_header(file)["changes"]
+
+
+def install_snapshot(path: Path) -> None:
+    """Замена файла базы реплики снимком основного сервера"""
+    global cache_changes
+    with file_lock(FILENAME):
+        os.replace(path, FILENAME)
+        # Журнал реплики относится к прежнему файлу
+        wal.reset()
+        rebuild_indexes()
+        book_cache.clear()
+        search_cache.clear()
+        with open(FILENAME, "rb") as file:
+            cache_changes = read_header(file)["changes"]
+    save_indexes()
+
+
+def read_exact(reader, size: int) -> bytes:
+    data = reader.read(size)
+    if len(data) < size:
+        raise ConnectionError("основной сервер закрыл соединение")
+    return data
+
+
+class Follower:
+    """
+    Реплика: поток, получающий изменения основного сервера. Примененный LSN хранится
+    в REPLICA_STATE_FILENAME, после перезапуска реплика продолжает с него
+    """
+
+    def __init__(self, host: str, port: int):
+        self.address = (host, port)
+        self.applied_lsn = self.load_state()
+        self.primary_lsn = self.applied_lsn
+        # Время последнего примененного изменения и последнего изменения на основном сервере
+        self.applied_time = None
+        self.primary_time = None
+        self.connected = False
+        self.last_contact = None
+
+    @staticmethod
+    def load_state():
+        try:
+            return int(Path(REPLICA_STATE_FILENAME).read_text())
+        except (OSError, ValueError):
+            return None
+
+    def save_state(self, lsn: int) -> None:
+        # Сначала примененные изменения на диск, затем LSN: после сбоя
+        # реплика повторит часть изменений, но не пропустит их
+        with open(FILENAME, "rb") as file:
+            os.fsync(file.fileno())
+        write_durable(Path(REPLICA_STATE_FILENAME), str(lsn).encode())
+        self.applied_lsn = lsn
+        self.primary_lsn = max(self.primary_lsn or 0, lsn)
+
+    def run(self) -> None:
+        host, port = self.address
+        while True:
+            try:
+                self.follow()
+            except (OSError, ValueError) as error:
+                logging.info(f"Репликация с {host}:{port} прервана: {error}")
+            self.connected = False
+            time.sleep(REPLICATION_RETRY)
+
+    def follow(self) -> None:
+        with socket.create_connection(self.address, timeout=REPLICATION_TIMEOUT) as sock:
+            reader = sock.makefile("rb")
+            handshake = "REPLICATE" if self.applied_lsn is None else f"REPLICATE {self.applied_lsn}"
+            sock.sendall(f"{handshake}\n".encode())
+            self.connected = True
+            logging.info(f"Реплика подключена к {self.address[0]}:{self.address[1]}")
+            while True:
+                line = reader.readline()
+                if not line:
+                    raise ConnectionError("основной сервер закрыл соединение")
+                kind, *args = line.decode().split()
+                self.last_contact = time.time()
+                if kind == "PING":
+                    self.primary_lsn, self.primary_time = int(args[0]), float(args[1])
+                elif kind == "WAL":
+                    self.apply(parse_wal_entries(read_exact(reader, int(args[0]))))
+                elif kind == "SNAPSHOT":
+                    self.install(reader, int(args[0]), float(args[1]), int(args[2]))
+                else:
+                    raise ValueError(f"неизвестное сообщение {line!r}")
+
+    def apply(self, entries: List[tuple]) -> None:
+        if not entries:
+            return
+        apply_replicated([write for _, _, writes in entries for write in writes])
+        lsn, timestamp, _ = entries[-1]
+        self.save_state(lsn)
+        self.applied_time = timestamp
+        self.primary_time = max(self.primary_time or 0, timestamp)
+
+    def install(self, reader, lsn: int, commit_time: float, size: int) -> None:
+        temp_filename = Path(f"{FILENAME}.snapshot")
+        with temp_filename.open("wb") as file:
+            left = size
+            while left:
+                chunk = read_exact(reader, min(left, 1024 * 1024))
+                file.write(chunk)
+                left -= len(chunk)
+            file.flush()
+            os.fsync(file.fileno())
+        install_snapshot(temp_filename)
+        self.save_state(lsn)
+        self.applied_time = commit_time
+        self.primary_time = max(self.primary_time or 0, commit_time)
+        logging.info(f"Получен снимок базы основного сервера: LSN {lsn}, {size} байт")
+
+    def lag(self) -> tuple:
+        """
+        Отставание: (байт журнала, секунд). Секунды - разница времени последнего изменения
+        на основном сервере и последнего примененного
+        """
+        if self.applied_lsn is None:
+            return None, None
+        lag_bytes = max(0, self.primary_lsn - self.applied_lsn)
+        if lag_bytes == 0 or self.primary_time is None or self.applied_time is None:
+            return lag_bytes, 0.0
+        return lag_bytes, max(0.0, self.primary_time - self.applied_time)
+
+    def report(self) -> List[str]:
+        host, port = self.address
+        lines = [f"Основной сервер: {host}:{port} ({'подключен' if self.connected else 'нет связи'})"]
+        if self.applied_lsn is None:
+            return lines + ["Снимок базы еще не получен"]
+        lag_bytes, lag_seconds = self.lag()
+        lines += [
+            f"Применено до LSN: {self.applied_lsn}",
+            f"LSN основного сервера: {self.primary_lsn}",
+            f"Отставание: {lag_bytes} байт журнала, {lag_seconds:.1f} с",
+        ]
+        if not self.connected and self.last_contact is not None:
+            lines.append(f"Последняя связь: {time.time() - self.last_contact:.0f} с назад")
+        return lines
+
+
+def replication_report() -> List[str]:
+    """Состояние репликации (команда протокола LAG)"""
+    if follower is not None:
+        return follower.report()
+    if replication_feed is None:
+        return ["Репликация не настроена"]
+    end_lsn = replication_feed.end_lsn
+    followers = replication_feed.followers.copy()
+    lines = [f"LSN основного сервера: {end_lsn}", f"Реплик подключено: {len(followers)}"]
+    for name, lsn in sorted(followers.items()):
+        if lsn < 0:
+            lines.append(f"{name}: получает снимок базы")
+        else:
+            lines.append(f"{name}: отправлено до LSN {lsn}, отставание {end_lsn - lsn} байт")
+    return lines
+
+
+def check_writable() -> None:
+    """Реплика только читает: изменения выполняются на основном сервере"""
+    if follower is not None:
+        raise ValueError(
+            "Сервер - реплика только для чтения, "
+            f"изменения выполняются на основном сервере {follower.address[0]}"
+        )
+
+
+def authors_set():
+    authors = set()
+    while len(authors) < 100:
+        # Faker добавляет к части имен обращения вроде "тов." и "г-жа", которые не проходят проверку
+        name = fake.name()
+        if SCHEMA["authors"].fullmatch(name):
+            authors.add(name)
+    return authors
+
+
+# SINGLE BOOK
+def generate_valid_book(authors_list, genres_list) -> dict:
+    name = fake.sentence(nb_words=random.randint(1, 5)).rstrip(".")
+    authors = ",".join(random.sample(authors_list, k=random.randint(1, 3)))
+    genres = ",".join(random.sample(genres_list, k=random.randint(1, 4)))
+    year = str(random.randint(1500, 2025))
+    width = round(random.uniform(10.0, 200.0), 1)
+    height = round(random.uniform(10.0, 200.0), 1)
+    book_type = random.choice(["мягкий", "твердый"])
+    source = random.choice(["покупка", "подарок", "наследство"])
+    # Даты выбираются сразу в допустимых границах (после начала года издания,
+    # не позже сегодняшнего дня), поэтому проверка с повторами не нужна
+    today = date.today().toordinal()
+    date_added = date.fromordinal(random.randint(date(int(year), 1, 1).toordinal(), today))
+    date_read = date.fromordinal(random.randint(date_added.toordinal(), today))
+    date_added = date_added.strftime("%d-%m-%Y")
+    date_read = date_read.strftime("%d-%m-%Y")
+    # rating
+    rating_value = random.randint(1, 10)
+    description = fake.sentence(nb_words=random.randint(3, 10), variable_nb_words=True)
+    rating = f"{rating_value}/10 - {description}"
+    return {
+        "name": name,
+        "authors": authors,
+        "genres": genres,
+        "year": year,
+        "width": width,
+        "height": height,
+        "book_type": book_type,
+        "source": source,
+        "date_added": date_added,
+        "date_read": date_read,
+        "rating": rating,
+    }
+
+
+def generate_books(count: int) -> List[dict]:
+    return [generate_valid_book(authors_list, genres_list) for _ in range(count)]
+
+
+def get_next_id(file) -> int:
+    """
+    Следующий свободный ID из счетчика в заголовке файла. Вызывается под блокировкой;
+    заголовок с увеличенным счетчиком записывается вместе с новыми книгами
+    """
+    return read_header(file)["next_id"]
+
+
+def is_unique_book(book: dict) -> bool:
+    """Проверка на уникальность книги по индексу уникальности"""
+    return not unique_index.get(unique_key(book))
+
+
+@instrumented("add_book")
+def add_book(book: dict):
+    """ Операция добавление книги - добавление ID + проверка на уникальность"""
+    try:
+        # Проверяем, что поля помещаются в запись, до захвата блокировки
+        dict_to_record({**book, "id": 0})
+    except ValueError as error:
+        return f"Ошибка: {error}"
+    try:
+        with file_lock(FILENAME):
+            if not is_unique_book(book):
+                res = f"Книга уже добавлена: {book['name']}, написанная {book['authors']}"
+                return res
+            with open(FILENAME, ("r+b")) as file:
+                inject_fault("add_book")
+                book_id = get_next_id(file)
+                book["id"] = book_id
+                offset = file.seek(0, os.SEEK_END)
+                lsn = commit_writes(file, [(offset, dict_to_record(book))], next_id=book_id + 1)
+            index_book(book, offset)
+            invalidate_cache([], [book])
+        wal.sync(lsn)
+        res = f"Добавлена книга: {book['name']} (ID: {book_id})"
+        return res
+    except TimeoutError:
+        return "Ошибка: не удалось выполнить обновление - система занята, попробуйте позже"
+
+
+# MULTIPLE BOOKS
+@instrumented("add_books")
+def add_books(books: List[dict], invalid: Dict[int, ValueError] = None) -> str:
+    """
+    Пакетное добавление: проверка всех книг, отсев дубликатов по индексу
+    и запись всех новых книг одной операцией под одной блокировкой.
+    invalid - ошибки, найденные до вызова (номер книги в пакете с 0 -> ошибка),
+    на месте таких книг в books может стоять None
+    """
+    valid_books = []
+    errors = []
+    invalid = dict(invalid or {})
+    checked = [number for number in range(len(books)) if number not in invalid]
+    for position, error in validate_books([books[number] for number in checked]).items():
+        invalid[checked[position]] = error
+    for number, book in enumerate(books):
+        try:
+            if number in invalid:
+                raise invalid[number]
+            dict_to_record({**book, "id": 0})
+        except ValueError as error:
+            errors.append(f"Книга {number + 1}: {error}\n")
+        else:
+            valid_books.append(book)
+
+    new_books = []
+    duplicates = 0
+    lsn = 0
+    try:
+        with file_lock(FILENAME):
+            keys = set()
+            for book in valid_books:
+                key = unique_key(book)
+                if key in keys or unique_index.get(key):
+                    duplicates += 1
+                    continue
+                keys.add(key)
+                new_books.append(book)
+            if new_books:
+                with open(FILENAME, "r+b") as file:
+                    inject_fault("add_books")
+                    first_id = get_next_id(file)
+                    for book_id, book in enumerate(new_books, start=first_id):
+                        book["id"] = book_id
+                    offset = file.seek(0, os.SEEK_END)
+                    records = b"".join(dict_to_record(book) for book in new_books)
+                    lsn = commit_writes(
+                        file, [(offset, records)], next_id=first_id + len(new_books)
+                    )
+                keep_sorted = len(new_books) < RANGE_INDEX_SORT_BATCH
+                for i, book in enumerate(new_books):
+                    index_book(book, offset + i * RECORD_SIZE, keep_sorted)
+                if not keep_sorted:
+                    sort_range_indexes()
+                invalidate_cache([], new_books)
+        wal.sync(lsn)
+    except TimeoutError:
+        return "Ошибка: не удалось выполнить обновление - система занята, попробуйте позже"
+
+    res = f"Добавлено книг: {len(new_books)}, дубликатов: {duplicates}, с ошибками: {len(errors)}\n"
+    return res + "".join(errors)
+
+
+@instrumented("modify_books_file")
+def modify_books_file(new_books: List[dict] = None, update=False) -> str:
+    """
+    Редактируем файл базы данных для операций удаления и редактирования.
+    Обновление перезаписывает запись на месте, удаление помечает запись байтом RECORD_DELETED.
+    Все изменения попадают в журнал одной записью, поэтому после сбоя они восстанавливаются вместе.
+    Книга с полем version (прочитанная ранее поиском) изменяется, только если ее версия
+    в файле та же; иначе изменение не применяется и попадает в ответ как конфликт
+    """
+    global dead_slots
+    res = ""
+    conflicts = ""
+    lsn = 0
+    original_filename = Path(FILENAME)
+    try:
+        with file_lock(original_filename):
+            with original_filename.open("r+b") as file:
+                inject_fault("modify_books_file")
+                # Находим записи изменяемых книг по индексу, без чтения всего файла
+                changes = []
+                for new_book in new_books:
+                    offset = id_index.get(int(new_book["id"]))
+                    old_book = None if offset is None else read_book_at(file, offset)
+                    if old_book is None:
+                        if "version" in new_book:
+                            conflicts += (
+                                f"Конфликт: книга {new_book['name']} (ID: {new_book['id']}) "
+                                "удалена после поиска\n"
+                            )
+                        continue
+                    if int(new_book.get("version", old_book["version"])) != old_book["version"]:
+                        conflicts += (
+                            f"Конфликт: книга {old_book['name']} (ID: {old_book['id']}) изменена "
+                            "после поиска, изменение не применено\n"
+                        )
+                        continue
+                    if update:
+                        # Обновляем поля книги
+                        book = {**old_book, **new_book, "version": old_book["version"] + 1}
+                        try:
+                            changes.append((offset, old_book, book, dict_to_record(book)))
+                        except ValueError as error:
+                            return f"Ошибка: {error}"
+                    else:
+                        changes.append((offset, old_book, old_book, RECORD_DELETED))
+
+                if changes:
+                    lsn = commit_writes(file, [(offset, data) for offset, _, _, data in changes])
+                for offset, old_book, book, data in changes:
+                    unindex_book(old_book)
+                    if update:
+                        index_book(book, offset)
+                        res += f"Обновлена книга: {book['name']} (ID: {book['id']})\n"
+                    else:
+                        dead_slots += 1
+                        res += f"Удалена книга: {book['name']} (ID: {book['id']})\n"
+                invalidate_cache(
+                    [old_book for _, old_book, _, _ in changes],
+                    [book for _, _, book, _ in changes] if update else [],
+                )
+
+        wal.sync(lsn)
+        if needs_compaction():
+            compaction_needed.set()
+        return res + conflicts
+    except TimeoutError:
+        return "Ошибка: не удалось выполнить обновление - система занята, попробуйте позже"
+
+
+# SESSION
+# Действия, которые сеанс клиента (генератор) отдает драйверу соединения
+RECV = object()
+SwitchToProtocol = namedtuple("SwitchToProtocol", ["buffer"])
+# Вывод порциями: драйвер отправляет каждую строку из chunks, как только она готова
+Stream = namedtuple("Stream", ["chunks"])
+
+
+class Call:
+    """Блокирующая операция с файлом: драйвер выполняет ее сам или в пуле потоков"""
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+
+def search_books_to_change(field: str, value: str):
+    """
+    Поиск книг для изменения из меню: None, если файл занят. Драйвер выполняет Call
+    вне сеанса, поэтому TimeoutError до генератора не дошел бы и оборвал соединение
+    """
+    try:
+        return search_books(field, value)
+    except TimeoutError:
+        return None
+
+
+def update_books(field: str, value: str, new_field, new_value) -> Generator:
+    """
+    Обновление поля в строке (часть сеанса клиента, см. client_session).
+    Книги отбираются поиском по полю или составным запросом (field == QUERY_FIELD)
+    """
+    books = yield Call(search_books_to_change, field, value)
+    if books is None:
+        return "Ошибка: не удалось выполнить поиск - система занята, попробуйте позже\n"
+    for book in books:
+        book[new_field] = new_value
+    # Новое значение проверяется вместе с остальными полями каждой книги (например,
+    # дата добавления - с годом издания)
+    errors = validate_books(books)
+    if errors:
+        return "".join(
+            f"Книга {books[number]['id']}: {error}\n" for number, error in errors.items()
+        )
+    results = "Обновленные книги:\n"
+    results += print_books(books)
+    if not books:
+        return ""
+    yield str(results)
+
+
+    yield "Обновить? (д/н): "
+    choice = (yield RECV).decode().strip().lower()
+    while choice not in ("д", "н", "y", "n"):
+        yield "Некорректный ввод\n"
+        yield "Обновить? (д/н): "
+        choice = (yield RECV).decode().strip().lower()
+    if choice == "д" or choice == "y":
+        return (yield Call(modify_books_file, books, True))
+    return ""
+
+
+def delete_books(field: str, value: str) -> Generator:
+    """
+    Проходит по файлу, ищет в поле field совпадения с value
+    (или книги составного запроса value, если field == QUERY_FIELD).
+    Найденные записи после подтверждения помечаются удаленными,
+    место освобождает фоновое уплотнение.
+    """
+    books = yield Call(search_books_to_change, field, value)
+    if books is None:
+        return "Ошибка: не удалось выполнить поиск - система занята, попробуйте позже\n"
+    results = "Найденные книги:\n"
+    results += print_books(books)
+    yield str(results)
+    if not books:
+        return ""
+    yield "Удалить? (д/н): \n"
+    choice = (yield RECV).decode().strip().lower()
+    while choice not in ("д", "н", "y", "n"):
+        yield "Некорректный ввод\n"
+        yield "Удалить? (д/н): "
+        choice = (yield RECV).decode().strip().lower()
+    if choice == "д" or choice == "y":
+        return (yield Call(modify_books_file, books))
+    return ""
+
+
+def format_book(book: dict) -> str:
+    res = f"ID: {book['id']},\n" if "id" in book else ""
+    return res + (
+        f"\tНазвание: {book['name']},\n"
+        f"\tАвторы: {book['authors']},\n"
+        f"\tГод: {book['year']},\n"
+        f"\tЖанры: {book['genres']},\n"
+        f"\tШирина: {book['width']},\n"
+        f"\tВысота: {book['height']},\n"
+        f"\tТип книги: {book['book_type']},\n"
+        f"\tИсточник: {book['source']},\n"
+        f"\tДата добавления: {book['date_added']},\n"
+        f"\tДата прочтения: {book['date_read']},\n"
+        f"\tРейтинг: {book['rating']}\n"
+    )
+
+
+@instrumented("iter_all_books")
+def iter_all_books(offset: int = 0, limit: int = None) -> Generator:
+    """
+    Книги порциями по STREAM_CHUNK_RECORDS. Блокировка на чтение берется на каждую порцию,
+    а следующая порция ищется по id последней книги, поэтому медленный клиент
+    не задерживает запись, а уплотнение между порциями не сбивает вывод
+    """
+    last_id = 0
+    left = math.inf if limit is None else limit
+    while left > 0:
+        chunk = []
+        with file_lock(FILENAME, shared=True), open(FILENAME, "rb") as file:
+            for _, record in iter_records(file, start=find_record_after(file, last_id)):
+                last_id = record_id(record)
+                if is_deleted(record):
+                    continue
+                if offset > 0:
+                    offset -= 1
+                    continue
+                chunk.append(record_to_dict(record))
+                if len(chunk) >= min(left, STREAM_CHUNK_RECORDS):
+                    break
+        if not chunk:
+            return
+        left -= len(chunk)
+        yield chunk
+
+
+@instrumented("iter_found_books")
+def iter_found_books(field: str, value: str, offset: int = 0, limit: int = None) -> Generator:
+    """
+    Результаты поиска порциями по STREAM_CHUNK_RECORDS. Небольшой результат берется
+    из кэша целиком; для большого под блокировкой запоминаются только id нужной страницы,
+    книги читаются по ним уже при выводе
+    """
+    stop = None if limit is None else offset + limit
+    with file_lock(FILENAME, shared=True):
+        inject_fault("search_books")
+        books = find_books_cached(field, value)
+        if books is None:
+            ids = [
+                int(book["id"])
+                for book in itertools.islice(iter_search_books(field, value), offset, stop)
+            ]
+    if books is not None:
+        books = books[offset:stop]
+        for start in range(0, len(books), STREAM_CHUNK_RECORDS):
+            yield [dict(book) for book in books[start:start + STREAM_CHUNK_RECORDS]]
+        return
+    for start in range(0, len(ids), STREAM_CHUNK_RECORDS):
+        with file_lock(FILENAME, shared=True):
+            chunk = read_books(ids[start:start + STREAM_CHUNK_RECORDS])
+        if chunk:
+            yield chunk
+
+
+@instrumented("print_all_books")
+def print_all_books(offset: int = 0, limit: int = None) -> Generator:
+    """ Вывести книги: текст порциями для отправки клиенту"""
+    try:
+        for chunk in iter_all_books(offset, limit):
+            yield "".join(format_book(book) for book in chunk)
+    except TimeoutError:
+        yield "Ошибка: не удалось прочитать книги - система занята, попробуйте позже\n"
+
+
+@instrumented("print_found_books")
+def print_found_books(field: str, value: str, offset: int = 0, limit: int = None) -> Generator:
+    """ Вывести результаты поиска порциями"""
+    count = 0
+    try:
+        for chunk in iter_found_books(field, value, offset, limit):
+            count += len(chunk)
+            yield "".join(format_book(book) for book in chunk)
+    except TimeoutError:
+        yield "Ошибка: не удалось выполнить поиск - система занята, попробуйте позже\n"
+        return
+    yield f"Отображено {count} книг(и).\n" if count else "Нет книг для отображения.\n"
+
+
+def print_books(books: List[dict]) -> str:
+    """ Вывести книгу"""
+    if not books:
+        res = "Нет книг для отображения.\n"
+        return res
+    res = f"Отображено {len(books)} книг(и):\n"
+    return res + "".join(format_book(book) for book in books)
+
+
+@instrumented("search_books")
+def search_books(field: str, value: str) -> List[dict]:
+    """
+    Ищет в поле field совпадения c value, возвращает список словарей книг
+    """
+    with file_lock(FILENAME, shared=True):
+        inject_fault("search_books")
+        books = find_books_cached(field, value)
+        if books is None:
+            return list(iter_search_books(field, value))
+        # Копии: вызывающий код может менять книги, а кэш должен остаться прежним
+        return [dict(book) for book in books]
+
+
+def iter_search_books(field: str, value: str):
+    """
+    Книги, у которых поле field совпадает с value, или книги составного запроса value
+    для field == QUERY_FIELD. Вызывается под блокировкой
+    """
+    if field == QUERY_FIELD:
+        yield from iter_query_books(parse_query(value))
+        return
+    if COLUMN_TABLE_ENABLED:
+        yield from column_table.search(field, value)
+        return
+    if field == "id":
+        offset = id_index.get(int(value)) if str(value).isdigit() else None
+        if offset is None:
+            return
+        with open(FILENAME, "rb") as file:
+            book = read_book_at(file, offset)
+        # Индексы сверяются с файлом при захвате блокировки, проверка id - страховка
+        if book is not None and book["id"] == str(int(value)):
+            yield book
+        return
+
+    if field in range_indexes:
+        try:
+            bounds = parse_range(field, str(value))
+        except ValueError:
+            return
+        if bounds is not None:
+            yield from iter_read_books(range_ids(field, *bounds))
+            return
+        if field not in DATE_FIELDS:
+            # Точное совпадение: кандидаты из индекса, сравнение - по строке, как раньше
+            try:
+                key = range_key(field, str(value))
+            except ValueError:
+                return
+            books = iter_read_books(range_ids(field, key, True, key, True))
+            yield from (book for book in books if book[field] == value)
+            return
+
+    if field in text_indexes and TEXT_INDEXES_ENABLED and len(str(value)) >= 3:
+        value = str(value).lower()
+        candidates = iter_read_books(text_candidates(field, value))
+        yield from (book for book in candidates if value in book[field].lower())
+        return
+
+    with open(FILENAME, "rb") as file:
+        if field in ["year", "width", "height"]:
+            yield from (book for book in scan_books(file, field, value) if book[field] == value)
+        else:
+            yield from scan_books(file, field, value)
+
+
+# QUERIES
+# Составной запрос: условия "поле оператор значение", соединенные AND и OR (AND связывает
+# сильнее). Операторы: ~ - как поиск по одному полю, = - точное совпадение,
+# >=, >, <=, < - сравнение для полей RANGE_FIELDS. Значение с пробелами вокруг and/or
+# берется в кавычки: name~"мир and война"
+QUERY_FIELD = "query"
+QUERY_TERM = re.compile(
+    r'\s*(?P<field>[a-z_]+)\s*(?P<op>>=|<=|~|=|>|<)\s*(?:"(?P<quoted>[^"]*)"|(?P<value>.*?))'
+    r"(?:\s+(?P<conj>and|or)\s+|\s*$)",
+    re.IGNORECASE,
+)
+# Условие запроса: поле, значение поиска по одному полю (как в iter_search_books)
+# и признак точного совпадения для текстовых полей
+Predicate = namedtuple("Predicate", ["field", "search", "exact"])
+
+
+def make_predicate(field: str, op: str, value: str) -> Predicate:
+    if field not in HEADERS:
+        raise ValueError(f"Неизвестное поле {field}")
+    value = value.strip()
+    if not value:
+        raise ValueError(f"Пустое значение для поля {field}")
+    if op == "~":
+        return Predicate(field, value, False)
+    if field in RANGE_FIELDS:
+        try:
+            range_key(field, value)
+        except ValueError:
+            raise ValueError(f"Неверное значение {value} для поля {field}") from None
+    if op == "=":
+        if field in DATE_FIELDS:
+            return Predicate(field, f"{value}..{value}", False)
+        return Predicate(field, value, field not in RANGE_FIELDS and field != "id")
+    if field not in RANGE_FIELDS:
+        raise ValueError(f"Сравнение {op} возможно только для полей {', '.join(RANGE_FIELDS)}")
+    return Predicate(field, op + value, False)
+
+
+@functools.lru_cache(maxsize=SEARCH_CACHE_SIZE)
+def parse_query(text: str) -> tuple:
+    """Разбор запроса: кортеж групп, соединенных OR; группа - кортеж условий, соединенных AND"""
+    text = text.strip()
+    groups, group = [], []
+    pos = 0
+    while True:
+        match = QUERY_TERM.match(text, pos)
+        if match is None:
+            raise ValueError(f"Ожидается условие вида поле~значение, а не {text[pos:]!r}")
+        value = match["quoted"] if match["quoted"] is not None else match["value"]
+        group.append(make_predicate(match["field"].lower(), match["op"], value))
+        pos = match.end()
+        conj = (match["conj"] or "").lower()
+        if conj != "and":
+            groups.append(tuple(group))
+            group = []
+        if not conj:
+            return tuple(groups)
+
+
+def predicate_matches(predicate: Predicate, book: dict) -> bool:
+    if not book_matches(book, predicate.field, predicate.search):
+        return False
+    return not predicate.exact or str(book[predicate.field]).lower() == predicate.search.lower()
+
+
+def query_matches(query: tuple, book: dict) -> bool:
+    return any(all(predicate_matches(predicate, book) for predicate in group) for group in query)
+
+
+def estimate_matches(predicate: Predicate) -> int:
+    """Оценка числа книг, которые прочитает поиск по условию; без индекса - все книги"""
+    field, value = predicate.field, predicate.search
+    if field == "id":
+        return 1
+    if field in range_indexes:
+        try:
+            bounds = parse_range(field, value)
+            if bounds is None and field not in DATE_FIELDS:
+                key = range_key(field, value)
+                bounds = key, True, key, True
+        except ValueError:
+            return 0
+        if bounds is not None:
+            part = range_slice(field, *bounds)
+            return part.stop - part.start
+    if field in text_indexes and TEXT_INDEXES_ENABLED and len(value) >= 3:
+        # Кандидатов не больше, чем книг с самой редкой триграммой запроса
+        index = text_indexes[field]
+        return min(len(index.get(gram, ())) for gram in trigrams(value))
+    return len(id_index)
+
+
+def iter_group_books(group: tuple):
+    """
+    Книги группы условий AND: кандидаты дает поиск по самому избирательному условию,
+    остальные условия проверяются за один проход по кандидатам
+    """
+    best = min(group, key=estimate_matches)
+    checks = [predicate for predicate in group if predicate is not best or predicate.exact]
+    for book in iter_search_books(best.field, best.search):
+        if all(predicate_matches(predicate, book) for predicate in checks):
+            yield book
+
+
+def iter_query_books(query: tuple):
+    """Книги, подходящие под составной запрос, в порядке id. Вызывается под блокировкой"""
+    if len(query) == 1:
+        yield from iter_group_books(query[0])
+        return
+    last_id = None
+    groups = heapq.merge(*map(iter_group_books, query), key=lambda book: int(book["id"]))
+    for book in groups:
+        if book["id"] != last_id:
+            last_id = book["id"]
+            yield book
+
+
+# AGGREGATES
+# Сводки по книгам на сервере: число книг и средняя оценка (число N из "N/10 - ..."),
+# всего или по группам. У authors и genres книга входит в группу каждого автора и жанра,
+# read_month - месяц прочтения ГГГГ-ММ из date_read
+AGGREGATE_GROUPS = ["genres", "authors", "year", "source", "book_type", "read_month"]
+RATING_PATTERN = re.compile(r"\s*(\d+)/")
+# Для оценки из файла читаются только первые байты поля rating ("7/1", "10/")
+RATING_PREFIX = 3
+
+
+def group_source(group: str) -> str:
+    return "date_read" if group == "read_month" else group
+
+
+def group_keys(group: str, value: str) -> list:
+    """Группы, в которые входит книга со значением value поля группировки"""
+    if group in LIST_FIELDS:
+        return [item.strip() for item in value.split(",") if item.strip()]
+    if group == "read_month":
+        # DD-MM-YYYY -> YYYY-MM без strptime: на миллионе книг разбор даты заметен
+        if len(value) != 10 or value[2] != "-" or value[5] != "-":
+            return []
+        return [f"{value[6:]}-{value[3:5]}"]
+    return [value] if value else []
+
+
+def count_aggregate_values(fields: List[str], query: str = None) -> Counter:
+    """
+    Число книг для каждого сочетания значений полей сводки: по найденным по запросу книгам,
+    по таблице по столбцам или одним проходом по файлу без сборки словарей.
+    Вызывается под блокировкой
+    """
+    if query is not None:
+        books = iter_search_books(QUERY_FIELD, query)
+        return Counter(tuple(str(book[field]) for field in fields) for book in books)
+    if COLUMN_TABLE_ENABLED:
+        rows = column_table.rows_where()
+        return Counter(tuple(column_table.value(field, row) for field in fields) for row in rows)
+    with open(FILENAME, "rb") as file:
+        return count_field_values(file, fields, {"rating": RATING_PREFIX})
+
+
+def aggregate_books(group: str = None, query: str = None, rating: bool = True) -> dict:
+    """
+    Группа (None без группировки) -> [число книг, сумма оценок, число книг с оценкой].
+    Вызывается под блокировкой
+    """
+    fields = ([group_source(group)] if group else []) + (["rating"] if rating else [])
+    totals = {}
+    for values, count in count_aggregate_values(fields, query).items():
+        score = None
+        if rating:
+            match = RATING_PATTERN.match(values[-1])
+            score = int(match[1]) if match else None
+        for key in group_keys(group, values[0]) if group else [None]:
+            entry = totals.get(key)
+            if entry is None:
+                entry = totals[key] = [0, 0, 0]
+            entry[0] += count
+            if score is not None:
+                entry[1] += score * count
+                entry[2] += count
+    return totals
+
+
+def count_books(group: str = None, query: str = None) -> dict:
+    """Группа -> число книг; без условия число и годы берутся из индексов. Вызывается под блокировкой"""
+    if query is None and group is None:
+        return {None: len(id_index)}
+    if query is None and group == "year":
+        return {
+            str(int(key)): sum(1 for _ in entries)
+            for key, entries in itertools.groupby(range_indexes["year"], key=operator.itemgetter(0))
+        }
+    totals = aggregate_books(group, query, rating=False)
+    return {key: entry[0] for key, entry in totals.items()}
+
+
+def average_rating(group: str = None, query: str = None) -> dict:
+    """Группа -> (средняя оценка, число книг с оценкой). Вызывается под блокировкой"""
+    return {
+        key: (entry[1] / entry[2], entry[2])
+        for key, entry in aggregate_books(group, query).items()
+        if entry[2]
+    }
+
+
+@instrumented("summary_lines")
+def summary_lines(function: str, group: str = None, query: str = None) -> List[str]:
+    """Строки сводки "группа|число книг" (count) или "группа|средняя оценка|число книг" (avg)"""
+    if group is not None and group not in AGGREGATE_GROUPS:
+        raise ValueError(f"Группировка возможна по полям {', '.join(AGGREGATE_GROUPS)}")
+    if query is not None:
+        parse_query(query)
+    with file_lock(FILENAME, shared=True):
+        if function == "count":
+            rows = {key: [count] for key, count in count_books(group, query).items()}
+        else:
+            rows = {key: [f"{avg:.2f}", rated] for key, (avg, rated) in average_rating(group, query).items()}
+    if group is None:
+        return ["|".join(map(str, rows.get(None, [0] if function == "count" else ["-", 0])))]
+    return ["|".join(map(str, [key, *rows[key]])) for key in sorted(rows)]
+
+
+def parse_page(text: str):
+    """Номер страницы меню -> (offset, limit); пустой ввод - все книги"""
+    text = text.strip()
+    if not text:
+        return 0, None
+    if not text.isdigit() or int(text) < 1:
+        raise ValueError("Номер страницы - целое число от 1")
+    return (int(text) - 1) * PAGE_SIZE, PAGE_SIZE
+
+
+def search_prompt(field: str) -> str:
+    if field in RANGE_FIELDS:
+        return (
+            "Введите поисковый запрос "
+            "(значение или диапазон: 1900..1950, >=1900, <1950, after 01-01-2023): "
+        )
+    return "Введите поисковый запрос: "
+
+
+def search_condition() -> Generator:
+    """Условие поиска из меню -> (поле, значение); вместо поля можно ввести составной запрос"""
+    while True:
+        yield (
+            "Введите поле для поиска (id/name/authors/genres/year/width/height/book_type/source/"
+            "date_added/date_read/rating) или запрос (authors~толстой AND year>=1860): "
+        )
+        text = (yield RECV).decode().strip().lower()
+        if text in HEADERS:
+            break
+        if not QUERY_TERM.match(text):
+            yield "Некорректный ввод!\n"
+            continue
+        try:
+            parse_query(text)
+        except ValueError as error:
+            yield f"Неверный запрос: {error}\n"
+            continue
+        return QUERY_FIELD, text
+    yield search_prompt(text)
+    return text, (yield RECV).decode().strip().lower()
+
+
+def display_menu():
+    return (
         "\n--- Меню Библиотеки ---\n"
         "1. Добавить книгу\n"
         "2. Показать все книги\n"
@@ -554,6 +3411,7 @@ def display_menu():
         "4. Обновить книгу\n"
         "5. Удалить книгу\n"
         "6. Выход\n"
+        "7. Сводка по книгам\n"
     )
 
 
@@ -563,438 +3421,892 @@ def display_add_menu():
         "1.1. Сгенерировать книгу\n"
         "1.2. Ввести книгу вручную\n"
         "1.3. Выход\n"
+        "1.4. Сгенерировать несколько книг\n"
     )
 
 authors_list = list(authors_set())
 
 
-def handle_client(client_socket, addr):
-    """ Меню ввода команд"""
+def print_summary(function: str, group: str = None, query: str = None) -> str:
+    """ Вывести сводку по книгам (пункт 7 меню)"""
     try:
-        print(f"Подключен клиент {addr}")
-        client_socket.sendall(library.encode())
-        client_socket.sendall("Добро пожаловать в библиотеку!\n".encode())
-        while True:
-            client_socket.send(display_menu().encode())
-            choice = client_socket.recv(1024).decode().strip()
+        lines = summary_lines(function, group, query)
+    except ValueError as error:
+        return f"Неверный ввод: {error}\n"
+    except TimeoutError:
+        return "Ошибка: не удалось составить сводку - система занята, попробуйте позже\n"
+    header = "число книг" if function == "count" else "средняя оценка|книг с оценкой"
+    return "".join(f"{line}\n" for line in [f"{group}|{header}" if group else header, *lines])
 
-            if choice == "1":
-                while True:
-                    client_socket.send(display_add_menu().encode())
-                    choice_add = client_socket.recv(1024).decode().strip()
-                    if choice_add == "1.1" or choice_add == "1" or choice_add == "1.1.":
-                        book = generate_valid_book(authors_list, genres_list)
-                        client_socket.send(print_books([book]).encode())
-                        client_socket.send("Добавить? (д/н): \n".encode())
-                        choice = client_socket.recv(1024).decode().strip().lower()
-                        while choice not in ("д", "н", "y", "n"):
-                            client_socket.send("Некорректный ввод!\n".encode())
-                            client_socket.send("Добавить? (д/н): \n".encode())
-                            choice = client_socket.recv(1024).decode().strip()
-                        if choice == "д" or choice == "y":
-                            logging.info(f"Добавление книги {book['name']} начато клиентом {addr}")
-                            response = add_book(book)
-                            logging.info(f"Добавление книги {book['name']} завершено клиентом {addr}")
-                            client_socket.send(response.encode())
-                            break
-                    elif choice_add == "1.2" or choice_add == "2" or choice_add == "1.2.":
-                        while True:
-                            try:
-                                client_socket.send("Введите название книги: ".encode())
-                                name = client_socket.recv(1024).decode().strip()
-                                validate_regex("name", name)
-                                break
-                            except ValueError as error:
-                                client_socket.send(f"Неверный ввод: {error}\n".encode())
-                        # authors
-                        while True:
-                            try:
-                                client_socket.send(
-                                    "Введите авторов (через запятую): ".encode()
-                                )
-                                authors = client_socket.recv(1024).decode().strip()
-                                validate_regex("authors", authors)
-                                break
-                            except ValueError as error:
-                                client_socket.send(f"Неверный ввод: {error}\n".encode())
-                        # genres
-                        while True:
-                            try:
-                                client_socket.send(
-                                    "Введите жанр (через запятую): ".encode()
-                                )
-                                genres = client_socket.recv(1024).decode().strip()
-                                validate_regex("genres", genres)
-                                break
-                            except ValueError as error:
-                                client_socket.send(f"Неверный ввод: {error}\n".encode())
-                        # year
-                        while True:
-                            try:
-                                client_socket.send("Введите год издания: ".encode())
-                                year = client_socket.recv(1024).decode().strip()
-                                validate_year(year)
-                                break
-                            except ValueError as error:
-                                client_socket.send(f"Неверный ввод: {error}\n".encode())
-                        # width
-                        while True:
-                            try:
-                                client_socket.send("Введите ширину книги (мм): ".encode())
-                                width = client_socket.recv(1024).decode().strip()
-                                validate_width(width)
-                                break
-                            except ValueError as error:
-                                client_socket.send(f"Неверный ввод: {error}\n".encode())
-                        # height
-                        while True:
-                            try:
-                                client_socket.send("Введите высоту книги (мм): ".encode())
-                                height = client_socket.recv(1024).decode().strip()
-                                validate_height(height)
-                                break
-                            except ValueError as error:
-                                client_socket.send(f"Неверный ввод: {error}\n".encode())
-                        # book_type
-                        while True:
-                            try:
-                                client_socket.send(
-                                    "Введите тип обложки (мягкий/твердый): ".encode()
-                                )
-                                book_type = client_socket.recv(1024).decode().strip()
-                                validate_regex("book_type", book_type)
-                                break
-                            except ValueError as error:
-                                client_socket.send(f"Неверный ввод: {error}\n".encode())
-                        # source
-                        while True:
-                            try:
-                                client_socket.send(
-                                    "Введите источник (покупка/подарок/наследство): ".encode()
-                                )
-                                source = client_socket.recv(1024).decode().strip()
-                                validate_regex("source", source)
-                                break
-                            except ValueError as error:
-                                client_socket.send(f"Неверный ввод: {error}\n".encode())
-                        # date_added
-                        while True:
-                            try:
-                                client_socket.send(
-                                    "Введите дату добавления (DD-MM-YYYY): ".encode()
-                                )
-                                date_added = client_socket.recv(1024).decode().strip()
-                                validate_date_added(date_added, year)
-                                break
-                            except ValueError as error:
-                                client_socket.send(f"Неверный ввод: {error}\n".encode())
-                        # date_read
-                        while True:
-                            try:
-                                client_socket.send(
-                                    "Введите дату прочтения (DD-MM-YYYY): ".encode()
-                                )
-                                date_read = client_socket.recv(1024).decode().strip()
-                                validate_date_read(date_read, date_added)
-                                break
-                            except ValueError as error:
-                                client_socket.send(f"Неверный ввод: {error}\n".encode())
-                        # rating
-                        while True:
-                            try:
-                                client_socket.send(
-                                    "Введите рейтинг (X/10) - комментарий: ".encode()
-                                )
-                                rating = client_socket.recv(1024).decode().strip()
-                                validate_regex("rating", rating)
-                                break
-                            except ValueError as error:
-                                client_socket.send(f"Неверный ввод: {error}\n".encode())
-                        book = {
-                            "name": name,
-                            "authors": authors,
-                            "genres": genres,
-                            "year": year,
-                            "width": width,
-                            "height": height,
-                            "book_type": book_type,
-                            "source": source,
-                            "date_added": date_added,
-                            "date_read": date_read,
-                            "rating": rating,
-                        }
+
+# PROTOCOL
+# Неинтерактивный режим: клиент отправляет PROTO вместо пункта меню, затем
+# по одной команде на строку. Ответ: "OK <n>" и n строк данных либо "ERR <сообщение>"
+def reply_ok(lines: List[str] = ()) -> str:
+    return f"OK {len(lines)}\n" + "".join(f"{line}\n" for line in lines)
+
+
+def reply_error(message: str) -> str:
+    return f"ERR {' '.join(str(message).split())}\n"
+
+
+def line_to_book(line: str) -> dict:
+    """Книга из строки протокола: поля HEADERS без id, разделенные |"""
+    parts = line.strip().split("|")
+    if len(parts) != len(HEADERS) - 1:
+        raise ValueError(f"Ожидается {len(HEADERS) - 1} полей через |, получено {len(parts)}")
+    return dict(zip(HEADERS[1:], parts))
+
+
+def find_book(book_id: str) -> dict:
+    books = search_books("id", book_id)
+    if not books:
+        raise ValueError(f"Книга с ID {book_id} не найдена")
+    return books[0]
+
+
+def is_error(response: str) -> bool:
+    return response.startswith(("Ошибка", "Конфликт"))
+
+
+def command_get(args: str) -> str:
+    return reply_ok([dict_to_line(book) for book in search_books("id", args.strip())])
+
+
+def parse_paging(args: str) -> tuple:
+    """Хвост команды [OFFSET n] [LIMIT n] -> (остаток аргументов, offset, limit)"""
+    match = PAGING_PATTERN.search(args)
+    offset = int(match["offset"] or 0)
+    limit = int(match["limit"]) if match["limit"] else None
+    return args[:match.start()], offset, limit
+
+
+def reply_stream(chunks) -> Generator:
+    """Ответ неизвестной заранее длины: "OK *", строки данных порциями, затем строка "." """
+    yield "OK *\n"
+    try:
+        for chunk in chunks:
+            yield "".join(f"{dict_to_line(book)}\n" for book in chunk)
+    except TimeoutError as error:
+        # Часть строк уже отправлена - ошибка завершает ответ вместо "."
+        yield reply_error(error)
+        return
+    yield ".\n"
+
+
+def command_list(args: str) -> Generator:
+    rest, offset, limit = parse_paging(args)
+    if rest.strip():
+        raise ValueError("Формат: LIST [OFFSET n] [LIMIT n]")
+    return reply_stream(iter_all_books(offset, limit))
+
+
+def command_find(args: str) -> Generator:
+    args, offset, limit = parse_paging(args)
+    field, _, value = args.strip().partition(" ")
+    if field not in HEADERS:
+        raise ValueError(f"Неизвестное поле {field}")
+    return reply_stream(iter_found_books(field, value.strip(), offset, limit))
+
+
+def command_query(args: str) -> Generator:
+    query, offset, limit = parse_paging(args)
+    parse_query(query.strip())
+    return reply_stream(iter_found_books(QUERY_FIELD, query.strip(), offset, limit))
+
+
+SUMMARY_PATTERN = re.compile(
+    r"\s*(?:BY\s+(?P<group>\S+))?\s*(?:WHERE\s+(?P<query>.+?))?\s*$", re.IGNORECASE
+)
+
+
+def command_summary(function: str, args: str) -> str:
+    """COUNT и AVG: [BY <группа>] [WHERE <запрос>]"""
+    match = SUMMARY_PATTERN.fullmatch(args)
+    if match is None:
+        raise ValueError(f"Формат: {function.upper()} [BY <группа>] [WHERE <запрос>]")
+    return reply_ok(summary_lines(function, match["group"], match["query"]))
+
+
+def command_add(args: str) -> str:
+    check_writable()
+    book = line_to_book(args)
+    validate_book(book)
+    response = add_book(book)
+    if "id" not in book or is_error(response):
+        return reply_error(response)
+    return reply_ok([dict_to_line(book)])
+
+
+def command_gen(args: str) -> str:
+    check_writable()
+    if not args.strip().isdigit() or not 1 <= int(args) <= MAX_BATCH_SIZE:
+        raise ValueError(f"Количество книг должно быть от 1 до {MAX_BATCH_SIZE}")
+    return reply_ok(add_books(generate_books(int(args))).splitlines())
+
+
+def command_upd(args: str) -> str:
+    check_writable()
+    book_id, field, value = (args.strip().split(" ", 2) + ["", ""])[:3]
+    if field not in HEADERS[1:]:
+        raise ValueError(f"Неизвестное поле {field}")
+    book = {**find_book(book_id), field: value.strip()}
+    validate_book(book)
+    response = modify_books_file([book], True)
+    if is_error(response):
+        return reply_error(response)
+    return reply_ok([dict_to_line(book)])
+
+
+def command_del(args: str) -> str:
+    check_writable()
+    book = find_book(args.strip())
+    response = modify_books_file([book])
+    if is_error(response):
+        return reply_error(response)
+    return reply_ok([dict_to_line(book)])
+
+
+PAGING_PATTERN = re.compile(
+    r"(?:(?:^|\s+)OFFSET\s+(?P<offset>\d+))?(?:(?:^|\s+)LIMIT\s+(?P<limit>\d+))?\s*$"
+)
+
+PROTOCOL_COMMANDS = {
+    "GET": command_get,
+    "LIST": command_list,
+    "FIND": command_find,
+    "QUERY": command_query,
+    "COUNT": lambda args: command_summary("count", args),
+    "AVG": lambda args: command_summary("avg", args),
+    "ADD": command_add,
+    "GEN": command_gen,
+    "UPD": command_upd,
+    "DEL": command_del,
+    "LOCKS": lambda args: reply_ok(lock_report()),
+    "CACHE": lambda args: reply_ok(cache_report()),
+    "LAG": lambda args: reply_ok(replication_report()),
+    "STATS": lambda args: reply_ok(stats_report()),
+    "PING": lambda args: reply_ok(),
+}
+
+
+def merge_replies(replies: list) -> list:
+    """Склейка соседних текстовых ответов, чтобы отправить их одним вызовом"""
+    merged = []
+    for is_text, group in itertools.groupby(replies, key=lambda reply: isinstance(reply, str)):
+        merged.extend(["".join(group)] if is_text else group)
+    return merged
+
+
+def process_commands(buffer: bytes):
+    """
+    Выполнение всех полных команд из буфера, ответы идут в порядке команд.
+    Возвращает (ответы, необработанный остаток буфера, признак завершения сеанса,
+    сколько полных строк должно быть в остатке, чтобы разбор продвинулся).
+    Ответ - строка или генератор порций (LIST, FIND); после генератора разбор
+    останавливается, чтобы следующие команды не изменили данные до его отправки
+    """
+    replies = []
+    lines = buffer.split(b"\n")
+    rest = lines.pop()
+    wanted = 1
+    i = 0
+    while i < len(lines):
+        command = lines[i].decode(errors="replace").strip()
+        i += 1
+        if not command:
+            continue
+        verb, _, args = command.partition(" ")
+        verb = verb.upper()
+        if verb == "QUIT":
+            replies.append(reply_ok())
+            return merge_replies(replies), b"", True, 0
+        try:
+            if verb == "BATCH":
+                # BATCH n, затем n строк с книгами в формате ADD
+                if not args.strip().isdigit() or not 1 <= int(args) <= MAX_BATCH_SIZE:
+                    raise ValueError(f"Количество книг должно быть от 1 до {MAX_BATCH_SIZE}")
+                count = int(args)
+                if len(lines) - i < count:
+                    # Пакет пришел не полностью - ждем остальные строки
+                    rest = b"\n".join(lines[i - 1:] + [rest])
+                    wanted = count + 1
+                    break
+                # Строки пакета пропускаются целиком до разбора: ошибка в одной книге
+                # не должна превращать остальные в команды
+                batch = lines[i:i + count]
+                i += count
+                check_writable()
+                books = []
+                invalid = {}
+                for number, line in enumerate(batch):
+                    try:
+                        books.append(line_to_book(line.decode()))
+                    except ValueError as error:
+                        books.append(None)
+                        invalid[number] = error
+                replies.append(reply_ok(add_books(books, invalid).splitlines()))
+            elif verb in PROTOCOL_COMMANDS:
+                reply = PROTOCOL_COMMANDS[verb](args)
+                replies.append(reply)
+                if not isinstance(reply, str):
+                    rest = b"\n".join(lines[i:] + [rest])
+                    break
+            else:
+                replies.append(reply_error(f"Неизвестная команда {verb}"))
+        except (ValueError, TimeoutError) as error:
+            replies.append(reply_error(error))
+    return merge_replies(replies), rest, False, wanted
+
+
+def handle_protocol(client_socket, buffer: bytes = b"") -> None:
+    """Сеанс в режиме протокола: все команды, полученные за один recv, обрабатываются пачкой"""
+    while True:
+        replies, buffer, done, wanted = process_commands(buffer)
+        for reply in replies:
+            if isinstance(reply, str):
+                client_socket.sendall(reply.encode())
+            else:
+                for chunk in reply:
+                    client_socket.sendall(chunk.encode())
+        if done:
+            return
+        if replies and not isinstance(replies[-1], str):
+            # Поток прервал разбор пачки - оставшиеся команды уже в буфере
+            continue
+        # Части склеиваются один раз, когда наберется нужное число строк: большой пакет
+        # BATCH приходит за много recv, и разбирать его заново после каждого было бы долго
+        parts = [buffer]
+        lines = buffer.count(b"\n")
+        while lines < wanted:
+            chunk = client_socket.recv(65536)
+            if not chunk:
+                return
+            parts.append(chunk)
+            lines += chunk.count(b"\n")
+        buffer = b"".join(parts)
+
+
+def page_prompt() -> Generator:
+    while True:
+        yield f"Номер страницы (по {PAGE_SIZE} книг, Enter - все): "
+        try:
+            return parse_page((yield RECV).decode())
+        except ValueError as error:
+            yield f"Неверный ввод: {error}\n"
+
+
+def client_session(addr) -> Generator:
+    """
+    Меню ввода команд. Сеанс не работает с сокетом сам: он отдает драйверу
+    строки для отправки, RECV для чтения, Call для блокирующих операций с файлом
+    и SwitchToProtocol для перехода в режим протокола
+    """
+    yield library
+    yield "Добро пожаловать в библиотеку!\n"
+    while True:
+        yield display_menu()
+        data = yield RECV
+        choice = data.decode(errors="replace").strip()
+
+        if choice.partition("\n")[0].strip().upper() == "PROTO":
+            yield "OK PROTO\n"
+            yield SwitchToProtocol(data.partition(b"\n")[2])
+            break
+
+        elif choice in ("1", "4", "5") and follower is not None:
+            yield "".join(f"{line}\n" for line in [
+                "Реплика только для чтения: доступны просмотр, поиск и сводка", *follower.report()
+            ])
+
+        elif choice == "1":
+            while True:
+                yield display_add_menu()
+                choice_add = (yield RECV).decode().strip()
+                if choice_add == "1.1" or choice_add == "1" or choice_add == "1.1.":
+                    book = generate_valid_book(authors_list, genres_list)
+                    yield print_books([book])
+                    yield "Добавить? (д/н): \n"
+                    choice = (yield RECV).decode().strip().lower()
+                    while choice not in ("д", "н", "y", "n"):
+                        yield "Некорректный ввод!\n"
+                        yield "Добавить? (д/н): \n"
+                        choice = (yield RECV).decode().strip()
+                    if choice == "д" or choice == "y":
                         logging.info(f"Добавление книги {book['name']} начато клиентом {addr}")
-                        response = add_book(book)
+                        response = yield Call(add_book, book)
                         logging.info(f"Добавление книги {book['name']} завершено клиентом {addr}")
-                        client_socket.send(response.encode())
+                        yield response
                         break
-                    elif choice_add == "1.3" or choice_add == "3" or choice_add == "1.3.":
-                        break
-                    else:
-                        client_socket.send("Неверный выбор. Попробуйте снова.".encode())
-
-            elif choice == "2":
-                logging.info("Вывод книг начат")
-                response = print_all_books()
-                logging.info("Вывод книг завершен")
-                client_socket.send(response.encode())
-
-            elif choice == "3":
-                client_socket.send(
-                    "Введите поле для поиска (id/name/authors/genres/year/width/height/book_type/source/date_added/date_read/rating): ".encode()
-                )
-                search_field = client_socket.recv(1024).decode().strip().lower()
-                while search_field not in HEADERS:
-                    client_socket.send("Некорректный ввод!\n".encode())
-                    client_socket.send(
-                    "Введите поле для поиска (id/name/authors/genres/year/width/height/book_type/source/date_added/date_read/rating): ".encode()
-                    )
-                    search_field = client_socket.recv(1024).decode().strip().lower()
-                client_socket.send("Введите поисковый запрос: ".encode())
-                search_value = client_socket.recv(1024).decode().strip().lower()
-                logging.info("Поиск книг начат")
-                results = print_books(search_books(search_field, search_value))
-                logging.info("Поиск книг завершен")
-                client_socket.send(str(results).encode())
-
-            elif choice == "4":
-                client_socket.send(
-                    "Введите поле для поиска (id/name/authors/genres/year/width/height/book_type/source/date_added/date_read/rating): ".encode()
-                )
-                search_field = client_socket.recv(1024).decode().strip().lower()
-                while search_field not in HEADERS:
-                    client_socket.send("Некорректный ввод!\n".encode())
-                    client_socket.send(
-                    "Введите поле для поиска (id/name/authors/genres/year/width/height/book_type/source/date_added/date_read/rating): ".encode()
-                    )
-                    search_field = client_socket.recv(1024).decode().strip().lower()
-                client_socket.send("Введите поисковый запрос: ".encode())
-                search_value = client_socket.recv(1024).decode().strip().lower()
-                client_socket.send(
-                    "Введите поле для обновления (id/name/authors/genres/year/width/height/book_type/source/date_added/date_read/rating): ".encode()
-                )
-                update_field = client_socket.recv(1024).decode().strip()
-                while update_field not in HEADERS:
-                    client_socket.send("Некорректный ввод!\n".encode())
-                    client_socket.send(
-                    "Введите поле для поиска (id/name/authors/genres/year/width/height/book_type/source/date_added/date_read/rating): ".encode()
-                    )
-                    update_field = client_socket.recv(1024).decode().strip().lower()
-                if update_field == "name":
+                elif choice_add == "1.2" or choice_add == "2" or choice_add == "1.2.":
                     while True:
                         try:
-                            client_socket.send("Введите название книги: ".encode())
-                            name = client_socket.recv(1024).decode().strip()
+                            yield "Введите название книги: "
+                            name = (yield RECV).decode().strip()
                             validate_regex("name", name)
-                            response = update_books(
-                                client_socket, search_field, search_value, update_field, name
-                            )
-                            client_socket.send(response.encode())
                             break
                         except ValueError as error:
-                            client_socket.send(f"Неверный ввод: {error}\n".encode())
-                elif update_field == "authors":
+                            yield f"Неверный ввод: {error}\n"
+                    # authors
                     while True:
                         try:
-                            client_socket.send(
-                                "Введите авторов (через запятую): ".encode()
-                            )
-                            authors = client_socket.recv(1024).decode().strip()
+                            yield "Введите авторов (через запятую): "
+                            authors = (yield RECV).decode().strip()
                             validate_regex("authors", authors)
-                            response = update_books(
-                                client_socket, search_field, search_value, update_field, authors
-                            )
-                            client_socket.send(response.encode())
                             break
                         except ValueError as error:
-                            client_socket.send(f"Неверный ввод: {error}\n".encode())
-                elif update_field == "genres":
+                            yield f"Неверный ввод: {error}\n"
+                    # genres
                     while True:
                         try:
-                            client_socket.send(
-                                "Введите жанр (через запятую): ".encode()
-                            )
-                            genres = client_socket.recv(1024).decode().strip()
+                            yield "Введите жанр (через запятую): "
+                            genres = (yield RECV).decode().strip()
                             validate_regex("genres", genres)
-                            response = update_books(
-                                client_socket, search_field, search_value, update_field, genres
-                            )
-                            client_socket.send(response.encode())
                             break
                         except ValueError as error:
-                            client_socket.send(f"Неверный ввод: {error}\n".encode())
-                elif update_field == "year":
+                            yield f"Неверный ввод: {error}\n"
+                    # year
                     while True:
                         try:
-                            client_socket.send("Введите год издания: ".encode())
-                            year = client_socket.recv(1024).decode().strip()
+                            yield "Введите год издания: "
+                            year = (yield RECV).decode().strip()
                             validate_year(year)
-                            response = update_books(
-                                client_socket, search_field, search_value, update_field, year
-                            )
-                            client_socket.send(response.encode())
                             break
                         except ValueError as error:
-                            client_socket.send(f"Неверный ввод: {error}\n".encode())
-                elif update_field == "width":
+                            yield f"Неверный ввод: {error}\n"
+                    # width
                     while True:
                         try:
-                            client_socket.send("Введите ширину книги (мм): ".encode())
-                            width = client_socket.recv(1024).decode().strip()
+                            yield "Введите ширину книги (мм): "
+                            width = (yield RECV).decode().strip()
                             validate_width(width)
-                            response = update_books(
-                                client_socket, search_field, search_value, update_field, width
-                            )
-                            client_socket.send(response.encode())
                             break
                         except ValueError as error:
-                            client_socket.send(f"Неверный ввод: {error}\n".encode())
-                elif update_field == "height":
+                            yield f"Неверный ввод: {error}\n"
+                    # height
                     while True:
                         try:
-                            client_socket.send("Введите высоту книги (мм): ".encode())
-                            height = client_socket.recv(1024).decode().strip()
+                            yield "Введите высоту книги (мм): "
+                            height = (yield RECV).decode().strip()
                             validate_height(height)
-                            response = update_books(
-                                client_socket, search_field, search_value, update_field, height
-                            )
-                            client_socket.send(response.encode())
                             break
                         except ValueError as error:
-                            client_socket.send(f"Неверный ввод: {error}\n".encode())
-                elif update_field == "book_type":
+                            yield f"Неверный ввод: {error}\n"
+                    # book_type
                     while True:
                         try:
-                            client_socket.send(
-                                "Введите тип обложки (мягкий/твердый): ".encode()
-                            )
-                            book_type = client_socket.recv(1024).decode().strip()
+                            yield "Введите тип обложки (мягкий/твердый): "
+                            book_type = (yield RECV).decode().strip()
                             validate_regex("book_type", book_type)
-                            response = update_books(
-                                client_socket, search_field, search_value, update_field, book_type
-                            )
-                            client_socket.send(response.encode())
                             break
                         except ValueError as error:
-                            client_socket.send(f"Неверный ввод: {error}\n".encode())
-                elif update_field == "source":
+                            yield f"Неверный ввод: {error}\n"
+                    # source
                     while True:
                         try:
-                            client_socket.send(
-                                "Введите источник (покупка/подарок/наследство): ".encode()
-                            )
-                            source = client_socket.recv(1024).decode().strip()
+                            yield "Введите источник (покупка/подарок/наследство): "
+                            source = (yield RECV).decode().strip()
                             validate_regex("source", source)
-                            response = update_books(
-                                client_socket, search_field, search_value, update_field, source
-                            )
-                            client_socket.send(response.encode())
                             break
                         except ValueError as error:
-                            client_socket.send(f"Неверный ввод: {error}\n".encode())
-                elif update_field == "date_added":
+                            yield f"Неверный ввод: {error}\n"
+                    # date_added
                     while True:
                         try:
-                            client_socket.send(
-                                "Введите дату добавления (DD-MM-YYYY): ".encode()
-                            )
-                            date_added = client_socket.recv(1024).decode().strip()
+                            yield "Введите дату добавления (DD-MM-YYYY): "
+                            date_added = (yield RECV).decode().strip()
                             validate_date_added(date_added, year)
-                            response = update_books(
-                                client_socket, search_field, search_value, update_field, date_added
-                            )
-                            client_socket.send(response.encode())
                             break
                         except ValueError as error:
-                            client_socket.send(f"Неверный ввод: {error}\n".encode())
-                elif update_field == "date_read":
+                            yield f"Неверный ввод: {error}\n"
+                    # date_read
                     while True:
                         try:
-                            client_socket.send(
-                                "Введите дату прочтения (DD-MM-YYYY): ".encode()
-                            )
-                            date_read = client_socket.recv(1024).decode().strip()
+                            yield "Введите дату прочтения (DD-MM-YYYY): "
+                            date_read = (yield RECV).decode().strip()
                             validate_date_read(date_read, date_added)
-                            response = update_books(
-                                client_socket, search_field, search_value, update_field, date_read
-                            )
-                            client_socket.send(response.encode())
                             break
                         except ValueError as error:
-                            client_socket.send(f"Неверный ввод: {error}\n".encode())
-                elif update_field == "rating":
+                            yield f"Неверный ввод: {error}\n"
+                    # rating
                     while True:
                         try:
-                            client_socket.send(
-                                "Введите рейтинг (X/10) - комментарий: ".encode()
-                            )
-                            rating = client_socket.recv(1024).decode().strip()
+                            yield "Введите рейтинг (X/10) - комментарий: "
+                            rating = (yield RECV).decode().strip()
                             validate_regex("rating", rating)
-                            logging.info(f"Обновление книг начато клиентом {addr}")
-                            response = update_books(
-                                client_socket, search_field, search_value, update_field, rating
-                            )
-                            logging.info(f"Обновление книг завершено клиентом {addr}")
-                            client_socket.send(response.encode())
                             break
                         except ValueError as error:
-                            client_socket.send(f"Неверный ввод: {error}\n".encode())
+                            yield f"Неверный ввод: {error}\n"
+                    book = {
+                        "name": name,
+                        "authors": authors,
+                        "genres": genres,
+                        "year": year,
+                        "width": width,
+                        "height": height,
+                        "book_type": book_type,
+                        "source": source,
+                        "date_added": date_added,
+                        "date_read": date_read,
+                        "rating": rating,
+                    }
+                    logging.info(f"Добавление книги {book['name']} начато клиентом {addr}")
+                    response = yield Call(add_book, book)
+                    logging.info(f"Добавление книги {book['name']} завершено клиентом {addr}")
+                    yield response
+                    break
+                elif choice_add == "1.3" or choice_add == "3" or choice_add == "1.3.":
+                    break
+                elif choice_add == "1.4" or choice_add == "4" or choice_add == "1.4.":
+                    while True:
+                        yield f"Сколько книг сгенерировать (1-{MAX_BATCH_SIZE})? "
+                        count = (yield RECV).decode().strip()
+                        if count.isdigit() and 1 <= int(count) <= MAX_BATCH_SIZE:
+                            break
+                        yield "Некорректный ввод!\n"
+                    books = yield Call(generate_books, int(count))
+                    logging.info(f"Пакетное добавление {count} книг начато клиентом {addr}")
+                    response = yield Call(add_books, books)
+                    logging.info(f"Пакетное добавление {count} книг завершено клиентом {addr}")
+                    yield response
+                    break
+                else:
+                    yield "Неверный выбор. Попробуйте снова."
 
-            elif choice == "5":
-                client_socket.send(
-                    "Введите поле для поиска (id/name/authors/genres/year/width/height/book_type/source/date_added/date_read/rating): ".encode()
-                )
-                search_field = client_socket.recv(1024).decode().strip().lower()
-                while search_field not in HEADERS:
-                    client_socket.send("Некорректный ввод!\n".encode())
-                    client_socket.send(
-                    "Введите поле для поиска (id/name/authors/genres/year/width/height/book_type/source/date_added/date_read/rating): ".encode()
-                    )
-                    search_field = client_socket.recv(1024).decode().strip().lower()
-                client_socket.send("Введите поисковый запрос: ".encode())
-                search_value = client_socket.recv(1024).decode().strip().lower()
-                logging.info(f"Удаление книг начато клиентом {addr}")
-                response = delete_books(client_socket, search_field, search_value)
-                logging.info(f"Удаление книг завершено клиентом {addr}")
-                client_socket.send(response.encode())
-
-            elif choice == "6":
-                client_socket.send("Выход из программы.".encode())
-                break
+        elif choice == "2":
+            offset, limit = yield from page_prompt()
+            logging.info("Вывод книг начат")
+            yield Stream(print_all_books(offset, limit))
+            logging.info("Вывод книг завершен")
 
-            else:
-                client_socket.send("Неверный выбор. Попробуйте снова.".encode())
+        elif choice == "3":
+            search_field, search_value = yield from search_condition()
+            offset, limit = yield from page_prompt()
+            logging.info("Поиск книг начат")
+            yield Stream(print_found_books(search_field, search_value, offset, limit))
+            logging.info("Поиск книг завершен")
+
+        elif choice == "4":
+            search_field, search_value = yield from search_condition()
+            yield "Введите поле для обновления (id/name/authors/genres/year/width/height/book_type/source/date_added/date_read/rating): "
+            update_field = (yield RECV).decode().strip()
+            while update_field not in HEADERS:
+                yield "Некорректный ввод!\n"
+                yield "Введите поле для поиска (id/name/authors/genres/year/width/height/book_type/source/date_added/date_read/rating): "
+                update_field = (yield RECV).decode().strip().lower()
+            if update_field == "name":
+                while True:
+                    try:
+                        yield "Введите название книги: "
+                        name = (yield RECV).decode().strip()
+                        validate_regex("name", name)
+                        response = yield from update_books(
+                            search_field, search_value, update_field, name
+                        )
+                        yield response
+                        break
+                    except ValueError as error:
+                        yield f"Неверный ввод: {error}\n"
+            elif update_field == "authors":
+                while True:
+                    try:
+                        yield "Введите авторов (через запятую): "
+                        authors = (yield RECV).decode().strip()
+                        validate_regex("authors", authors)
+                        response = yield from update_books(
+                            search_field, search_value, update_field, authors
+                        )
+                        yield response
+                        break
+                    except ValueError as error:
+                        yield f"Неверный ввод: {error}\n"
+            elif update_field == "genres":
+                while True:
+                    try:
+                        yield "Введите жанр (через запятую): "
+                        genres = (yield RECV).decode().strip()
+                        validate_regex("genres", genres)
+                        response = yield from update_books(
+                            search_field, search_value, update_field, genres
+                        )
+                        yield response
+                        break
+                    except ValueError as error:
+                        yield f"Неверный ввод: {error}\n"
+            elif update_field == "year":
+                while True:
+                    try:
+                        yield "Введите год издания: "
+                        year = (yield RECV).decode().strip()
+                        validate_year(year)
+                        response = yield from update_books(
+                            search_field, search_value, update_field, year
+                        )
+                        yield response
+                        break
+                    except ValueError as error:
+                        yield f"Неверный ввод: {error}\n"
+            elif update_field == "width":
+                while True:
+                    try:
+                        yield "Введите ширину книги (мм): "
+                        width = (yield RECV).decode().strip()
+                        validate_width(width)
+                        response = yield from update_books(
+                            search_field, search_value, update_field, width
+                        )
+                        yield response
+                        break
+                    except ValueError as error:
+                        yield f"Неверный ввод: {error}\n"
+            elif update_field == "height":
+                while True:
+                    try:
+                        yield "Введите высоту книги (мм): "
+                        height = (yield RECV).decode().strip()
+                        validate_height(height)
+                        response = yield from update_books(
+                            search_field, search_value, update_field, height
+                        )
+                        yield response
+                        break
+                    except ValueError as error:
+                        yield f"Неверный ввод: {error}\n"
+            elif update_field == "book_type":
+                while True:
+                    try:
+                        yield "Введите тип обложки (мягкий/твердый): "
+                        book_type = (yield RECV).decode().strip()
+                        validate_regex("book_type", book_type)
+                        response = yield from update_books(
+                            search_field, search_value, update_field, book_type
+                        )
+                        yield response
+                        break
+                    except ValueError as error:
+                        yield f"Неверный ввод: {error}\n"
+            elif update_field == "source":
+                while True:
+                    try:
+                        yield "Введите источник (покупка/подарок/наследство): "
+                        source = (yield RECV).decode().strip()
+                        validate_regex("source", source)
+                        response = yield from update_books(
+                            search_field, search_value, update_field, source
+                        )
+                        yield response
+                        break
+                    except ValueError as error:
+                        yield f"Неверный ввод: {error}\n"
+            elif update_field == "date_added":
+                while True:
+                    try:
+                        yield "Введите дату добавления (DD-MM-YYYY): "
+                        date_added = (yield RECV).decode().strip()
+                        validate_date_added(date_added)
+                        response = yield from update_books(
+                            search_field, search_value, update_field, date_added
+                        )
+                        yield response
+                        break
+                    except ValueError as error:
+                        yield f"Неверный ввод: {error}\n"
+            elif update_field == "date_read":
+                while True:
+                    try:
+                        yield "Введите дату прочтения (DD-MM-YYYY): "
+                        date_read = (yield RECV).decode().strip()
+                        validate_date_read(date_read)
+                        response = yield from update_books(
+                            search_field, search_value, update_field, date_read
+                        )
+                        yield response
+                        break
+                    except ValueError as error:
+                        yield f"Неверный ввод: {error}\n"
+            elif update_field == "rating":
+                while True:
+                    try:
+                        yield "Введите рейтинг (X/10) - комментарий: "
+                        rating = (yield RECV).decode().strip()
+                        validate_regex("rating", rating)
+                        logging.info(f"Обновление книг начато клиентом {addr}")
+                        response = yield from update_books(
+                            search_field, search_value, update_field, rating
+                        )
+                        logging.info(f"Обновление книг завершено клиентом {addr}")
+                        yield response
+                        break
+                    except ValueError as error:
+                        yield f"Неверный ввод: {error}\n"
+
+        elif choice == "5":
+            search_field, search_value = yield from search_condition()
+            logging.info(f"Удаление книг начато клиентом {addr}")
+            response = yield from delete_books(search_field, search_value)
+            logging.info(f"Удаление книг завершено клиентом {addr}")
+            yield response
+
+        elif choice == "7":
+            yield "Что считать: 1 - число книг, 2 - средняя оценка: "
+            function = (yield RECV).decode().strip()
+            while function not in ("1", "2"):
+                yield "Некорректный ввод!\n"
+                yield "Что считать: 1 - число книг, 2 - средняя оценка: "
+                function = (yield RECV).decode().strip()
+            yield f"Группировка ({'/'.join(AGGREGATE_GROUPS)}, Enter - без группировки): "
+            group = (yield RECV).decode().strip().lower()
+            while group and group not in AGGREGATE_GROUPS:
+                yield "Некорректный ввод!\n"
+                yield f"Группировка ({'/'.join(AGGREGATE_GROUPS)}, Enter - без группировки): "
+                group = (yield RECV).decode().strip().lower()
+            yield "Условие (запрос вида year>=1900 AND source~покупка, Enter - все книги): "
+            query = (yield RECV).decode().strip().lower()
+            response = yield Call(
+                print_summary, "count" if function == "1" else "avg", group or None, query or None
+            )
+            yield response
+
+        elif choice == "6":
+            yield "Выход из программы."
+            break
+
+        else:
+            yield "Неверный выбор. Попробуйте снова."
+
+
+def run_session(session: Generator, client_socket) -> None:
+    """Драйвер сеанса для потока: все действия выполняются синхронно"""
+    reply = None
+    while True:
+        try:
+            action = session.send(reply)
+        except StopIteration:
+            return
+        reply = None
+        if action is RECV:
+            reply = client_socket.recv(1024)
+            if not reply:
+                return
+        elif isinstance(action, Call):
+            reply = action.function(*action.args)
+        elif isinstance(action, SwitchToProtocol):
+            handle_protocol(client_socket, action.buffer)
+            return
+        elif isinstance(action, Stream):
+            for chunk in action.chunks:
+                client_socket.sendall(chunk.encode())
+        else:
+            client_socket.sendall(action.encode())
+
+
+def handle_client(client_socket, addr):
+    """ Обслуживание клиента в отдельном потоке"""
+    session = client_session(addr)
+    try:
+        print(f"Подключен клиент {addr}")
+        run_session(session, client_socket)
     except Exception as e:
         print(f"Ошибка с клиентом {addr}: {e}")
     finally:
+        session.close()
         client_socket.close()
         print(f"Клиент {addr} отключен")
 
 
-def start_server(host="127.0.0.1", port=9999):
-    lock_files = list(Path().glob("*.lock"))
+async def write_stream(writer, chunks) -> None:
+    """Отправка порций по мере готовности: каждая порция читается в пуле потоков"""
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            return
+        writer.write(chunk.encode())
+        await writer.drain()
+
+
+async def handle_protocol_async(reader, writer, buffer: bytes = b"") -> None:
+    """Режим протокола для asyncio: команды выполняются в пуле потоков"""
+    loop = asyncio.get_running_loop()
+    while True:
+        replies, buffer, done, wanted = await loop.run_in_executor(None, process_commands, buffer)
+        for reply in replies:
+            if isinstance(reply, str):
+                writer.write(reply.encode())
+                await writer.drain()
+            else:
+                await write_stream(writer, reply)
+        if done:
+            return
+        if replies and not isinstance(replies[-1], str):
+            # Поток прервал разбор пачки - оставшиеся команды уже в буфере
+            continue
+        parts = [buffer]
+        lines = buffer.count(b"\n")
+        while lines < wanted:
+            chunk = await reader.read(65536)
+            if not chunk:
+                return
+            parts.append(chunk)
+            lines += chunk.count(b"\n")
+        buffer = b"".join(parts)
+
+
+async def handle_client_async(reader, writer) -> None:
+    """Драйвер сеанса для asyncio: ожидание ввода не занимает поток, операции с файлом - в пуле потоков"""
+    addr = writer.get_extra_info("peername")
+    loop = asyncio.get_running_loop()
+    session = client_session(addr)
+    reply = None
+    try:
+        print(f"Подключен клиент {addr}")
+        while True:
+            try:
+                action = session.send(reply)
+            except StopIteration:
+                break
+            reply = None
+            if action is RECV:
+                reply = await reader.read(1024)
+                if not reply:
+                    break
+            elif isinstance(action, Call):
+                reply = await loop.run_in_executor(None, action.function, *action.args)
+            elif isinstance(action, SwitchToProtocol):
+                await handle_protocol_async(reader, writer, action.buffer)
+                break
+            elif isinstance(action, Stream):
+                await write_stream(writer, action.chunks)
+            else:
+                writer.write(action.encode())
+                await writer.drain()
+    except Exception as e:
+        print(f"Ошибка с клиентом {addr}: {e}")
+    finally:
+        session.close()
+        writer.close()
+        print(f"Клиент {addr} отключен")
+
+
+def prepare_storage(host: str, replication_port: int = None, follow: tuple = None) -> None:
+    """
+    Общая подготовка при запуске сервера: файл базы, восстановление из журнала,
+    индексы, уплотнение, контрольные точки и репликация.
+    Файлы *.lock не удаляются: flock снимается сам при завершении процесса,
+    а удаление файла сломало бы блокировку у других запущенных серверов
+    """
+    global follower
+    ensure_storage()
+    recover_from_wal()
+    load_indexes()
+    if follow is not None:
+        # Файл реплики меняют только изменения основного сервера
+        follower = Follower(*follow)
+        threading.Thread(target=follower.run, daemon=True).start()
+        return
+    threading.Thread(target=compactor, daemon=True).start()
+    threading.Thread(target=checkpointer, daemon=True).start()
+    threading.Thread(target=backup_worker, daemon=True).start()
+    if replication_port is not None:
+        start_replication(host, replication_port)
 
-    if not lock_files:
-        logging.info("Нет файлов блокировки")
-    else:
-        for lock_file in lock_files:
-            lock_file.unlink()
-        print(f"Удалено {len(lock_files)} файлов блокировки")
+
+def start_server(host="127.0.0.1", port=9999, replication_port=None, follow=None):
+    prepare_storage(host, replication_port, follow)
 
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server.bind((host, port))
-    server.listen(10)
+    server.listen(LISTEN_BACKLOG)
     print(f"Сервер запущен на {host}:{port}")
 
-    while True:
-        client_socket, addr = server.accept()
-        client_thread = threading.Thread(
-            target=handle_client,
-            args=(client_socket, addr),
-            daemon=True
-        )
-        client_thread.start()
+    try:
+        while True:
+            client_socket, addr = server.accept()
+            client_thread = threading.Thread(
+                target=handle_client,
+                args=(client_socket, addr),
+                daemon=True
+            )
+            client_thread.start()
+    finally:
+        save_indexes()
+
+
+async def serve_async(host: str, port: int) -> None:
+    server = await asyncio.start_server(
+        handle_client_async, host, port, backlog=LISTEN_BACKLOG
+    )
+    print(f"Сервер (asyncio) запущен на {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def start_async_server(host="127.0.0.1", port=9999, replication_port=None, follow=None):
+    """Сервер на asyncio: одно событийное ядро вместо потока на каждое соединение"""
+    prepare_storage(host, replication_port, follow)
+    try:
+        asyncio.run(serve_async(host, port))
+    finally:
+        save_indexes()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Сервер домашней библиотеки")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument(
+        "--async", dest="use_asyncio", action="store_true",
+        help="обслуживать клиентов в цикле событий asyncio вместо потоков",
+    )
+    parser.add_argument(
+        "--restore", nargs="?", const="", metavar="ДД-ММ-ГГГГ ЧЧ:ММ:СС",
+        help="восстановить базу из резервных копий на заданный момент (по умолчанию - последнее состояние) и выйти",
+    )
+    parser.add_argument(
+        "--inject", type=parse_fault, action="append", default=[],
+        metavar="ОПЕРАЦИЯ=ЗАДЕРЖКА[:ДОЛЯ_СБОЕВ]",
+        help=f"для тестов: задержка (с) и доля сбоев операции под блокировкой ({', '.join(FAULT_OPERATIONS)})",
+    )
+    parser.add_argument(
+        "--text-indexes", action="store_true",
+        help="строить триграммные индексы для поиска подстроки (много памяти на большой базе)",
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, metavar="PORT",
+        help="отдавать метрики в формате Prometheus на http://127.0.0.1:PORT/metrics",
+    )
+    replication = parser.add_mutually_exclusive_group()
+    replication.add_argument(
+        "--replication-port", type=int, metavar="PORT",
+        help="передавать изменения репликам, подключающимся к этому порту",
+    )
+    replication.add_argument(
+        "--follow", type=parse_address, metavar="HOST:PORT",
+        help="работать репликой только для чтения сервера с портом репликации HOST:PORT",
+    )
+    return parser.parse_args()
+
+
+def parse_address(text: str) -> tuple:
+    host, _, port = text.rpartition(":")
+    if not port.isdigit():
+        raise argparse.ArgumentTypeError(f"Адрес {text} не в формате HOST:PORT")
+    return host or "127.0.0.1", int(port)
 
 
 if __name__ == "__main__":
-    start_server()
+    args = parse_args()
+    faults.update(args.inject)
+    TEXT_INDEXES_ENABLED = args.text_indexes
+    if args.restore is not None:
+        target = datetime.strptime(args.restore, "%d-%m-%Y %H:%M:%S") if args.restore else None
+        if not recover_from_backup(target):
+            print("Нет подходящей резервной копии")
+    else:
+        if args.metrics_port is not None:
+            start_metrics_server(args.metrics_port)
+        if args.use_asyncio:
+            start_async_server(args.host, args.port, args.replication_port, args.follow)
+        else:
+            start_server(args.host, args.port, args.replication_port, args.follow)
@@ -0,0 +1,183 @@
+"""
+Схема полей книги и проверка данных. Регулярные выражения компилируются один раз
+при импорте, книга проверяется целиком (все ошибки полей сообщаются вместе),
+пакет книг - одним вызовом с общей текущей датой
+"""
+import re
+from datetime import date
+from typing import Dict, List
+
+regex_schema = {
+    "name": r"(?!.*([\s])\1)[А-Яа-яЁёA-Za-z0-9\s]{1,100}",
+    "authors": r"(?!.*([\s,])\1)[А-Яа-яЁёA-Za-z\s,]{1,130}",
+    "genres": r"^(?!.*([\s,])\1)[А-Яа-яЁёA-Za-z\s,]{1,100}",
+    "year": r"\d{4}",
+    "width": r"\d+(\.\d+)?",
+    "height": r"\d+(\.\d+)?",
+    "book_type": r"мягкий|твердый",
+    "source": r"покупка|подарок|наследство",
+    "date_added": r"\d{2}-\d{2}-\d{4}",
+    "date_read": r"\d{2}-\d{2}-\d{4}",
+    "rating": r"([1-9]|10)/10 - [А-Яа-яЁёA-Za-z0-9\s\,\.\!\?]{1,200}",
+}
+SCHEMA = {field: re.compile(pattern) for field, pattern in regex_schema.items()}
+
+MIN_YEAR = 1500
+MAX_SIZE = 1000
+SIZE_NAMES = {"width": "Ширина", "height": "Высота"}
+DATE_FIELDS = ("date_added", "date_read")
+
+
+class ValidationError(ValueError):
+    """Ошибки проверки книги: поле -> сообщение"""
+
+    def __init__(self, errors: Dict[str, str]):
+        self.errors = errors
+        super().__init__("; ".join(errors.values()))
+
+
+def parse_date(value: str) -> date:
+    """DD-MM-YYYY -> date без strptime; формат уже проверен регулярным выражением"""
+    return date(int(value[6:10]), int(value[3:5]), int(value[0:2]))
+
+
+def regex_error(field: str, value: str):
+    if SCHEMA[field].fullmatch(value) is None:
+        return f"Значение {value} не соответствует регулярному выражению {regex_schema[field]}"
+    return None
+
+
+# Проверки значения, уже прошедшего регулярное выражение
+def year_range_error(value: str, today: date):
+    if int(value) > today.year:
+        return "Год издания не может быть больше текущего года"
+    if int(value) < MIN_YEAR:
+        return "Год издания не может меньше 1500"
+    return None
+
+
+def size_range_error(field: str, value: str):
+    if float(value) > MAX_SIZE:
+        return f"{SIZE_NAMES[field]} книги не может быть больше 1 метра"
+    if float(value) <= 0:
+        return f"{SIZE_NAMES[field]} книги не может быть отрицательной или равна 0"
+    return None
+
+
+def date_range_error(field: str, parsed: date, today: date):
+    if field == "date_added" and parsed > today:
+        return "Дата добавления не может быть позже текущей даты"
+    return None
+
+
+def field_error(field: str, value: str, today: date):
+    """Сообщение об ошибке значения одного поля без учета других полей или None"""
+    error = regex_error(field, value)
+    if error:
+        return error
+    if field == "year":
+        return year_range_error(value, today)
+    if field in SIZE_NAMES:
+        return size_range_error(field, value)
+    if field in DATE_FIELDS:
+        try:
+            return date_range_error(field, parse_date(value), today)
+        except ValueError:
+            return f"Несуществующая дата {value}"
+    return None
+
+
+def book_errors(book: dict, today: date = None) -> Dict[str, str]:
+    """Все ошибки книги: поле -> сообщение (пустой словарь, если книга верна)"""
+    today = today or date.today()
+    errors = {}
+    dates = {}
+    # Тот же порядок проверок, что в field_error, но без вызова на каждое поле:
+    # на пакете из тысяч книг вызовы функций стоят больше самих регулярных выражений
+    for field, pattern in SCHEMA.items():
+        if field not in book:
+            errors[field] = f"Нет поля {field}"
+            continue
+        value = str(book[field])
+        if pattern.fullmatch(value) is None:
+            errors[field] = (
+                f"Значение {value} не соответствует регулярному выражению {regex_schema[field]}"
+            )
+        elif field == "year":
+            error = year_range_error(value, today)
+            if error:
+                errors[field] = error
+        elif field in SIZE_NAMES:
+            error = size_range_error(field, value)
+            if error:
+                errors[field] = error
+        elif field in DATE_FIELDS:
+            try:
+                dates[field] = parse_date(value)
+            except ValueError:
+                errors[field] = f"Несуществующая дата {value}"
+                continue
+            error = date_range_error(field, dates[field], today)
+            if error:
+                errors[field] = error
+    # Связи между полями проверяются, только если сами поля верны
+    if not errors.keys() & {"year", "date_added"}:
+        if dates["date_added"].year < int(book["year"]):
+            errors["date_added"] = "Год добавления не может быть раньше года издания"
+    if not errors.keys() & {"date_added", "date_read"}:
+        if dates["date_read"] < dates["date_added"]:
+            errors["date_read"] = "Дата чтения не может быть раньше даты добавления"
+    return errors
+
+
+def validate_book(book: dict, today: date = None) -> None:
+    """Проверка всех полей книги; ValidationError со всеми ошибками сразу"""
+    errors = book_errors(book, today)
+    if errors:
+        raise ValidationError(errors)
+
+
+def validate_books(books: List[dict]) -> Dict[int, ValidationError]:
+    """Проверка пакета книг: номер книги в пакете (с 0) -> ошибки"""
+    today = date.today()
+    result = {}
+    for number, book in enumerate(books):
+        errors = book_errors(book, today)
+        if errors:
+            result[number] = ValidationError(errors)
+    return result
+
+
+# Проверка отдельных полей при вводе из меню: ValueError с сообщением.
+# Связи с другими полями проверяются, если переданы их значения
+def check(error) -> None:
+    if error:
+        raise ValueError(error)
+
+
+def validate_regex(field: str, value) -> None:
+    check(regex_error(field, str(value)))
+
+
+def validate_year(year) -> None:
+    check(field_error("year", str(year), date.today()))
+
+
+def validate_width(width) -> None:
+    check(field_error("width", str(width), date.today()))
+
+
+def validate_height(height) -> None:
+    check(field_error("height", str(height), date.today()))
+
+
+def validate_date_added(date_added, year=None) -> None:
+    check(field_error("date_added", str(date_added), date.today()))
+    if year is not None and parse_date(date_added).year < int(year):
+        raise ValueError("Год добавления не может быть раньше года издания")
+
+
+def validate_date_read(date_read, date_added=None) -> None:
+    check(field_error("date_read", str(date_read), date.today()))
+    if date_added is not None and parse_date(date_read) < parse_date(date_added):
+        raise ValueError("Дата чтения не может быть раньше даты добавления")